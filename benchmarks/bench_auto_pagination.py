@@ -0,0 +1,102 @@
+"""Benchmark `all=true` auto-pagination against a local fake nucleus.
+
+Times how long it takes to collect every page of a listing as the number of
+pages and the number of concurrent page fetches grow. Each fake nucleus
+response is delayed to mimic a remote call, so with concurrency `c` the
+wall-clock time should drop roughly by a factor of `c` until the pool or the
+fake server saturates.
+
+Then checks every element is collected, by the threaded and the asyncio
+iterators, from a nucleus capping its pages below the page size asked.
+
+Usage:
+    python benchmarks/bench_auto_pagination.py [latency_ms] [page_size]
+"""
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "domino-extensions-api")
+)
+
+from fake_nucleus import FakeNucleus  # noqa: E402
+from nucleus import AsyncNucleusClient, NucleusClient  # noqa: E402
+from pagination import iter_all_items, iter_all_items_async  # noqa: E402
+
+PAGE_COUNTS = (1, 4, 16, 64)
+CONCURRENCY = (1, 2, 4, 8, 16)
+
+
+def main():
+    latency_ms = float(sys.argv[1]) if len(sys.argv) > 1 else 20.0
+    page_size = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    projects = [
+        {"id": f"{i:024x}", "name": f"project-{i}"}
+        for i in range(max(PAGE_COUNTS) * page_size)
+    ]
+    client = NucleusClient(pool_size=max(CONCURRENCY))
+    print(f"latency={latency_ms}ms page_size={page_size}")
+    print(f"{'pages':>6} " + " ".join(f"{'c=' + str(c):>9}" for c in CONCURRENCY))
+    for pages in PAGE_COUNTS:
+        with FakeNucleus(
+            projects=projects[: pages * page_size], latency_seconds=latency_ms / 1000
+        ) as nucleus:
+            client.base_uri = nucleus.uri
+            timings = []
+            for concurrency in CONCURRENCY:
+                start = time.perf_counter()
+                items = list(
+                    iter_all_items(
+                        client,
+                        "api/projects/beta/projects",
+                        "projects",
+                        {},
+                        {},
+                        page_size=page_size,
+                        concurrency=concurrency,
+                    )
+                )
+                timings.append(time.perf_counter() - start)
+                assert [p["name"] for p in items] == [
+                    f"project-{i}" for i in range(pages * page_size)
+                ]
+        print(f"{pages:>6} " + " ".join(f"{t * 1000:>7.0f}ms" for t in timings))
+
+    # Pages capped to a third of the size asked, with an uneven last one
+    expected = [p["name"] for p in projects[: 10 * page_size + 7]]
+    with FakeNucleus(
+        projects=projects[: len(expected)], max_limit=max(1, page_size // 3)
+    ) as nucleus:
+        client.base_uri = nucleus.uri
+        items = iter_all_items(
+            client, "api/projects/beta/projects", "projects", {}, {}, page_size, 4
+        )
+        assert [p["name"] for p in items] == expected, "capped pages"
+
+        async def collect():
+            async_client = AsyncNucleusClient(nucleus.uri, pool_size=4)
+            items = [
+                item
+                async for item in iter_all_items_async(
+                    async_client,
+                    "api/projects/beta/projects",
+                    "projects",
+                    {},
+                    {},
+                    page_size,
+                    4,
+                )
+            ]
+            await async_client.aclose()
+            return items
+
+        items = asyncio.run(collect())
+        assert [p["name"] for p in items] == expected, "capped pages, asyncio"
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+"""Benchmark the cold load time and memory footprint of the caches.
+
+Loads a synthetic dataset (100k projects / 500k environment revisions by
+default) twice: once the way the caches used to, reading whole documents
+into dict-backed entries, and once through ProjectsCache and
+EnvironmentRevisionCache, which request only the projected fields and build
+slotted entries with shared ObjectIds. Documents are BSON encoded and decoded
+by the stand-in collection so the cost of shipping unused fields is
+included in the load time.
+
+Usage:
+    python benchmarks/bench_cache_footprint.py [scale]
+
+`scale` multiplies the dataset size, e.g. 0.1 for 10k projects / 50k revisions.
+"""
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+import bson
+from bson import ObjectId
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "domino-extensions-api")
+)
+
+from caches import EnvironmentRevisionCache, ProjectsCache  # noqa: E402
+from harness import StandInDatabase  # noqa: E402
+
+PROJECTS = 100_000
+REVISIONS = 500_000
+REVISIONS_PER_ENVIRONMENT = 25
+DOCKERFILE = "RUN pip install --user pandas==1.3.5 scikit-learn==1.0.2\n" * 8
+
+
+class _LegacyEnvironmentRevision:
+    def __init__(self, revision: dict):
+        self._id = ObjectId(revision["_id"])
+        self.environment_id = revision["environmentId"]
+        self.version = int(revision["metadata"]["number"])
+        self.docker_image = revision["definition"].get("dockerImage")
+        self.base_environment_revision_id = revision["definition"].get(
+            "baseEnvironmentRevisionId"
+        )
+
+
+class _LegacyProject:
+    def __init__(self, project: dict):
+        self._id = ObjectId(project["_id"])
+        self.environment_id = project["overrideV2EnvironmentId"]
+        self.default_environment_revision_spec = project[
+            "defaultEnvironmentRevisionSpec"
+        ]
+
+
+def _project_document(value: dict, projection: dict) -> dict:
+    if projection is None:
+        return value
+    projected = {"_id": value["_id"]}
+    for path in projection:
+        source, target = value, projected
+        parts = path.split(".")
+        for part in parts[:-1]:
+            if part not in source:
+                break
+            source = source[part]
+            target = target.setdefault(part, {})
+        else:
+            if parts[-1] in source:
+                target[parts[-1]] = source[parts[-1]]
+    return projected
+
+
+class _SyntheticCollection:
+    """Generates documents on the fly and round trips them through BSON."""
+
+    def __init__(self, count, make_document):
+        self.count = count
+        self.make_document = make_document
+        self.bytes_read = 0
+
+    def find(self, filter=None, projection=None):
+        for i in range(self.count):
+            raw = bson.encode(_project_document(self.make_document(i), projection))
+            self.bytes_read += len(raw)
+            yield bson.decode(raw)
+
+
+def _object_id(kind: int, i: int) -> ObjectId:
+    return ObjectId(f"{kind:08x}{i:016x}")
+
+
+def _revision_document(i: int) -> dict:
+    environment = i // REVISIONS_PER_ENVIRONMENT
+    number = i % REVISIONS_PER_ENVIRONMENT + 1
+    definition = {
+        "dockerfileInstructions": DOCKERFILE,
+        "preRunScript": "echo pre-run",
+        "postRunScript": "",
+        "workspaceTools": [
+            {"name": "jupyter", "iconUrl": "/assets/jupyter.svg", "start": ["/opt/run"]},
+            {"name": "vscode", "iconUrl": "/assets/vscode.svg", "start": ["/opt/code"]},
+        ],
+        "environmentVariables": [{"name": "ENV", "value": "prod"}],
+    }
+    if number == 1:
+        definition["dockerImage"] = "quay.io/domino/standard-environment:ubuntu18-py3.8"
+    else:
+        definition["baseEnvironmentRevisionId"] = _object_id(2, i - 1)
+    return {
+        "_id": _object_id(2, i),
+        "environmentId": _object_id(1, environment),
+        "metadata": {
+            "number": number,
+            "created": 1650000000000 + i,
+            "authorId": _object_id(3, i % 500),
+        },
+        "definition": definition,
+        "status": "Succeeded",
+        "buildLogs": "Step 1/9 : FROM ubuntu\n" * 4,
+    }
+
+
+def _project_document_for(i: int) -> dict:
+    return {
+        "_id": _object_id(4, i),
+        "name": f"project-{i}",
+        "description": "A synthetic project used to size the projects cache. " * 3,
+        "ownerId": _object_id(3, i % 500),
+        "collaborators": [
+            {"collaboratorId": _object_id(3, (i + k) % 500), "role": "Contributor"}
+            for k in range(3)
+        ],
+        "overrideV2EnvironmentId": _object_id(1, i % (REVISIONS // REVISIONS_PER_ENVIRONMENT)),
+        "defaultEnvironmentRevisionSpec": "ActiveRevision",
+        "hardwareTierId": "small-k8s",
+        "tags": ["synthetic", "benchmark"],
+    }
+
+
+def _legacy_load(collection, entry_class):
+    cache = {}
+    for document in collection.find():
+        cache[document["_id"]] = entry_class(document)
+    return cache
+
+
+def _measure(load):
+    gc.collect()
+    start = time.perf_counter()
+    result = load()
+    elapsed = time.perf_counter() - start
+    del result
+    gc.collect()
+    tracemalloc.start()
+    result = load()
+    gc.collect()
+    footprint = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return elapsed, footprint
+
+
+def main():
+    scale = float(sys.argv[1]) if len(sys.argv) > 1 else 1.0
+    projects = _SyntheticCollection(int(PROJECTS * scale), _project_document_for)
+    revisions = _SyntheticCollection(int(REVISIONS * scale), _revision_document)
+    database = StandInDatabase(
+        {"projects": projects, "environment_revisions": revisions}
+    )
+
+    def cached(cache_class):
+        cache = cache_class(database)
+        cache.refresh_cache()
+        return cache
+
+    runs = [
+        ("projects", "full/dict", projects, lambda: _legacy_load(projects, _LegacyProject)),
+        ("projects", "projected/slots", projects, lambda: cached(ProjectsCache)),
+        (
+            "environment_revisions",
+            "full/dict",
+            revisions,
+            lambda: _legacy_load(revisions, _LegacyEnvironmentRevision),
+        ),
+        (
+            "environment_revisions",
+            "projected/slots",
+            revisions,
+            lambda: cached(EnvironmentRevisionCache),
+        ),
+    ]
+    print(
+        f"{'collection':>22} {'variant':>16} {'docs':>8} {'wire_MB':>8} "
+        f"{'load_s':>7} {'memory_MB':>10}"
+    )
+    for name, variant, collection, load in runs:
+        collection.bytes_read = 0
+        elapsed, footprint = _measure(load)
+        print(
+            f"{name:>22} {variant:>16} {collection.count:>8} "
+            f"{collection.bytes_read / 2 / 1e6:>8.1f} {elapsed:>7.2f} "
+            f"{footprint / 1e6:>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""Time a cache reload from Mongo against a restore from its snapshot.
+
+Loads a synthetic dataset (see `synthetic_data.py`) into mongomock, or into
+the Mongo server of `--mongo-uri`, reloads both caches from it, writes their
+snapshots to a temporary folder and restores fresh caches from them. Checks
+that the restored caches hold the same entries and derived indexes (latest
+revision per environment, root images, dangling parents) as the reloaded ones.
+
+Usage:
+    python benchmarks/bench_cache_snapshots.py [--projects 20000] [--mongo-uri mongodb://localhost]
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, "..", "domino-extensions-api"))
+
+from caches import EnvironmentRevisionCache, ProjectsCache  # noqa: E402
+from harness import benchmark_database  # noqa: E402
+from snapshots import CacheSnapshots, snapshot_path  # noqa: E402
+from synthetic_data import add_size_arguments, generate_from_arguments  # noqa: E402
+
+
+def _best(runs: int, action) -> float:
+    best = float("inf")
+    for _ in range(runs):
+        start = time.perf_counter()
+        action()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def _revision_state(cache: EnvironmentRevisionCache):
+    snapshot = cache.snapshot
+    return (
+        {
+            key: (
+                r.environment_id,
+                r.version,
+                r.docker_image,
+                r.base_environment_revision_id,
+            )
+            for key, r in snapshot.cache.items()
+        },
+        {key: r._id for key, r in snapshot.latest_by_environment.items()},
+        {
+            key: sorted(versions)
+            for key, versions in snapshot.by_environment.items()
+        },
+        snapshot.root_images,
+        snapshot.dangling_parents,
+    )
+
+
+def _project_state(cache: ProjectsCache):
+    return {
+        key: (p.environment_id, p.default_environment_revision_spec)
+        for key, p in cache.cache.items()
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_size_arguments(parser)
+    parser.add_argument("--mongo-uri", default="")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.set_defaults(projects=20000, environments=1000)
+    args = parser.parse_args()
+    # Every snapshot load is logged
+    logging.getLogger("extended-api").setLevel(logging.ERROR)
+
+    dataset = generate_from_arguments(args)
+    # A revision based on one which was deleted
+    dataset.environment_revisions[-1]["definition"] = {
+        "baseEnvironmentRevisionId": dataset.projects[0]["_id"]
+    }
+    database = benchmark_database(args.mongo_uri, "extended_api_benchmark")
+    dataset.load(database)
+    print(
+        f"{len(dataset.environment_revisions)} environment revisions, "
+        f"{len(dataset.projects)} projects, "
+        f"{'mongomock' if not args.mongo_uri else args.mongo_uri}"
+    )
+
+    with tempfile.TemporaryDirectory() as directory:
+        for cache_class, state in (
+            (EnvironmentRevisionCache, _revision_state),
+            (ProjectsCache, _project_state),
+        ):
+            name = cache_class.__name__
+            reloaded = cache_class(database)
+            reload_seconds = _best(args.runs, reloaded.refresh_cache)
+            writer = CacheSnapshots([reloaded], directory)
+            write_seconds = _best(
+                args.runs, lambda: writer.write(reloaded, force=True)
+            )
+            size = os.path.getsize(snapshot_path(directory, reloaded))
+
+            restored = cache_class(database)
+            reader = CacheSnapshots([restored], directory)
+            load_seconds = _best(args.runs, lambda: reader.load(restored))
+            assert reader.loads == args.runs and reader.failures == 0
+            assert state(restored) == state(reloaded), f"{name} differs"
+            print(
+                f"{name:>24}: reload {reload_seconds * 1000:8.1f} ms, "
+                f"snapshot write {write_seconds * 1000:6.1f} ms, "
+                f"load {load_seconds * 1000:6.1f} ms ({size / 1e6:.1f} MB, "
+                f"{size / max(len(reloaded.cache), 1):.0f} bytes per entry)"
+            )
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
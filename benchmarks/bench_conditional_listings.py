@@ -0,0 +1,190 @@
+"""Time polls of the enriched listings with and without `If-None-Match`.
+
+Serves the enriched listings in this process, with the Flask app (`sync`) and
+the asyncio app (`async`) driven through their test clients, from caches
+loaded from a synthetic dataset (see `synthetic_data.py`) in mongomock and a
+local fake nucleus (`fake_nucleus.py`) delayed by `--latency-ms`. Each listing
+is polled `--polls` times:
+
+- without a condition, the full listing every time
+- with the ETag of the previous poll, nucleus sending no ETag: the listing is
+  still downloaded from nucleus and hashed, but neither enriched nor sent
+- with the ETag of the previous poll, nucleus sending ETags: the condition is
+  forwarded and nucleus answers 304 as well
+
+Checks that a changed cache and a changed upstream listing are answered with
+the new listing, that a reload of unchanged data or a change undone keeps the
+ETag, and that caches loaded independently, as by two workers, tag the same
+listing with the same ETag.
+
+Usage:
+    python benchmarks/bench_conditional_listings.py [--limit 1000] [--polls 50]
+        [--latency-ms 5] [--projects 5000] [--environments 200]
+"""
+import argparse
+import contextlib
+import logging
+import os
+import sys
+import time
+from urllib.parse import urlencode
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, "..", "domino-extensions-api"))
+
+import mongomock  # noqa: E402
+from bson import ObjectId  # noqa: E402
+
+from fake_nucleus import FakeNucleus  # noqa: E402
+from harness import install_caches, response_body  # noqa: E402
+from synthetic_data import add_size_arguments, generate_from_arguments  # noqa: E402
+
+HEADERS = {"X-Domino-Api-Key": "benchmark-admin"}
+LISTINGS = (
+    ("environments", "/api-extended/environments/beta/environments"),
+    ("projects", "/api-extended/projects/beta/projects"),
+)
+
+
+def _poll(client, path: str, polls: int, conditional: bool):
+    """(mean seconds, mean bytes, statuses) of `polls` polls of `path`."""
+    etag = None
+    statuses = set()
+    size = 0
+    start = time.perf_counter()
+    for _ in range(polls):
+        headers = dict(HEADERS)
+        if conditional and etag:
+            headers["If-None-Match"] = etag
+        resp = client.get(path, headers=headers)
+        assert resp.status_code in (200, 304), resp.status_code
+        statuses.add(resp.status_code)
+        etag = resp.headers.get("ETag", etag)
+        size += len(response_body(resp))
+    return (time.perf_counter() - start) / polls, size / polls, statuses
+
+
+def _added_document(cache) -> dict:
+    if cache.collection_name == "projects":
+        return {
+            "_id": ObjectId(),
+            "overrideV2EnvironmentId": ObjectId(),
+            "defaultEnvironmentRevisionSpec": "ActiveRevision",
+        }
+    return {
+        "_id": ObjectId(),
+        "environmentId": ObjectId(),
+        "metadata": {"number": 1},
+        "definition": {"dockerImage": "added:latest"},
+    }
+
+
+def _check(client, nucleus: FakeNucleus, path: str, cache):
+    resp = client.get(path, headers=HEADERS)
+    etag = resp.headers["ETag"]
+    conditional = dict(HEADERS, **{"If-None-Match": etag})
+    assert client.get(path, headers=conditional).status_code == 304
+    # A new generation of the same content
+    cache.refresh_cache()
+    assert client.get(path, headers=conditional).status_code == 304, "reload"
+    document = _added_document(cache)
+    cache.apply_upsert(document)
+    resp = client.get(path, headers=conditional)
+    assert resp.status_code == 200 and resp.headers["ETag"] != etag, "change"
+    cache.apply_delete(document["_id"])
+    assert client.get(path, headers=conditional).status_code == 304, "undone"
+    nucleus.projects.insert(0, {"id": "0" * 24, "name": "added"})
+    nucleus.environments.insert(0, dict(nucleus.environments[0], name="added"))
+    nucleus._pages.clear()
+    resp = client.get(path, headers=conditional)
+    assert resp.status_code == 200 and resp.headers["ETag"] != etag, "upstream"
+    del nucleus.projects[0], nucleus.environments[0]
+    nucleus._pages.clear()
+
+
+def _check_instances(client, api, database, path: str):
+    # As two workers loading the same collections
+    install_caches(api, database)
+    etag = client.get(path, headers=HEADERS).headers["ETag"]
+    install_caches(api, database)
+    resp = client.get(path, headers=dict(HEADERS, **{"If-None-Match": etag}))
+    assert resp.status_code == 304, "instance"
+
+
+def _clients(mode: str, api, uri: str):
+    if mode == "sync":
+        api.NUCLEUS_CLIENT.base_uri = uri
+        return api.app.test_client()
+    from starlette.testclient import TestClient
+
+    import async_api
+
+    os.environ["DOMINO_NUCLEUS_URI"] = uri
+    return TestClient(async_api.app)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_size_arguments(parser)
+    parser.add_argument("--limit", type=int, default=1000)
+    parser.add_argument("--polls", type=int, default=50)
+    parser.add_argument("--latency-ms", type=float, default=5.0)
+    args = parser.parse_args()
+    # The enhanced listings log every request as a warning
+    logging.getLogger("extended-api").setLevel(logging.ERROR)
+
+    import api
+
+    dataset = generate_from_arguments(args)
+    database = mongomock.MongoClient()["domino"]
+    dataset.load(database)
+    install_caches(api, database)
+    # Both test clients take the query string in the path
+    query = urlencode({"offset": 0, "limit": args.limit})
+    print(
+        f"{args.limit} elements per listing, nucleus latency {args.latency_ms} ms, "
+        f"{args.polls} polls"
+    )
+    for mode in ("sync", "async"):
+        for etags, label in ((False, "body hash"), (True, "nucleus ETag")):
+            with FakeNucleus(
+                environments=dataset.nucleus_environments,
+                projects=dataset.nucleus_projects,
+                latency_seconds=args.latency_ms / 1000,
+                etags=etags,
+            ) as nucleus:
+                client = _clients(mode, api, nucleus.uri)
+                with client if mode == "async" else contextlib.nullcontext():
+                    for name, listing in LISTINGS:
+                        path = f"{listing}?{query}"
+                        cache = (
+                            api.ENVIRONMENT_REVISION_CACHE
+                            if name == "environments"
+                            else api.PROJECTS_CACHE
+                        )
+                        if not etags:
+                            seconds, size, _ = _poll(
+                                client, path, args.polls, False
+                            )
+                            print(
+                                f"{mode:>5} {name:<12} {'full':<30} "
+                                f"{seconds * 1000:7.2f} ms {size / 1000:8.1f} kB"
+                            )
+                        seconds, size, statuses = _poll(
+                            client, path, args.polls, True
+                        )
+                        assert statuses == {200, 304}, statuses
+                        print(
+                            f"{mode:>5} {name:<12} {'if-none-match, ' + label:<30} "
+                            f"{seconds * 1000:7.2f} ms {size / 1000:8.1f} kB"
+                        )
+                        _check(client, nucleus, path, cache)
+                        _check_instances(client, api, database, path)
+                if etags:
+                    assert nucleus.not_modified >= 2 * (args.polls - 1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,416 @@
+"""Benchmark every endpoint of the service against local stand-ins.
+
+Generates a synthetic dataset (`synthetic_data.py`), then starts:
+
+- a fake nucleus (`fake_nucleus.py`, on uvicorn) and a fake Kubernetes API
+  server (`fake_kubernetes.py`) holding the mutations, in a process of their own
+- the service, with the gthread server (`--mode sync`, one gunicorn worker)
+  or the asyncio server (`--mode async`), its Mongo database being an
+  in-memory mongomock database, or a local Mongo with `--mongo-uri`
+
+Once `/readyz` answers, each endpoint is driven by `--concurrency` clients
+for `--duration` seconds (the endpoints which write or reload, one client at
+a time), and its throughput and p50 / p99 latency are reported. Finally the
+caches are reloaded from the same database in this process, to report the
+p50 / p99 duration of a refresh of each cache.
+
+Usage:
+    python benchmarks/bench_endpoints.py [--mode sync|async] [--duration 5]
+        [--concurrency 16] [--latency-ms 5] [--users 1000] [--projects 5000]
+        [--environments 200] [--revision-depth 10] [--base-depth 3]
+        [--mutations 100] [--mongo-uri mongodb://localhost:27017]
+        [--only projects] [--json results.json]
+
+Requires mongomock (`pip install -r benchmarks/requirements.txt`) unless
+`--mongo-uri` is given.
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+from typing import Callable, Dict, List, Tuple
+
+import httpx
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, "..", "domino-extensions-api"))
+
+import synthetic_data  # noqa: E402
+from harness import benchmark_database, free_port, wait_until_up  # noqa: E402
+
+HEADERS = {"X-Domino-Api-Key": "benchmark-admin"}
+PAGE_SIZE = 50
+BATCH_SIZE = 20
+DATABASE_NAME = "domino_benchmark"
+
+# name, method, path, request parameters for the i-th request, serialized
+Endpoint = Tuple[str, str, str, Callable[[int], Dict], bool]
+
+
+def _endpoints(dataset: synthetic_data.Dataset) -> List[Endpoint]:
+    environments = max(len(dataset.nucleus_environments), 1)
+    projects = max(len(dataset.nucleus_projects), 1)
+    mutations = dataset.mutations or [synthetic_data.mutation("mutation-00000")]
+    users = max(len(dataset.users), 1)
+
+    def page(total: int):
+        return lambda i: {
+            "params": {"offset": (i * PAGE_SIZE) % total, "limit": PAGE_SIZE}
+        }
+
+    def batch(i: int) -> Dict:
+        start = (i * BATCH_SIZE) % len(mutations)
+        return {"json": (mutations + mutations)[start : start + BATCH_SIZE]}
+
+    environments_path = "/api-extended/environments/beta/environments"
+    projects_path = "/api-extended/projects/beta/projects"
+    return [
+        ("healthz", "GET", "/healthz", lambda i: {}, False),
+        ("readyz", "GET", "/readyz", lambda i: {}, False),
+        ("environments", "GET", environments_path, page(environments), False),
+        ("projects", "GET", projects_path, page(projects), False),
+        (
+            "projects all=true",
+            "GET",
+            projects_path,
+            lambda i: {"params": {"all": "true"}},
+            False,
+        ),
+        (
+            "projects all=true ndjson",
+            "GET",
+            projects_path,
+            lambda i: {"params": {"all": "true", "stream": "ndjson"}},
+            False,
+        ),
+        ("cache_stats", "GET", "/api-extended/cache_stats", lambda i: {}, False),
+        (
+            "refresh_central_config",
+            "GET",
+            "/api-extended/refresh_central_config",
+            lambda i: {},
+            False,
+        ),
+        ("metrics", "GET", "/metrics", lambda i: {}, False),
+        ("mutation list", "GET", "/mutation/list", lambda i: {}, False),
+        (
+            "mutation get",
+            "GET",
+            "/mutation/{name}",
+            lambda i: {"name": mutations[i % len(mutations)]["metadata"]["name"]},
+            False,
+        ),
+        (
+            "mutation apply (unchanged)",
+            "POST",
+            "/mutation/apply",
+            lambda i: {"json": mutations[i % len(mutations)]},
+            False,
+        ),
+        (
+            f"mutation apply/batch x{BATCH_SIZE}",
+            "POST",
+            "/mutation/apply/batch",
+            batch,
+            False,
+        ),
+        (
+            "workspaceautoshutdown",
+            "POST",
+            "/workspaceautoshutdown/interval",
+            lambda i: {
+                "json": {
+                    "users": {f"user-{i % users}": 3600 + i % 60},
+                    "override_to_default": False,
+                }
+            },
+            True,
+        ),
+        ("refresh_cache", "GET", "/api-extended/refresh_cache", lambda i: {}, True),
+    ]
+
+
+def run_fakes(args: argparse.Namespace):
+    import uvicorn
+
+    from fake_kubernetes import FakeKubernetes
+    from fake_nucleus import FakeNucleus
+
+    dataset = synthetic_data.generate_from_arguments(args)
+    latency = args.latency_ms / 1000
+    kubernetes = FakeKubernetes(
+        dataset.mutations, latency_seconds=latency, port=args.k8s_port
+    )
+    kubernetes.start()
+    nucleus = FakeNucleus(
+        environments=dataset.nucleus_environments,
+        projects=dataset.nucleus_projects,
+        latency_seconds=latency,
+    )
+    uvicorn.run(
+        nucleus.asgi_app,
+        host="127.0.0.1",
+        port=args.port,
+        log_level="warning",
+        backlog=4096,
+        interface="asgi3",
+    )
+
+
+def run_server(args: argparse.Namespace):
+    from kubernetes import client
+
+    import logging
+
+    import api
+    import k8s
+
+    # The Domsed endpoints log every request's headers as warnings
+    logging.getLogger("extendedapi_server_domsed").setLevel(logging.ERROR)
+    dataset = synthetic_data.generate_from_arguments(args)
+    database = benchmark_database(args.mongo_uri, DATABASE_NAME)
+    if not args.mongo_uri:
+        # mongomock lives in this process, a local Mongo is loaded by the driver
+        dataset.load(database)
+    configuration = client.Configuration()
+    configuration.host = f"http://127.0.0.1:{args.k8s_port}"
+    configuration.connection_pool_maxsize = k8s.K8S_CONNECTION_POOL_SIZE
+    k8s._api_client = k8s.TimedApiClient(configuration)
+
+    def init_worker(worker=None):
+        api.configure_logging()
+        api.init_worker(connect=lambda: database)
+
+    if args.mode == "async":
+        import uvicorn
+
+        import async_api
+
+        init_worker()
+        uvicorn.run(
+            async_api.app, host="127.0.0.1", port=args.port, log_level="warning"
+        )
+        return
+
+    from gunicorn.app.base import BaseApplication
+
+    class _Server(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", f"127.0.0.1:{args.port}")
+            self.cfg.set("worker_class", "gthread")
+            self.cfg.set("workers", 1)
+            self.cfg.set("threads", args.threads)
+            self.cfg.set("loglevel", "warning")
+            # The warm-up thread and the informer must start after the fork
+            self.cfg.set("post_worker_init", init_worker)
+
+        def load(self):
+            return api.app
+
+    _Server().run()
+
+
+def _percentile(latencies: List[float], p: float) -> float:
+    if not latencies:
+        return float("nan")
+    return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+
+async def _drive(
+    base_url: str, endpoint: Endpoint, concurrency: int, duration: float
+) -> Dict:
+    name, method, path, build, serialized = endpoint
+    concurrency = 1 if serialized else concurrency
+    latencies: List[float] = []
+    errors = 0
+    counter = 0
+    deadline = time.perf_counter() + duration
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(
+        base_url=base_url, limits=limits, timeout=120, headers=HEADERS
+    ) as client:
+
+        async def worker():
+            nonlocal errors, counter
+            while time.perf_counter() < deadline:
+                i = counter
+                counter += 1
+                request = build(i)
+                url = path.format(name=request.pop("name", ""))
+                start = time.perf_counter()
+                try:
+                    resp = await client.request(method, url, **request)
+                    await resp.aread()
+                    ok = resp.status_code == 200
+                except httpx.HTTPError:
+                    ok = False
+                if ok:
+                    latencies.append(time.perf_counter() - start)
+                else:
+                    errors += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "endpoint": name,
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "rps": len(latencies) / elapsed,
+        "p50_ms": _percentile(latencies, 0.5),
+        "p99_ms": _percentile(latencies, 0.99),
+        "errors": errors,
+    }
+
+
+def _bench_refreshes(database, refreshes: int) -> List[Dict]:
+    from caches import EnvironmentRevisionCache, ProjectsCache
+
+    results = []
+    for cache in (EnvironmentRevisionCache(database), ProjectsCache(database)):
+        durations = []
+        for _ in range(refreshes):
+            start = time.perf_counter()
+            cache.refresh_cache()
+            durations.append(time.perf_counter() - start)
+        durations.sort()
+        results.append(
+            {
+                "cache": type(cache).__name__,
+                "size": len(cache.cache),
+                "refreshes": refreshes,
+                "p50_ms": _percentile(durations, 0.5),
+                "p99_ms": _percentile(durations, 0.99),
+            }
+        )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=["sync", "async"], default="sync")
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--latency-ms", type=float, default=5.0)
+    parser.add_argument("--refreshes", type=int, default=5)
+    parser.add_argument("--mongo-uri")
+    parser.add_argument(
+        "--only", nargs="+", help="Endpoints whose name contains one of these"
+    )
+    parser.add_argument("--json", help="Also write the results to this file")
+    parser.add_argument("--role", choices=["fakes", "server"])
+    parser.add_argument("--port", type=int)
+    parser.add_argument("--k8s-port", type=int)
+    synthetic_data.add_size_arguments(parser)
+    args = parser.parse_args()
+
+    if args.role == "fakes":
+        run_fakes(args)
+        return
+    if args.role == "server":
+        run_server(args)
+        return
+
+    dataset = synthetic_data.generate_from_arguments(args)
+    database = benchmark_database(args.mongo_uri, DATABASE_NAME)
+    dataset.load(database)
+    print(f"dataset: {dataset.summary()}")
+
+    nucleus_port, k8s_port, server_port = free_port(), free_port(), free_port()
+    common = [
+        f"--latency-ms={args.latency_ms}",
+        f"--k8s-port={k8s_port}",
+        *synthetic_data.size_arguments(args),
+    ]
+    if args.mongo_uri:
+        common.append(f"--mongo-uri={args.mongo_uri}")
+    env = dict(
+        os.environ,
+        DOMINO_NUCLEUS_URI=f"http://127.0.0.1:{nucleus_port}",
+        NUCLEUS_POOL_SIZE=str(max(args.threads, 20)),
+        NUCLEUS_ASYNC_POOL_SIZE=str(max(args.concurrency, 20)),
+        PLATFORM_NAMESPACE="domino-platform",
+        LOG_LEVEL="ERROR",
+    )
+    env.pop("PROMETHEUS_MULTIPROC_DIR", None)
+    processes = [
+        subprocess.Popen(
+            [sys.executable, __file__, "--role=fakes", f"--port={nucleus_port}", *common]
+        )
+    ]
+    results: List[Dict] = []
+    refreshes: List[Dict] = []
+    try:
+        processes.append(
+            subprocess.Popen(
+                [
+                    sys.executable,
+                    __file__,
+                    "--role=server",
+                    f"--port={server_port}",
+                    f"--mode={args.mode}",
+                    f"--threads={args.threads}",
+                    *common,
+                ],
+                env=env,
+            )
+        )
+        base_url = f"http://127.0.0.1:{server_port}"
+        wait_until_up(f"{base_url}/readyz", timeout=120.0, process=processes[-1])
+        print(
+            f"mode={args.mode} concurrency={args.concurrency} "
+            f"latency={args.latency_ms}ms duration={args.duration}s"
+        )
+        print(
+            f"{'endpoint':<28} {'conc':>4} {'requests':>8} {'req/s':>8} "
+            f"{'p50':>9} {'p99':>9} {'errors':>6}"
+        )
+        for endpoint in _endpoints(dataset):
+            if args.only and not any(o in endpoint[0] for o in args.only):
+                continue
+            result = asyncio.run(
+                _drive(base_url, endpoint, args.concurrency, args.duration)
+            )
+            results.append(result)
+            print(
+                f"{result['endpoint']:<28} {result['concurrency']:>4} "
+                f"{result['requests']:>8} {result['rps']:>8.1f} "
+                f"{result['p50_ms']:>7.1f}ms {result['p99_ms']:>7.1f}ms "
+                f"{result['errors']:>6}",
+                flush=True,
+            )
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            process.wait()
+
+    refreshes = _bench_refreshes(database, args.refreshes)
+    print(f"\n{'cache refresh':<28} {'size':>8} {'p50':>9} {'p99':>9}")
+    for refresh in refreshes:
+        print(
+            f"{refresh['cache']:<28} {refresh['size']:>8} "
+            f"{refresh['p50_ms']:>7.1f}ms {refresh['p99_ms']:>7.1f}ms"
+        )
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(
+                {
+                    "settings": {
+                        k: v for k, v in vars(args).items() if k not in ("role", "port")
+                    },
+                    "endpoints": results,
+                    "cache_refreshes": refreshes,
+                },
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
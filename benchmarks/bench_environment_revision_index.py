@@ -0,0 +1,75 @@
+"""Benchmark the environment listing enrichment as the revision count grows.
+
+Builds an EnvironmentRevisionCache over a synthetic `environment_revisions`
+collection and times the two lookups the
+`/api-extended/environments/beta/environments` handler performs per
+environment (latest and selected revision). With the secondary indexes the
+per-listing latency should stay flat as the number of revisions grows.
+
+Usage:
+    python benchmarks/bench_environment_revision_index.py [listing_size]
+"""
+import os
+import sys
+import time
+
+from bson import ObjectId
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "domino-extensions-api")
+)
+
+from caches import EnvironmentRevisionCache  # noqa: E402
+from harness import StandInDatabase, StaticCollection  # noqa: E402
+
+REVISIONS_PER_ENVIRONMENT = 10
+
+
+def _synthetic_revisions(revision_count: int):
+    documents = []
+    environment_ids = []
+    for _ in range(revision_count // REVISIONS_PER_ENVIRONMENT):
+        environment_id = ObjectId()
+        environment_ids.append(environment_id)
+        for number in range(1, REVISIONS_PER_ENVIRONMENT + 1):
+            documents.append(
+                {
+                    "_id": ObjectId(),
+                    "environmentId": environment_id,
+                    "metadata": {"number": number},
+                    "definition": {"dockerImage": f"quay.io/domino/env:{number}"},
+                }
+            )
+    return documents, environment_ids
+
+
+def run(revision_count: int, listing_size: int) -> float:
+    documents, environment_ids = _synthetic_revisions(revision_count)
+    cache = EnvironmentRevisionCache(
+        StandInDatabase({"environment_revisions": StaticCollection(documents)})
+    )
+    cache.refresh_cache()
+    listing = environment_ids[:listing_size]
+
+    start = time.perf_counter()
+    for environment_id in listing:
+        latest = cache.try_get_latest_by_environment(environment_id)
+        assert latest.version == REVISIONS_PER_ENVIRONMENT
+        selected = cache.try_get_by_environment(environment_id, 1)
+        assert selected is not None
+    return time.perf_counter() - start
+
+
+def main():
+    listing_size = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    print(f"{'revisions':>10} {'listing':>8} {'elapsed_ms':>11} {'us/env':>8}")
+    for revision_count in (10_000, 50_000, 100_000, 500_000):
+        elapsed = run(revision_count, listing_size)
+        print(
+            f"{revision_count:>10} {listing_size:>8} {elapsed * 1000:>11.2f} "
+            f"{elapsed / listing_size * 1e6:>8.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""Roll out a set of mutations one by one and in batches, and time both.
+
+Serves the Domsed blueprint on a local threaded server, with the Kubernetes
+client pointed at a `fake_kubernetes.py` server and the admin check and
+access token served by a `fake_nucleus.py` server, both delayed by a fixed
+latency as if remote. The mutations are applied with the web client, first
+with `apply` per mutation (a token and a connection per call, then one apply
+at a time), then with `apply_many` (one token and one session, applied
+concurrently by `/mutation/apply/batch`). Every mutation is new for each run.
+
+Usage:
+    python benchmarks/bench_mutation_batch.py [mutations] [latency_ms]
+"""
+import contextlib
+import io
+import os
+import sys
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, ".."))
+sys.path.insert(0, os.path.join(HERE, "..", "domino-extensions-api"))
+
+from flask import Flask  # noqa: E402
+from werkzeug.serving import make_server  # noqa: E402
+
+import domsed_api as domsed  # noqa: E402
+import k8s  # noqa: E402
+from client import domsed_web_client  # noqa: E402
+from fake_kubernetes import GROUP, VERSION, FakeKubernetes  # noqa: E402
+from fake_nucleus import FakeNucleus  # noqa: E402
+from nucleus import NUCLEUS_CLIENT  # noqa: E402
+from utils import PRINCIPAL_CACHE  # noqa: E402
+
+
+def _mutation(run: str, i: int) -> dict:
+    return {
+        "apiVersion": f"{GROUP}/{VERSION}",
+        "kind": "Mutation",
+        "metadata": {"name": f"{run}-{i:04d}"},
+        "rules": [{"labelSelectors": [f"team=t{i}"], "modifyEnv": {"K": str(i)}}],
+    }
+
+
+def _timed(apply) -> float:
+    PRINCIPAL_CACHE.clear()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        apply()
+    return time.perf_counter() - start
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    latency_ms = float(sys.argv[2]) if len(sys.argv) > 2 else 20.0
+    latency = latency_ms / 1000
+    with FakeKubernetes(latency_seconds=latency) as fake, FakeNucleus(
+        latency_seconds=latency
+    ) as nucleus:
+        NUCLEUS_CLIENT.base_uri = nucleus.uri
+        k8s._api_client = fake.api_client(k8s.K8S_CONNECTION_POOL_SIZE)
+        os.environ["DOMINO_API_PROXY"] = nucleus.uri
+        app = Flask(__name__)
+        app.register_blueprint(domsed.domsed_api)
+        server = make_server("127.0.0.1", 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        domsed_web_client.api_endpoint = f"http://127.0.0.1:{server.server_port}"
+
+        print(
+            f"{count} mutations, {latency_ms} ms API server / nucleus latency, "
+            f"batch concurrency {domsed.MUTATION_BATCH_CONCURRENCY}"
+        )
+        one_by_one = [_mutation("single", i) for i in range(count)]
+        seconds = _timed(lambda: [domsed_web_client.apply(m) for m in one_by_one])
+        print(f"apply per mutation: {seconds:6.2f} s")
+        assert fake.writes == count
+
+        batched = [_mutation("batch", i) for i in range(count)]
+        results = []
+        seconds = _timed(
+            lambda: results.extend(domsed_web_client.apply_many(batched))
+        )
+        print(f"apply_many:         {seconds:6.2f} s")
+        assert [r["result"] for r in results] == ["created"] * count, results[:3]
+
+        seconds = _timed(lambda: domsed_web_client.apply_many(batched))
+        print(f"apply_many again:   {seconds:6.2f} s (every mutation unchanged)")
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
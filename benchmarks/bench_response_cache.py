@@ -0,0 +1,157 @@
+"""Time repeat enhanced listings with and without the response cache.
+
+Serves the enhanced listings in this process, with the Flask app (`sync`) and
+the asyncio app (`async`) driven through their test clients, from caches
+loaded from a synthetic dataset (see `synthetic_data.py`) in mongomock and a
+local fake nucleus (`fake_nucleus.py`, sending ETags) delayed by
+`--latency-ms`. Each listing is requested `--requests` times with the same
+credentials and parameters, without and with the response cache, and the
+mean time per request and the nucleus calls are reported. Checks that:
+
+- other credentials or other parameters are not served the cached listing
+- a new cache generation is not served the cached listing
+- an expired entry is served stale while a single background revalidation
+  runs, which nucleus answers with 304
+
+Usage:
+    python benchmarks/bench_response_cache.py [--limit 1000] [--requests 200]
+        [--latency-ms 5] [--projects 5000] [--environments 200]
+"""
+import argparse
+import contextlib
+import logging
+import os
+import sys
+import time
+from urllib.parse import urlencode
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, "..", "domino-extensions-api"))
+
+import mongomock  # noqa: E402
+
+from fake_nucleus import FakeNucleus  # noqa: E402
+from harness import install_caches, response_body, wait_until  # noqa: E402
+from synthetic_data import add_size_arguments, generate_from_arguments  # noqa: E402
+
+HEADERS = {"X-Domino-Api-Key": "benchmark-admin"}
+OTHER_HEADERS = {"X-Domino-Api-Key": "benchmark-user"}
+LISTINGS = (
+    ("environments", "/api-extended/environments/beta/environments"),
+    ("projects", "/api-extended/projects/beta/projects"),
+)
+TTL_SECONDS = 60.0
+
+
+def _time(client, path: str, requests: int) -> float:
+    start = time.perf_counter()
+    for _ in range(requests):
+        assert client.get(path, headers=HEADERS).status_code == 200
+    return (time.perf_counter() - start) / requests
+
+
+def _check(client, api, nucleus: FakeNucleus, path: str, cache):
+    response_cache = api.RESPONSE_CACHE
+    response_cache.clear()
+    first = client.get(path, headers=HEADERS)
+    calls = nucleus.requests
+    assert response_body(client.get(path, headers=HEADERS)) == response_body(first)
+    assert nucleus.requests == calls, "hit"
+
+    client.get(path, headers=OTHER_HEADERS)
+    assert nucleus.requests == calls + 1, "other credentials"
+    client.get(path.replace("offset=0", "offset=1"), headers=HEADERS)
+    assert nucleus.requests == calls + 2, "other parameters"
+
+    cache.refresh_cache()
+    resp = client.get(path, headers=HEADERS)
+    assert nucleus.requests == calls + 3, "generation"
+    assert resp.headers[api.CACHE_GENERATION_HEADER] == str(cache.generation)
+
+    # Expired: served stale, revalidated once in the background
+    response_cache.ttl_seconds = 0.5
+    time.sleep(0.6)
+    not_modified = nucleus.not_modified
+    revalidations = response_cache.revalidations
+    stale = [client.get(path, headers=HEADERS) for _ in range(5)]
+    assert all(response_body(resp) == response_body(stale[0]) for resp in stale)
+    wait_until(lambda: not response_cache._revalidating)
+    assert nucleus.not_modified == not_modified + 1, "nucleus 304"
+    assert response_cache.revalidations == revalidations + 1, "single revalidation"
+    calls = nucleus.requests
+    client.get(path, headers=HEADERS)
+    assert nucleus.requests == calls, "revalidated"
+    response_cache.ttl_seconds = TTL_SECONDS
+
+
+def _client(mode: str, api, uri: str):
+    if mode == "sync":
+        api.NUCLEUS_CLIENT.base_uri = uri
+        return api.app.test_client()
+    from starlette.testclient import TestClient
+
+    import async_api
+
+    os.environ["DOMINO_NUCLEUS_URI"] = uri
+    return TestClient(async_api.app)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_size_arguments(parser)
+    parser.add_argument("--limit", type=int, default=1000)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--latency-ms", type=float, default=5.0)
+    args = parser.parse_args()
+    # The enhanced listings log every request as a warning
+    logging.getLogger("extended-api").setLevel(logging.ERROR)
+
+    import api
+    from response_cache import ResponseCache
+
+    dataset = generate_from_arguments(args)
+    database = mongomock.MongoClient()["domino"]
+    dataset.load(database)
+    install_caches(api, database)
+    # Both test clients take the query string in the path
+    query = urlencode({"offset": 0, "limit": args.limit})
+    print(
+        f"{args.limit} elements per listing, nucleus latency {args.latency_ms} ms, "
+        f"{args.requests} requests"
+    )
+    for mode in ("sync", "async"):
+        with FakeNucleus(
+            environments=dataset.nucleus_environments,
+            projects=dataset.nucleus_projects,
+            latency_seconds=args.latency_ms / 1000,
+            etags=True,
+        ) as nucleus:
+            client = _client(mode, api, nucleus.uri)
+            with client if mode == "async" else contextlib.nullcontext():
+                for name, listing in LISTINGS:
+                    path = f"{listing}?{query}"
+                    cache = (
+                        api.ENVIRONMENT_REVISION_CACHE
+                        if name == "environments"
+                        else api.PROJECTS_CACHE
+                    )
+                    for label, response_cache in (
+                        ("no response cache", None),
+                        ("response cache", ResponseCache(ttl_seconds=TTL_SECONDS)),
+                    ):
+                        api.RESPONSE_CACHE = response_cache
+                        calls = nucleus.requests
+                        seconds = _time(client, path, args.requests)
+                        print(
+                            f"{mode:>5} {name:<12} {label:<18} "
+                            f"{seconds * 1e6:9.0f} us per request, "
+                            f"{nucleus.requests - calls:4} nucleus calls"
+                        )
+                    _check(client, api, nucleus, path, cache)
+                    api.RESPONSE_CACHE = None
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
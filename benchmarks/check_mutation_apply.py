@@ -0,0 +1,116 @@
+"""Check `/mutation/apply` against a fake Kubernetes API server.
+
+Serves the Domsed blueprint with the Kubernetes client pointed at a
+`fake_kubernetes.py` server and the admin check answered by a `fake_nucleus.py`
+server, then applies mutations and checks the reported result and the API
+server traffic of each apply:
+
+- a new mutation is created
+- re-applying it unchanged makes no API server write
+- a changed mutation is replaced in place, with the resourceVersion it was
+  compared with
+- a mutation changed behind the informer's back (409 Conflict) is retried
+
+Runs once reading through the informer and once without it.
+
+Usage:
+    python benchmarks/check_mutation_apply.py
+"""
+import copy
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "domino-extensions-api")
+)
+
+from flask import Flask  # noqa: E402
+from kubernetes.client import CustomObjectsApi  # noqa: E402
+
+import domsed_api as domsed  # noqa: E402
+import k8s  # noqa: E402
+from fake_kubernetes import GROUP, PLURAL, VERSION, FakeKubernetes  # noqa: E402
+from fake_nucleus import FakeNucleus  # noqa: E402
+from nucleus import NUCLEUS_CLIENT  # noqa: E402
+
+HEADERS = {"X-Domino-Api-Key": "admin"}
+
+
+def _mutation(name: str, value: str) -> dict:
+    return {
+        "apiVersion": f"{GROUP}/{VERSION}",
+        "kind": "Mutation",
+        "metadata": {"name": name, "labels": {"team": "platform"}},
+        "rules": [{"labelSelectors": ["team=t1"], "modifyEnv": {"K": value}}],
+    }
+
+
+def _apply(client, fake: FakeKubernetes, mutation: dict):
+    requests, writes = fake.requests, fake.writes
+    resp = client.post("/mutation/apply", json=mutation, headers=HEADERS)
+    assert resp.status_code == 200, resp.data
+    out = resp.get_json()
+    return out, fake.requests - requests, fake.writes - writes
+
+
+def _check(client, fake: FakeKubernetes, api: CustomObjectsApi, label: str):
+    name = f"apply-{label}"
+    namespace = domsed.platform_namespace
+
+    out, requests, writes = _apply(client, fake, _mutation(name, "1"))
+    assert out["result"] == "created" and writes == 1, (out, writes)
+    print(f"{label:>12}: created   {requests} requests, {writes} writes")
+
+    if domsed.MUTATION_INFORMER is not None:
+        # Let the ADDED event arrive, as it would between two applies
+        time.sleep(0.2)
+    out, requests, writes = _apply(client, fake, _mutation(name, "1"))
+    assert out["result"] == "unchanged" and writes == 0, (out, writes)
+    print(f"{label:>12}: unchanged {requests} requests, {writes} writes")
+
+    before = out["mutation"]["metadata"]["uid"]
+    out, requests, writes = _apply(client, fake, _mutation(name, "2"))
+    assert out["result"] == "updated" and writes == 1, (out, writes)
+    assert out["mutation"]["metadata"]["uid"] == before, "mutation was recreated"
+    assert out["mutation"]["rules"][0]["modifyEnv"]["K"] == "2"
+    print(f"{label:>12}: updated   {requests} requests, {writes} writes")
+
+    # Someone else changes it, the apply compares with a stale copy
+    fake.watches_paused = True
+    current = api.get_namespaced_custom_object(GROUP, VERSION, namespace, PLURAL, name)
+    changed = copy.deepcopy(current)
+    changed["rules"][0]["modifyEnv"]["K"] = "3"
+    api.replace_namespaced_custom_object(
+        GROUP, VERSION, namespace, PLURAL, name, changed
+    )
+    out, requests, writes = _apply(client, fake, _mutation(name, "4"))
+    fake.watches_paused = False
+    assert out["result"] == "updated", out
+    stored = api.get_namespaced_custom_object(GROUP, VERSION, namespace, PLURAL, name)
+    assert stored["rules"][0]["modifyEnv"]["K"] == "4", stored
+    print(f"{label:>12}: conflict  {requests} requests, {writes} writes")
+
+
+def main():
+    with FakeKubernetes() as fake, FakeNucleus() as nucleus:
+        NUCLEUS_CLIENT.base_uri = nucleus.uri
+        k8s._api_client = fake.api_client()
+        api = CustomObjectsApi(k8s._api_client)
+        app = Flask(__name__)
+        app.register_blueprint(domsed.domsed_api)
+        client = app.test_client()
+
+        _check(client, fake, api, "api-server")
+
+        informer = domsed.start_mutation_informer()
+        informer.watch_timeout_seconds = 1
+        assert informer.synced.wait(10), "informer never synced"
+        _check(client, fake, api, "informer")
+        domsed.stop_mutation_informer()
+        print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""Check the mutation informer against a fake Kubernetes API server.
+
+Lists and watches the mutations of a `fake_kubernetes.py` server, applies a
+series of creates, patches and deletes, and checks the informer ends up with
+the same mutations as the server. Then a write in another namespace is
+followed by bookmarks, which must move the resourceVersion of the informer
+past it without any event. Then the watch is stalled while more
+changes are made and the event history of the server is compacted, so the
+next watch gets `410 Gone`, which must make the informer list the mutations
+again. Finally compares the latency of reading
+a mutation from the informer and from the (simulated remote) API server.
+
+Usage:
+    python benchmarks/check_mutation_informer.py [mutations] [latency_ms]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "domino-extensions-api")
+)
+
+from kubernetes.client import CustomObjectsApi  # noqa: E402
+
+from fake_kubernetes import GROUP, PLURAL, VERSION, FakeKubernetes  # noqa: E402
+from harness import wait_until  # noqa: E402
+from mutation_informer import MutationInformer  # noqa: E402
+
+NAMESPACE = "domino-platform"
+
+
+def _mutation(i: int) -> dict:
+    return {
+        "apiVersion": f"{GROUP}/{VERSION}",
+        "kind": "Mutation",
+        "metadata": {"name": f"mutation-{i:04d}"},
+        "rules": [{"labelSelectors": [f"team=t{i}"], "modifyEnv": {"K": str(i)}}],
+    }
+
+
+def _consistent(informer: MutationInformer, k8s: FakeKubernetes) -> bool:
+    return informer.list()["items"] == k8s.list(NAMESPACE)["items"]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    latency_ms = float(sys.argv[2]) if len(sys.argv) > 2 else 5.0
+    with FakeKubernetes([_mutation(i) for i in range(count)]) as k8s:
+        api = CustomObjectsApi(k8s.api_client())
+        informer = MutationInformer(
+            NAMESPACE, api=lambda: api, watch_timeout_seconds=1
+        )
+        informer.start()
+        assert informer.synced.wait(10), "informer never synced"
+        assert _consistent(informer, k8s)
+        print(f"synced {informer.stats()['size']} mutations")
+
+        def writes(start: int):
+            for i in range(start, start + 10):
+                api.create_namespaced_custom_object(
+                    GROUP, VERSION, NAMESPACE, PLURAL, _mutation(count + i)
+                )
+            for i in range(start, start + 10):
+                api.patch_namespaced_custom_object(
+                    GROUP, VERSION, NAMESPACE, PLURAL, f"mutation-{i:04d}",
+                    {"rules": [{"labelSelectors": ["patched=true"]}]},
+                )
+            for i in range(start + 10, start + 20):
+                api.delete_namespaced_custom_object(
+                    GROUP, VERSION, NAMESPACE, PLURAL, f"mutation-{i:04d}"
+                )
+
+        writes(0)
+        wait_until(lambda: _consistent(informer, k8s), what="consistency")
+        print(f"after watched writes: {informer.stats()}")
+
+        # Only bookmarks tell the informer about writes it does not watch
+        events = informer.stats()["events"]
+        api.create_namespaced_custom_object(
+            GROUP, VERSION, "other-namespace", PLURAL, _mutation(count + 100)
+        )
+        wait_until(
+            lambda: informer.resource_version == str(k8s.resource_version),
+            what="bookmarks",
+        )
+        stats = informer.stats()
+        assert stats["bookmarks"] > 0 and stats["events"] == events, stats
+        print(f"after bookmarks: {stats}")
+
+        # The stalled watch ends at its timeout and resumes from a
+        # resourceVersion the server no longer has
+        k8s.watches_paused = True
+        writes(40)
+        k8s.compact()
+        k8s.watches_paused = False
+        wait_until(lambda: _consistent(informer, k8s), what="consistency after 410")
+        stats = informer.stats()
+        print(f"after 410 Gone: {stats}")
+        assert stats["relists"] == 2, f"expected one relist, got {stats['relists']}"
+
+        k8s.latency_seconds = latency_ms / 1000
+        name = "mutation-0100"
+        start = time.perf_counter()
+        for _ in range(20):
+            api.get_namespaced_custom_object(GROUP, VERSION, NAMESPACE, PLURAL, name)
+        api_ms = (time.perf_counter() - start) / 20 * 1000
+        start = time.perf_counter()
+        for _ in range(20000):
+            informer.get(name)
+        informer_us = (time.perf_counter() - start) / 20000 * 1e6
+        start = time.perf_counter()
+        for _ in range(100):
+            informer.list()
+        list_us = (time.perf_counter() - start) / 100 * 1e6
+        print(
+            f"get: API server {api_ms:.2f} ms, informer {informer_us:.2f} us; "
+            f"informer list of {stats['size']}: {list_us:.0f} us"
+        )
+        informer.stop()
+        print("OK")
+
+
+if __name__ == "__main__":
+    main()
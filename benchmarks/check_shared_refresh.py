@@ -0,0 +1,289 @@
+"""Check the shared cache refresh of several replicas and count the Mongo scans.
+
+Runs `replicas` workers in one process, each with its own caches, snapshot
+folder and HTTP server serving `/api-extended/cache_snapshots/<collection>`,
+electing a leader on a Lease of a `fake_kubernetes.py` server. The caches
+read a synthetic dataset (see `synthetic_data.py`) from mongomock, through a
+wrapper counting the full collection scans. Checks that:
+
+- warming every replica up scans each collection once (the leader's load)
+- the snapshots are only served with the token the leader published
+- a refresh asked of a follower reloads once and reaches every replica
+- refreshes asked of every follower at once are coalesced by the leader
+- when the leader dies, a follower takes the Lease over and keeps refreshing
+- a follower whose caches follow change streams only pulls the snapshots of
+  the refreshes it asked for, and its watchers resume from them
+- without a leader, a lookup of an unknown id on a follower gives up after
+  the miss timeout instead of failing after the refresh timeout
+
+and compares the scans with the same replicas refreshing on their own.
+
+Usage:
+    python benchmarks/check_shared_refresh.py [--replicas 4] [--projects 5000]
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, "..", "domino-extensions-api"))
+
+import mongomock  # noqa: E402
+import requests  # noqa: E402
+from bson import ObjectId  # noqa: E402
+from flask import Flask, Response, request, send_file  # noqa: E402
+from kubernetes.client import CoordinationV1Api  # noqa: E402
+from werkzeug.serving import make_server  # noqa: E402
+
+from caches import EnvironmentRevisionCache, ProjectsCache  # noqa: E402
+from fake_kubernetes import FakeKubernetes  # noqa: E402
+from harness import CountingDatabase, wait_until  # noqa: E402
+from shared_refresh import (  # noqa: E402
+    SNAPSHOT_TOKEN_HEADER,
+    LeaseElector,
+    SharedCacheRefresh,
+)
+from snapshots import CacheSnapshots  # noqa: E402
+from synthetic_data import add_size_arguments, generate_from_arguments  # noqa: E402
+
+LEASE = "extended-api-cache-refresh"
+NAMESPACE = "domino-field"
+LEASE_DURATION_SECONDS = 2
+RETRY_PERIOD_SECONDS = 0.2
+MISS_TIMEOUT_SECONDS = 0.5
+SYNC_TIMEOUT_SECONDS = 30.0
+
+
+class _Replica:
+    def __init__(self, index: int, database, kubernetes: FakeKubernetes, root: str):
+        self.name = f"replica-{index}"
+        self.caches = [EnvironmentRevisionCache(database), ProjectsCache(database)]
+        self.snapshots = CacheSnapshots(self.caches, os.path.join(root, self.name))
+        app = Flask(self.name)
+        app.add_url_rule(
+            "/api-extended/cache_snapshots/<collection>", view_func=self._snapshot
+        )
+        self.server = make_server("127.0.0.1", 0, app, threaded=True)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        api_client = kubernetes.api_client()
+        self.shared = SharedCacheRefresh(
+            self.caches,
+            self.snapshots,
+            LeaseElector(
+                LEASE,
+                NAMESPACE,
+                self.name,
+                LEASE_DURATION_SECONDS,
+                api=lambda: CoordinationV1Api(api_client),
+            ),
+            f"http://127.0.0.1:{self.server.server_port}",
+            retry_period_seconds=RETRY_PERIOD_SECONDS,
+            refresh_timeout_seconds=30,
+            miss_timeout_seconds=MISS_TIMEOUT_SECONDS,
+        )
+
+    def _snapshot(self, collection):
+        # As the route of api.py
+        if not self.shared.authorized(request.headers.get(SNAPSHOT_TOKEN_HEADER)):
+            return Response("Not authorized to download the cache snapshots", 403)
+        path = self.shared.snapshot_file(collection)
+        if path is None:
+            return Response(f"No snapshot of {collection}", 404)
+        return send_file(path, mimetype="application/octet-stream")
+
+    def warm_up(self):
+        # As the warm-up steps of api.py
+        self.shared.start()
+        for cache in self.caches:
+            if self.shared.leader:
+                cache.refresh_cache()
+            else:
+                self.shared.pull(cache)
+
+    def refresh(self):
+        # As /api-extended/refresh_cache
+        for cache in self.caches:
+            cache.refresh_cache()
+
+    def crash(self):
+        """Stop electing without giving the Lease up."""
+        self.shared._stop_event.set()
+        self.shared._lead.set()
+        for thread in self.shared._threads:
+            thread.join()
+        self.server.shutdown()
+
+
+class _Watcher:
+    """Stands for a change stream watcher, mongomock has no change streams."""
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.restores = 0
+
+    def restore(self, load):
+        self.restores += 1
+        return load()
+
+
+def _state(replica: _Replica):
+    return tuple(frozenset(cache.cache) for cache in replica.caches)
+
+
+def _scans(database: CountingDatabase) -> str:
+    return ", ".join(f"{name} {count}" for name, count in sorted(database.scans.items()))
+
+
+def _report(step: str, database: CountingDatabase, seconds: float):
+    print(f"{step:<44} {seconds:6.2f} s   scans: {_scans(database)}")
+    database.scans.clear()
+
+
+def _add_project(database, i: int):
+    database.database["projects"].insert_one(
+        {
+            "_id": ObjectId(),
+            "name": f"added-{i}",
+            "overrideV2EnvironmentId": None,
+            "defaultEnvironmentRevisionSpec": "ActiveRevision",
+        }
+    )
+
+
+def _in_sync(replicas):
+    return lambda: len({_state(replica) for replica in replicas}) == 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_size_arguments(parser)
+    parser.add_argument("--replicas", type=int, default=4)
+    args = parser.parse_args()
+    logging.getLogger("extended-api").setLevel(logging.ERROR)
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+
+    database = CountingDatabase(mongomock.MongoClient()["domino"])
+    generate_from_arguments(args).load(database.database)
+    print(f"{args.replicas} replicas, {args.projects} projects")
+
+    with FakeKubernetes() as kubernetes, tempfile.TemporaryDirectory() as root:
+        replicas = [
+            _Replica(i, database, kubernetes, root) for i in range(args.replicas)
+        ]
+        start = time.perf_counter()
+        for replica in replicas:
+            replica.warm_up()
+        wait_until(_in_sync(replicas), SYNC_TIMEOUT_SECONDS)
+        assert all(len(replica.caches[1].cache) == args.projects for replica in replicas)
+        assert sum(database.scans.values()) == 2, database.scans
+        _report("warm up", database, time.perf_counter() - start)
+
+        leader = next(replica for replica in replicas if replica.shared.leader)
+        followers = [replica for replica in replicas if replica is not leader]
+        url = leader.shared.url + "/api-extended/cache_snapshots/projects"
+        for headers, status in (
+            ({}, 403),
+            ({SNAPSHOT_TOKEN_HEADER: followers[0].shared.token}, 403),
+            ({SNAPSHOT_TOKEN_HEADER: leader.shared.token}, 200),
+        ):
+            assert requests.get(url, headers=headers).status_code == status, headers
+        _add_project(database, 0)
+        start = time.perf_counter()
+        followers[0].refresh()
+        wait_until(_in_sync(replicas), SYNC_TIMEOUT_SECONDS)
+        assert all(len(r.caches[1].cache) == args.projects + 1 for r in replicas)
+        assert database.scans == {"environment_revisions": 1, "projects": 1}
+        _report("refresh on a follower", database, time.perf_counter() - start)
+
+        _add_project(database, 1)
+        start = time.perf_counter()
+        threads = [threading.Thread(target=r.refresh) for r in followers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wait_until(_in_sync(replicas), SYNC_TIMEOUT_SECONDS)
+        assert all(len(r.caches[1].cache) == args.projects + 2 for r in replicas)
+        assert max(database.scans.values()) <= 2, database.scans
+        _report(f"refresh on {len(followers)} followers at once", database, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        leader.crash()
+        wait_until(lambda: any(r.shared.leader for r in followers), SYNC_TIMEOUT_SECONDS)
+        leader = next(r for r in followers if r.shared.leader)
+        followers = [r for r in followers if r is not leader]
+        _report("leader crash, Lease taken over", database, time.perf_counter() - start)
+
+        _add_project(database, 2)
+        start = time.perf_counter()
+        if followers:
+            followers[0].refresh()
+        else:
+            leader.refresh()
+        survivors = [leader] + followers
+        wait_until(_in_sync(survivors), SYNC_TIMEOUT_SECONDS)
+        assert all(len(r.caches[1].cache) == args.projects + 3 for r in survivors)
+        assert database.scans == {"environment_revisions": 1, "projects": 1}
+        _report("refresh after the takeover", database, time.perf_counter() - start)
+
+        if len(followers) >= 2:
+            watched = followers[-1]
+            watchers = [_Watcher(cache) for cache in watched.caches]
+            watched.shared.follow_watchers(watchers)
+            generations = [cache.generation for cache in watched.caches]
+            _add_project(database, 3)
+            start = time.perf_counter()
+            followers[0].refresh()
+            wait_until(
+                lambda: watched.shared._pulled == leader.shared._pulled,
+                SYNC_TIMEOUT_SECONDS,
+            )
+            assert [cache.generation for cache in watched.caches] == generations
+            assert not any(watcher.restores for watcher in watchers)
+            watched.refresh()
+            assert len(watched.caches[1].cache) == args.projects + 4
+            assert all(watcher.restores == 1 for watcher in watchers)
+            _report("refreshes with followers on change streams", database, time.perf_counter() - start)
+
+        if followers:
+            # The Lease is only taken over once expired, nobody answers meanwhile
+            leader.crash()
+            survivors.remove(leader)
+            cache = followers[0].caches[1]
+            # Not throttled by the refreshes of the previous steps
+            cache.refresher.min_refresh_interval_seconds = 0
+            start = time.perf_counter()
+            assert cache.get(ObjectId()) is None
+            seconds = time.perf_counter() - start
+            assert MISS_TIMEOUT_SECONDS <= seconds < MISS_TIMEOUT_SECONDS + 1, seconds
+            _report("unknown id on a follower, no leader", database, seconds)
+
+        for replica in survivors:
+            replica.shared.stop()
+            replica.server.shutdown()
+
+    # The same replicas without a shared refresh
+    alone = [
+        [EnvironmentRevisionCache(database), ProjectsCache(database)]
+        for _ in range(args.replicas)
+    ]
+    start = time.perf_counter()
+    for caches in alone:
+        for cache in caches:
+            cache.refresh_cache()
+    _report("warm up, no shared refresh", database, time.perf_counter() - start)
+    start = time.perf_counter()
+    for caches in alone:
+        for cache in caches:
+            cache.refresh_cache()
+    _report("refresh every replica, no shared refresh", database, time.perf_counter() - start)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,362 @@
+"""A local stand-in for the Kubernetes API server, for the Domsed mutations.
+
+Serves `mutations.apps.dominodatalab.com` objects, and the
+`coordination.k8s.io` Leases of the shared cache refresh, from memory with
+the parts of the API server behaviour the service relies on:
+
+- list, get, create, replace (PUT), merge patch and delete of mutations
+  (get, create and replace of leases)
+- a resourceVersion bumped on every write, checked on replace / patch
+  (409 Conflict when stale)
+- watches (`watch=true`) streaming the events after a resourceVersion, and a
+  `410 Gone` ERROR event once that resourceVersion has been compacted away
+- BOOKMARK events carrying the current resourceVersion, every
+  `bookmark_interval_seconds` a watch asking for them (`allowWatchBookmarks`)
+  is idle
+
+Set `watches_paused` to hold back the events of open watches (as if the
+connection had stalled) and call `compact()` to drop the event history.
+`writes` counts the requests which modified state and `requests` every
+request.
+
+Example:
+    with FakeKubernetes() as k8s:
+        api = CustomObjectsApi(k8s.api_client())
+        api.list_namespaced_custom_object(GROUP, VERSION, "domino-platform", PLURAL)
+"""
+import copy
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+from kubernetes import client
+
+GROUP = "apps.dominodatalab.com"
+VERSION = "v1alpha1"
+PLURAL = "mutations"
+PREFIX = f"/apis/{GROUP}/{VERSION}/namespaces/"
+LEASE_PREFIX = "/apis/coordination.k8s.io/v1/namespaces/"
+LEASES = "leases"
+
+
+def _status(code: int, reason: str, message: str) -> Dict:
+    return {
+        "kind": "Status",
+        "apiVersion": "v1",
+        "status": "Failure",
+        "reason": reason,
+        "message": message,
+        "code": code,
+    }
+
+
+def _merge_patch(target, patch):
+    if not isinstance(patch, dict):
+        return copy.deepcopy(patch)
+    result = dict(target) if isinstance(target, dict) else {}
+    for key, value in patch.items():
+        if value is None:
+            result.pop(key, None)
+        else:
+            result[key] = _merge_patch(result.get(key), value)
+    return result
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, do not wait for delayed ACKs
+    disable_nagle_algorithm = True
+    server: "_Server"
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, code: int, body: Dict):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _body(self) -> Dict:
+        length = int(self.headers.get("Content-Length", "0"))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _route(self) -> Optional[Tuple[str, Optional[str], Dict]]:
+        url = urlparse(self.path)
+        for prefix, plural in ((PREFIX, PLURAL), (LEASE_PREFIX, LEASES)):
+            if url.path.startswith(prefix):
+                break
+        else:
+            return None
+        parts = url.path[len(prefix) :].split("/")
+        if len(parts) < 2 or parts[1] != plural:
+            return None
+        name = parts[2] if len(parts) > 2 else None
+        # Leases are kept apart from the mutations of their namespace
+        namespace = parts[0] if plural == PLURAL else f"{LEASES}/{parts[0]}"
+        return namespace, name, parse_qs(url.query)
+
+    def _handle(self, method: str):
+        k8s = self.server.kubernetes
+        with k8s.lock:
+            k8s.requests += 1
+        if k8s.latency_seconds:
+            time.sleep(k8s.latency_seconds)
+        route = self._route()
+        if route is None:
+            self._send(404, _status(404, "NotFound", self.path))
+            return
+        namespace, name, query = route
+        if method == "GET" and name is None:
+            if query.get("watch", ["false"])[0].lower() == "true":
+                self._watch(namespace, query)
+                return
+            self._send(200, k8s.list(namespace))
+            return
+        body = self._body() if method in ("POST", "PUT", "PATCH") else None
+        code, result = k8s.handle(method, namespace, name, body)
+        self._send(code, result)
+
+    def _watch(self, namespace: str, query: Dict):
+        k8s = self.server.kubernetes
+        since = int(query.get("resourceVersion", ["0"])[0] or 0)
+        timeout = float(query.get("timeoutSeconds", ["30"])[0])
+        bookmarks = query.get("allowWatchBookmarks", ["false"])[0].lower() == "true"
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        deadline = time.monotonic() + timeout
+        try:
+            for event in k8s.events_after(namespace, since, deadline, bookmarks):
+                line = (json.dumps(event) + "\n").encode("utf-8")
+                self.wfile.write(f"{len(line):x}\r\n".encode() + line + b"\r\n")
+                self.wfile.flush()
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_PUT(self):
+        self._handle("PUT")
+
+    def do_PATCH(self):
+        self._handle("PATCH")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+    kubernetes: "FakeKubernetes"
+
+
+class FakeKubernetes:
+    def __init__(
+        self,
+        mutations: Optional[List[Dict]] = None,
+        namespace: str = "domino-platform",
+        latency_seconds: float = 0.0,
+        port: int = 0,
+        bookmark_interval_seconds: float = 0.5,
+    ):
+        self.latency_seconds = latency_seconds
+        self.bookmark_interval_seconds = bookmark_interval_seconds
+        self.lock = threading.Condition()
+        self.resource_version = 1
+        # namespace -> name -> object
+        self.objects: Dict[str, Dict[str, Dict]] = {}
+        # (resourceVersion, namespace, event)
+        self.history: List[Tuple[int, str, Dict]] = []
+        self.compacted_before = 0
+        self.watches_paused = False
+        self.requests = 0
+        self.writes = 0
+        for mutation in mutations or []:
+            self.handle("POST", namespace, None, mutation)
+        self.writes = 0
+        self._server = _Server(("127.0.0.1", port), _Handler)
+        self._server.kubernetes = self
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def uri(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_port}"
+
+    def api_client(self, pool_size: int = 5) -> client.ApiClient:
+        configuration = client.Configuration()
+        configuration.host = self.uri
+        configuration.connection_pool_maxsize = pool_size
+        return client.ApiClient(configuration)
+
+    def list(self, namespace: str) -> Dict:
+        with self.lock:
+            items = [
+                copy.deepcopy(obj)
+                for _, obj in sorted(self.objects.get(namespace, {}).items())
+            ]
+            return {
+                "apiVersion": f"{GROUP}/{VERSION}",
+                "kind": "MutationList",
+                "items": items,
+                "metadata": {"resourceVersion": str(self.resource_version)},
+            }
+
+    def compact(self):
+        """Forget the event history, resuming older watches gets 410 Gone."""
+        with self.lock:
+            self.history = []
+            self.compacted_before = self.resource_version
+
+    def events_after(
+        self, namespace: str, since: int, deadline: float, bookmarks: bool = False
+    ):
+        position = 0
+        delivered = since
+        bookmark_at = time.monotonic() + self.bookmark_interval_seconds
+        while True:
+            bookmark = None
+            with self.lock:
+                expired = delivered < self.compacted_before
+                if position > len(self.history):
+                    # Compacted while watching
+                    position = 0
+                pending: List[Dict] = []
+                if not expired and not self.watches_paused:
+                    for rv, ns, event in self.history[position:]:
+                        if rv > delivered and ns == namespace:
+                            pending.append(event)
+                            delivered = rv
+                    position = len(self.history)
+                if (
+                    bookmarks
+                    and not expired
+                    and not pending
+                    and not self.watches_paused
+                    and time.monotonic() >= bookmark_at
+                ):
+                    # Every event of the namespace up to now was delivered
+                    delivered = self.resource_version
+                    bookmark = {
+                        "type": "BOOKMARK",
+                        "object": {
+                            "apiVersion": f"{GROUP}/{VERSION}",
+                            "kind": "Mutation",
+                            "metadata": {"resourceVersion": str(delivered)},
+                        },
+                    }
+                    bookmark_at = time.monotonic() + self.bookmark_interval_seconds
+                elif not expired and not pending:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return
+                    self.lock.wait(
+                        min(remaining, 0.5, max(bookmark_at - time.monotonic(), 0.01))
+                    )
+                    continue
+            if bookmark is not None:
+                yield bookmark
+                continue
+            if expired:
+                # The events after `delivered` are gone
+                yield {
+                    "type": "ERROR",
+                    "object": _status(
+                        410, "Expired", f"too old resource version: {delivered}"
+                    ),
+                }
+                return
+            for event in pending:
+                yield event
+
+    def _record(self, namespace: str, event_type: str, obj: Dict):
+        self.history.append(
+            (
+                self.resource_version,
+                namespace,
+                {"type": event_type, "object": copy.deepcopy(obj)},
+            )
+        )
+        self.writes += 1
+        self.lock.notify_all()
+
+    def handle(
+        self, method: str, namespace: str, name: Optional[str], body: Optional[Dict]
+    ) -> Tuple[int, Dict]:
+        with self.lock:
+            objects = self.objects.setdefault(namespace, {})
+            current = objects.get(name) if name else None
+            if method == "GET":
+                if current is None:
+                    return 404, _status(404, "NotFound", f"{name} not found")
+                return 200, copy.deepcopy(current)
+            if method == "DELETE":
+                if current is None:
+                    return 404, _status(404, "NotFound", f"{name} not found")
+                del objects[name]
+                self.resource_version += 1
+                current["metadata"]["resourceVersion"] = str(self.resource_version)
+                self._record(namespace, "DELETED", current)
+                return 200, {"kind": "Status", "status": "Success"}
+            if method == "POST":
+                name = body["metadata"]["name"]
+                if name in objects:
+                    return 409, _status(409, "AlreadyExists", f"{name} exists")
+                obj = copy.deepcopy(body)
+                self.resource_version += 1
+                obj["metadata"].update(
+                    namespace=namespace.split("/")[-1],
+                    uid=str(uuid.uuid4()),
+                    generation=1,
+                    resourceVersion=str(self.resource_version),
+                    creationTimestamp=time.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                )
+                objects[name] = obj
+                self._record(namespace, "ADDED", obj)
+                return 201, copy.deepcopy(obj)
+            if current is None:
+                return 404, _status(404, "NotFound", f"{name} not found")
+            expected = (body.get("metadata") or {}).get("resourceVersion")
+            if expected is not None and expected != current["metadata"]["resourceVersion"]:
+                return 409, _status(409, "Conflict", f"{name} has been modified")
+            if method == "PUT":
+                obj = copy.deepcopy(body)
+                obj["metadata"] = dict(current["metadata"], **obj["metadata"])
+            else:
+                obj = _merge_patch(current, body)
+            self.resource_version += 1
+            metadata = obj["metadata"]
+            metadata["resourceVersion"] = str(self.resource_version)
+            metadata["uid"] = current["metadata"]["uid"]
+            metadata["generation"] = current["metadata"].get("generation", 1) + 1
+            objects[name] = obj
+            self._record(namespace, "MODIFIED", obj)
+            return 200, copy.deepcopy(obj)
+
+    def start(self) -> "FakeKubernetes":
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "FakeKubernetes":
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
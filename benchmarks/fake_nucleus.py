@@ -0,0 +1,197 @@
+"""A local stand-in for the nucleus frontend used by the benchmarks.
+
+Serves the endpoints the service calls, from in-memory data:
+
+- `GET /v4/auth/principal` - an admin principal, or a non admin one when the
+  API key / bearer token contains `user`
+- `GET /api/environments/beta/environments` - paged with `offset` / `limit`
+- `GET /api/projects/beta/projects` - paged with `offset` / `limit`
+- `GET /access-token` - a token for an admin, standing in for the Domino API
+  proxy of a workspace
+
+Every response can be delayed by a fixed latency to mimic a remote nucleus.
+With `max_limit` set, pages hold at most that many elements whatever the
+`limit` asked, as a nucleus capping its page size.
+With `etags=True` the listings carry an ETag and a request with a matching
+`If-None-Match` is answered with 304, as nucleus does when it supports
+conditional requests.
+`FakeNucleus.start` serves from a thread pool in the current process, while
+`FakeNucleus.asgi_app` is an asyncio app for load tests, to run with uvicorn in
+a process of its own, which holds thousands of delayed responses at once.
+
+Example:
+    with FakeNucleus(environments=envs, latency_seconds=0.02) as nucleus:
+        requests.get(f"{nucleus.uri}/api/environments/beta/environments")
+"""
+import asyncio
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+DEFAULT_LIMIT = 10
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, do not wait for delayed ACKs
+    disable_nagle_algorithm = True
+    server: "_Server"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        nucleus = self.server.nucleus
+        with nucleus.lock:
+            nucleus.requests += 1
+        if nucleus.latency_seconds:
+            time.sleep(nucleus.latency_seconds)
+        credentials = self.headers.get("X-Domino-Api-Key") or self.headers.get(
+            "Authorization", ""
+        )
+        status, payload = nucleus.respond(self.path, credentials)
+        status, payload, etag = nucleus.conditional(
+            status, payload, self.headers.get("If-None-Match")
+        )
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        if etag:
+            self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+    nucleus: "FakeNucleus"
+
+
+class FakeNucleus:
+    def __init__(
+        self,
+        environments: Optional[List[Dict]] = None,
+        projects: Optional[List[Dict]] = None,
+        latency_seconds: float = 0.0,
+        port: int = 0,
+        etags: bool = False,
+        max_limit: Optional[int] = None,
+    ):
+        self.environments = environments or []
+        self.projects = projects or []
+        self.latency_seconds = latency_seconds
+        self.etags = etags
+        self.max_limit = max_limit
+        self.requests = 0
+        self.not_modified = 0
+        self.lock = threading.Lock()
+        self._server = _Server(("127.0.0.1", port), _Handler)
+        self._server.nucleus = self
+        self._thread: Optional[threading.Thread] = None
+        # Encoded pages, a load test asks for the same few over and over
+        self._pages: Dict[Tuple[str, int, int], bytes] = {}
+
+    def _page(self, key: str, items: List[Dict], query: Dict) -> bytes:
+        offset = int(query.get("offset", ["0"])[0])
+        limit = int(query.get("limit", [str(DEFAULT_LIMIT)])[0])
+        if self.max_limit is not None:
+            limit = min(limit, self.max_limit)
+        page = self._pages.get((key, offset, limit))
+        if page is None:
+            page = json.dumps(
+                {
+                    key: items[offset : offset + limit],
+                    "metadata": {
+                        "offset": offset,
+                        "limit": limit,
+                        "totalCount": len(items),
+                    },
+                }
+            ).encode("utf-8")
+            self._pages[(key, offset, limit)] = page
+        return page
+
+    def respond(self, path: str, credentials: str) -> Tuple[int, bytes]:
+        url = urlparse(path)
+        query = parse_qs(url.query)
+        if url.path == "/v4/auth/principal":
+            is_admin = "user" not in credentials
+            principal = {
+                "canonicalName": "admin" if is_admin else "user",
+                "isAdmin": is_admin,
+            }
+            return 200, json.dumps(principal).encode("utf-8")
+        if url.path == "/access-token":
+            return 200, b"admin-token"
+        if url.path == "/api/environments/beta/environments":
+            return 200, self._page("environments", self.environments, query)
+        if url.path == "/api/projects/beta/projects":
+            return 200, self._page("projects", self.projects, query)
+        return 404, json.dumps({"message": f"Unknown path {url.path}"}).encode()
+
+    def conditional(
+        self, status: int, payload: bytes, if_none_match: Optional[str]
+    ) -> Tuple[int, bytes, Optional[str]]:
+        """(status, payload, ETag) of a response with `etags`, 304 when matched."""
+        if not self.etags or status != 200:
+            return status, payload, None
+        etag = f'"{hashlib.sha1(payload).hexdigest()}"'
+        if if_none_match == etag:
+            with self.lock:
+                self.not_modified += 1
+            return 304, b"", etag
+        return status, payload, etag
+
+    async def asgi_app(self, scope, receive, send):
+        if scope["type"] != "http":
+            return
+        self.requests += 1
+        if self.latency_seconds:
+            await asyncio.sleep(self.latency_seconds)
+        headers = dict(scope["headers"])
+        credentials = headers.get(b"x-domino-api-key") or headers.get(
+            b"authorization", b""
+        )
+        path = scope["path"]
+        if scope["query_string"]:
+            path += "?" + scope["query_string"].decode("latin-1")
+        status, payload = self.respond(path, credentials.decode("latin-1"))
+        if_none_match = headers.get(b"if-none-match")
+        status, payload, etag = self.conditional(
+            status, payload, if_none_match.decode("latin-1") if if_none_match else None
+        )
+        response_headers = [(b"content-type", b"application/json")]
+        if etag:
+            response_headers.append((b"etag", etag.encode("latin-1")))
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status,
+                "headers": response_headers,
+            }
+        )
+        await send({"type": "http.response.body", "body": payload})
+
+    @property
+    def uri(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_port}"
+
+    def start(self) -> "FakeNucleus":
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "FakeNucleus":
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
@@ -0,0 +1,111 @@
+"""Scaffolding shared by the benchmarks and checks.
+
+The database of a run (mongomock, or a Mongo server), stand-ins for the
+collections the caches read, the installation of fresh caches into the
+`api` module, and the waits and ports of the harnesses running servers in
+the background.
+
+Example:
+    database = StandInDatabase({"projects": StaticCollection(documents)})
+    install_caches(api, CountingDatabase(database))
+    wait_until(lambda: api.PROJECTS_CACHE.generation > 0)
+"""
+import collections
+import socket
+import time
+from typing import Callable, Dict, Iterable, Optional
+
+import httpx
+
+
+class StaticCollection:
+    """A collection of fixed documents, `find` ignores its filter and projection."""
+
+    def __init__(self, documents: Iterable[Dict]):
+        self.documents = documents
+
+    def find(self, *args, **kwargs):
+        return iter(self.documents)
+
+
+class StandInDatabase:
+    """A database of stand-in collections, the missing ones are empty."""
+
+    def __init__(self, collections: Dict):
+        self.collections = collections
+
+    def get_collection(self, name):
+        return self.collections.get(name) or StaticCollection([])
+
+
+class CountingDatabase:
+    """Counts the collection scans, a cache reload gets its collection once."""
+
+    def __init__(self, database):
+        self.database = database
+        self.scans = collections.Counter()
+
+    def get_collection(self, name):
+        self.scans[name] += 1
+        return self.database.get_collection(name)
+
+    def command(self, *args, **kwargs):
+        return self.database.command(*args, **kwargs)
+
+
+def benchmark_database(mongo_uri: Optional[str], name: str):
+    """Database `name` of the Mongo server at `mongo_uri`, mongomock without one."""
+    if mongo_uri:
+        from pymongo import MongoClient  # type: ignore
+
+        return MongoClient(mongo_uri)[name]
+    import mongomock  # type: ignore
+
+    return mongomock.MongoClient()[name]
+
+
+def install_caches(api, database, reload_on_miss: bool = True):
+    """Replace the caches of `api` with new ones loaded from `database`."""
+    from caches import EnvironmentRevisionCache, ProjectsCache
+
+    api.ENVIRONMENT_REVISION_CACHE = EnvironmentRevisionCache(database)
+    api.PROJECTS_CACHE = ProjectsCache(database)
+    for cache in (api.ENVIRONMENT_REVISION_CACHE, api.PROJECTS_CACHE):
+        cache.refresh_cache()
+        cache.reload_on_miss = reload_on_miss
+
+
+def response_body(resp) -> bytes:
+    # Flask test responses have `data`, requests and httpx ones `content`
+    return resp.data if hasattr(resp, "data") else resp.content
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_until(
+    condition: Callable[[], bool], timeout: float = 10.0, what: str = "condition"
+) -> float:
+    """Seconds until `condition()` held, raises TimeoutError after `timeout`."""
+    start = time.perf_counter()
+    while not condition():
+        if time.perf_counter() - start > timeout:
+            raise TimeoutError(f"{what} not met within {timeout} s")
+        time.sleep(0.01)
+    return time.perf_counter() - start
+
+
+def wait_until_up(url: str, timeout: float = 30.0, process=None):
+    """Wait for `url` to answer 200, or for `process` (a Popen) to exit."""
+    deadline = time.time() + timeout
+    while time.time() < deadline and (process is None or process.poll() is None):
+        try:
+            if httpx.get(url, timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up")
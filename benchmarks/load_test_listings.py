@@ -0,0 +1,241 @@
+"""Load test the enhanced projects listing, sync server against async server.
+
+Starts a fake nucleus (`fake_nucleus.py`) in its own process, then in turn the
+Flask app on a one worker gunicorn gthread server and the asyncio app on
+uvicorn, both with their caches loaded from in-memory stand-ins. Each server
+is driven by `concurrency` clients for a fixed time, and the requests per
+second and latency percentiles are reported.
+
+Usage:
+    python benchmarks/load_test_listings.py [--latency-ms 50] [--duration 10]
+        [--concurrency 16 64 256] [--threads 16] [--reload-on-miss]
+
+By default the caches behave as with change streams enabled (no reload on a
+miss), so the async server enriches on the event loop.
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+from typing import List
+
+import httpx
+from bson import ObjectId
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, "..", "domino-extensions-api"))
+
+from harness import (  # noqa: E402
+    StandInDatabase,
+    StaticCollection,
+    free_port,
+    install_caches,
+    wait_until_up,
+)
+
+PROJECTS = 5000
+PAGE_SIZE = 50
+LISTING = "/api-extended/projects/beta/projects"
+
+
+def _project_id(i: int) -> str:
+    return f"{i:024x}"
+
+
+def _stand_in_database() -> StandInDatabase:
+    return StandInDatabase(
+        {
+            "projects": StaticCollection(
+                [
+                    {
+                        "_id": ObjectId(_project_id(i)),
+                        "overrideV2EnvironmentId": ObjectId(_project_id(i % 100)),
+                        "defaultEnvironmentRevisionSpec": "ActiveRevision",
+                    }
+                    for i in range(PROJECTS)
+                ]
+            )
+        }
+    )
+
+
+def run_nucleus(port: int, latency_ms: float):
+    from fake_nucleus import FakeNucleus
+
+    projects = [
+        {"id": _project_id(i), "name": f"project-{i}"} for i in range(PROJECTS)
+    ]
+    nucleus = FakeNucleus(projects=projects, latency_seconds=latency_ms / 1000)
+    import uvicorn
+
+    uvicorn.run(
+        nucleus.asgi_app,
+        host="127.0.0.1",
+        port=port,
+        log_level="warning",
+        backlog=4096,
+        interface="asgi3",
+    )
+
+
+def run_server(mode: str, port: int, threads: int, reload_on_miss: bool):
+    import api
+
+    install_caches(api, _stand_in_database(), reload_on_miss)
+    if mode == "async":
+        import uvicorn
+
+        import async_api
+
+        uvicorn.run(
+            async_api.app, host="127.0.0.1", port=port, log_level="warning"
+        )
+        return
+
+    from gunicorn.app.base import BaseApplication
+
+    class _Server(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", f"127.0.0.1:{port}")
+            self.cfg.set("worker_class", "gthread")
+            self.cfg.set("workers", 1)
+            self.cfg.set("threads", threads)
+            self.cfg.set("loglevel", "warning")
+
+        def load(self):
+            return api.app
+
+    _Server().run()
+
+
+async def _drive(url: str, concurrency: int, duration: float):
+    latencies: List[float] = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=60) as client:
+
+        async def worker(n: int):
+            nonlocal errors
+            i = n
+            while time.perf_counter() < deadline:
+                offset = (i * PAGE_SIZE) % PROJECTS
+                i += concurrency
+                start = time.perf_counter()
+                try:
+                    resp = await client.get(
+                        url, params={"offset": offset, "limit": PAGE_SIZE}
+                    )
+                    ok = resp.status_code == 200 and len(resp.json()["projects"]) == (
+                        PAGE_SIZE
+                    )
+                except httpx.HTTPError:
+                    ok = False
+                if ok:
+                    latencies.append(time.perf_counter() - start)
+                else:
+                    errors += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(n) for n in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    latencies.sort()
+
+    def percentile(p: float) -> float:
+        if not latencies:
+            return float("nan")
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+    return len(latencies) / elapsed, percentile(0.5), percentile(0.99), errors
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--latency-ms", type=float, default=50.0)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[16, 64, 256])
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--reload-on-miss", action="store_true")
+    parser.add_argument("--role", choices=["nucleus", "sync", "async"])
+    parser.add_argument("--port", type=int)
+    args = parser.parse_args()
+
+    if args.role == "nucleus":
+        run_nucleus(args.port, args.latency_ms)
+        return
+    if args.role in ("sync", "async"):
+        run_server(args.role, args.port, args.threads, args.reload_on_miss)
+        return
+
+    nucleus_port = free_port()
+    processes = [
+        subprocess.Popen(
+            [
+                sys.executable,
+                __file__,
+                "--role",
+                "nucleus",
+                "--port",
+                str(nucleus_port),
+                "--latency-ms",
+                str(args.latency_ms),
+            ]
+        )
+    ]
+    env = dict(
+        os.environ,
+        DOMINO_NUCLEUS_URI=f"http://127.0.0.1:{nucleus_port}",
+        NUCLEUS_POOL_SIZE=str(max(args.threads, 20)),
+        NUCLEUS_ASYNC_POOL_SIZE=str(max(args.concurrency)),
+        LOG_LEVEL="ERROR",
+    )
+    try:
+        print(
+            f"nucleus latency={args.latency_ms}ms page={PAGE_SIZE} "
+            f"sync threads={args.threads} duration={args.duration}s"
+        )
+        print(f"{'mode':>6} {'conc':>5} {'req/s':>8} {'p50':>9} {'p99':>9} {'errors':>7}")
+        for mode in ("sync", "async"):
+            port = free_port()
+            command = [
+                sys.executable,
+                __file__,
+                "--role",
+                mode,
+                "--port",
+                str(port),
+                "--threads",
+                str(args.threads),
+            ]
+            if args.reload_on_miss:
+                command.append("--reload-on-miss")
+            server = subprocess.Popen(command, env=env)
+            try:
+                wait_until_up(f"http://127.0.0.1:{port}/healthz")
+                for concurrency in args.concurrency:
+                    rps, p50, p99, errors = asyncio.run(
+                        _drive(
+                            f"http://127.0.0.1:{port}{LISTING}",
+                            concurrency,
+                            args.duration,
+                        )
+                    )
+                    print(
+                        f"{mode:>6} {concurrency:>5} {rps:>8.1f} {p50:>7.1f}ms "
+                        f"{p99:>7.1f}ms {errors:>7}",
+                        flush=True,
+                    )
+            finally:
+                server.terminate()
+                server.wait()
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == "__main__":
+    main()
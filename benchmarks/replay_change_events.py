@@ -0,0 +1,195 @@
+"""Replay a recorded change stream log against in-memory collections.
+
+The log (MongoDB extended JSON) holds the initial documents of the
+`environment_revisions` and `projects` collections and the change events
+recorded on them. Every event is fed through a CacheChangeStreamWatcher into
+the caches, then the caches are compared with a full reload of the final
+collection state. With `--lose-token` the stream refuses the resume token
+half way through, which must trigger exactly one extra full reload. With
+`--snapshot` the watcher is stopped half way through and the cache written
+to a snapshot, then a new cache restored from it and followed by a watcher
+resuming from the snapshot, which must not reload the collection.
+
+Usage:
+    python benchmarks/replay_change_events.py [log_file] [--lose-token] [--snapshot]
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from bson import json_util
+from pymongo.errors import OperationFailure
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "domino-extensions-api")
+)
+
+from caches import EnvironmentRevisionCache, ProjectsCache  # noqa: E402
+from change_streams import (  # noqa: E402
+    CHANGE_STREAM_HISTORY_LOST,
+    CacheChangeStreamWatcher,
+)
+from harness import StandInDatabase  # noqa: E402
+from snapshots import CacheSnapshots  # noqa: E402
+
+DEFAULT_LOG_FILE = os.path.join(os.path.dirname(__file__), "data", "change_events.json")
+
+
+class InMemoryChangeStream:
+    def __init__(self, collection, position: int):
+        self.collection = collection
+        self.position = position
+        self.alive = True
+
+    @property
+    def resume_token(self):
+        return {"_data": self.position}
+
+    def try_next(self):
+        if self.position >= len(self.collection.events):
+            time.sleep(0.001)
+            return None
+        if self.position == self.collection.lose_token_at:
+            self.collection.lose_token_at = None
+            raise OperationFailure("history lost", code=CHANGE_STREAM_HISTORY_LOST)
+        change = self.collection.events[self.position]
+        self.collection.apply(change)
+        self.position += 1
+        return change
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.alive = False
+
+
+class InMemoryCollection:
+    """Stand-in for a pymongo collection which replays recorded events."""
+
+    def __init__(self, name, documents, events, lose_token_at=None):
+        self.name = name
+        self.documents = {d["_id"]: d for d in documents}
+        self.events = events
+        self.lose_token_at = lose_token_at
+        self.applied = 0
+
+    def find(self, *args, **kwargs):
+        return iter(list(self.documents.values()))
+
+    def watch(self, resume_after=None, **kwargs):
+        if resume_after is None:
+            # A fresh stream starts after everything already applied
+            position = self.applied
+        else:
+            position = resume_after["_data"]
+        return InMemoryChangeStream(self, position)
+
+    def apply(self, change):
+        operation = change["operationType"]
+        if operation in ("insert", "update", "replace"):
+            if change.get("fullDocument") is not None:
+                self.documents[change["documentKey"]["_id"]] = change["fullDocument"]
+        elif operation == "delete":
+            self.documents.pop(change["documentKey"]["_id"], None)
+        self.applied += 1
+
+
+def _snapshot(cache):
+    return {
+        k: {slot: getattr(v, slot) for slot in v.__slots__}
+        for k, v in cache.cache.items()
+    }
+
+
+def _follow(watcher, collection, until: int):
+    thread = threading.Thread(target=watcher.run, daemon=True)
+    thread.start()
+    while collection.applied < until:
+        time.sleep(0.001)
+    watcher._stop_event.set()
+    thread.join()
+
+
+def _restart_from_snapshot(cache, collection):
+    """Snapshot the cache, and restore a new cache from it like a new worker."""
+    with tempfile.TemporaryDirectory() as directory:
+        CacheSnapshots([cache], directory).write(cache)
+        restored = type(cache)(cache.database)
+        assert CacheSnapshots([restored], directory).load(restored)
+    return restored, CacheChangeStreamWatcher(
+        restored,
+        collection,
+        retry_backoff_seconds=0,
+        resume_token=restored.resume_token,
+        start_at_operation_time=restored.cluster_time,
+    )
+
+
+def replay(cache_class, name, recorded, lose_token, snapshot=False):
+    events = recorded[name]["events"]
+    collection = InMemoryCollection(
+        name,
+        recorded[name]["initial"],
+        events,
+        lose_token_at=len(events) // 2 if lose_token else None,
+    )
+    cache = cache_class(StandInDatabase({name: collection}))
+    watcher = CacheChangeStreamWatcher(cache, collection, retry_backoff_seconds=0)
+
+    start = time.perf_counter()
+    full_reloads = 0
+    if snapshot:
+        _follow(watcher, collection, len(events) // 2)
+        full_reloads += watcher.full_reloads
+        cache, watcher = _restart_from_snapshot(cache, collection)
+    _follow(watcher, collection, len(events))
+    full_reloads += watcher.full_reloads
+    elapsed = time.perf_counter() - start
+
+    expected = cache_class(StandInDatabase({name: collection}))
+    expected.refresh_cache()
+    # The digest behind the ETags follows the events to the one of a reload
+    consistent = (
+        _snapshot(cache) == _snapshot(expected)
+        and cache.snapshot.digest == expected.snapshot.digest
+    )
+    if isinstance(cache, EnvironmentRevisionCache):
+        consistent = (
+            consistent
+            and {k: set(v) for k, v in cache.snapshot.by_environment.items()}
+            == {k: set(v) for k, v in expected.snapshot.by_environment.items()}
+            and {k: v._id for k, v in cache.snapshot.latest_by_environment.items()}
+            == {k: v._id for k, v in expected.snapshot.latest_by_environment.items()}
+            and cache.snapshot.root_images == expected.snapshot.root_images
+        )
+    print(
+        f"{name:>22} events={len(events):<5} full_reloads={full_reloads:<3} "
+        f"elapsed_ms={elapsed * 1000:<8.2f} consistent={consistent}"
+    )
+    return consistent
+
+
+def main():
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    lose_token = "--lose-token" in sys.argv
+    snapshot = "--snapshot" in sys.argv
+    with open(args[0] if args else DEFAULT_LOG_FILE) as f:
+        recorded = json_util.loads(f.read())
+    results = [
+        replay(
+            EnvironmentRevisionCache,
+            "environment_revisions",
+            recorded,
+            lose_token,
+            snapshot,
+        ),
+        replay(ProjectsCache, "projects", recorded, lose_token, snapshot),
+    ]
+    sys.exit(0 if all(results) else 1)
+
+
+if __name__ == "__main__":
+    main()
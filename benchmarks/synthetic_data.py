@@ -0,0 +1,198 @@
+"""Synthetic Domino data for the benchmarks.
+
+Generates, for a number of users, projects and environments, the Mongo
+documents the service reads (`users`, `userPreferences`, `projects`,
+`environment_revisions`, the auto-shutdown keys of `config`), the matching
+nucleus listings and Domsed mutations. Every environment has `revision_depth`
+revisions. Environments come in chains of `base_depth + 1`: the first one has
+a docker image, each of the others is based on the latest revision of the
+previous one, so resolving a root image walks up to `base_depth` revisions.
+
+The ids are derived from the positions, so every process generating the same
+sizes gets the same data.
+
+Example:
+    dataset = generate(users=1000, projects=5000, environments=200)
+    dataset.load(mongomock.MongoClient()["domino"])
+    FakeNucleus(environments=dataset.nucleus_environments, projects=dataset.nucleus_projects)
+"""
+import argparse
+from typing import Dict, List
+
+from bson import ObjectId
+
+DOCKER_REPOSITORY = "quay.io/domino/compute-environment"
+GROUP = "apps.dominodatalab.com"
+VERSION = "v1alpha1"
+
+AUTO_SHUTDOWN_CONFIG = {
+    "com.cerebro.domino.workspaceAutoShutdown.isEnabled": "true",
+    "com.cerebro.domino.workspaceAutoShutdown.globalMaximumLifetimeInSeconds": 86400,
+    "com.cerebro.domino.workspaceAutoShutdown.globalDefaultLifetimeInSeconds": 7200,
+    "com.cerebro.domino.workloadNotifications.isEnabled": "true",
+    "com.cerebro.domino.workloadNotifications.longRunningWorkloadDefinitionInSeconds": 3600,
+}
+
+# Leading byte of the generated ids, one per kind of document
+_USER = 1
+_PROJECT = 2
+_ENVIRONMENT = 3
+_REVISION = 4
+_PREFERENCE = 5
+
+
+def _object_id(kind: int, i: int) -> ObjectId:
+    return ObjectId(f"{kind:02x}{i:022x}")
+
+
+class Dataset:
+    def __init__(self):
+        self.users: List[Dict] = []
+        self.user_preferences: List[Dict] = []
+        self.projects: List[Dict] = []
+        self.environment_revisions: List[Dict] = []
+        self.config: List[Dict] = []
+        self.nucleus_environments: List[Dict] = []
+        self.nucleus_projects: List[Dict] = []
+        self.mutations: List[Dict] = []
+
+    def collections(self) -> Dict[str, List[Dict]]:
+        return {
+            "users": self.users,
+            "userPreferences": self.user_preferences,
+            "projects": self.projects,
+            "environment_revisions": self.environment_revisions,
+            "config": self.config,
+        }
+
+    def load(self, database):
+        """Replace the collections of `database` (pymongo or mongomock)."""
+        for name, documents in self.collections().items():
+            collection = database[name]
+            collection.delete_many({})
+            if documents:
+                collection.insert_many([dict(document) for document in documents])
+
+    def summary(self) -> Dict[str, int]:
+        sizes = {name: len(documents) for name, documents in self.collections().items()}
+        sizes["mutations"] = len(self.mutations)
+        return sizes
+
+
+def mutation(name: str, i: int = 0) -> Dict:
+    return {
+        "apiVersion": f"{GROUP}/{VERSION}",
+        "kind": "Mutation",
+        "metadata": {"name": name},
+        "rules": [
+            {
+                "labelSelectors": [f"dominodatalab.com/project-name=project-{i}"],
+                "modifyEnv": {"env": [{"name": "TEAM", "value": f"team-{i % 10}"}]},
+            }
+        ],
+    }
+
+
+def generate(
+    users: int = 1000,
+    projects: int = 5000,
+    environments: int = 200,
+    revision_depth: int = 10,
+    base_depth: int = 3,
+    mutations: int = 100,
+) -> Dataset:
+    dataset = Dataset()
+    for i in range(users):
+        user_id = _object_id(_USER, i)
+        dataset.users.append({"_id": user_id, "loginId": {"id": f"user-{i}"}})
+        if i % 2 == 0:
+            dataset.user_preferences.append(
+                {
+                    "_id": _object_id(_PREFERENCE, i),
+                    "userId": user_id,
+                    "notifyAboutCollaboratorAdditions": True,
+                }
+            )
+
+    revision_count = 0
+    for i in range(environments):
+        environment_id = _object_id(_ENVIRONMENT, i)
+        root = i % (base_depth + 1) == 0
+        # The previous environment of the chain was generated just before
+        base_revision_id = None if root else _object_id(_REVISION, revision_count - 1)
+        for number in range(1, revision_depth + 1):
+            definition: Dict = {}
+            if root:
+                definition["dockerImage"] = f"{DOCKER_REPOSITORY}:{i}-{number}"
+            else:
+                definition["baseEnvironmentRevisionId"] = base_revision_id
+            dataset.environment_revisions.append(
+                {
+                    "_id": _object_id(_REVISION, revision_count),
+                    "environmentId": environment_id,
+                    "metadata": {"number": number},
+                    "definition": definition,
+                }
+            )
+            revision_count += 1
+        dataset.nucleus_environments.append(
+            {
+                "id": str(environment_id),
+                "name": f"environment-{i}",
+                "latestRevision": {"number": revision_depth},
+                "selectedRevision": {"number": max(1, revision_depth - 1)},
+            }
+        )
+
+    for i in range(projects):
+        project_id = _object_id(_PROJECT, i)
+        dataset.projects.append(
+            {
+                "_id": project_id,
+                "name": f"project-{i}",
+                "overrideV2EnvironmentId": _object_id(
+                    _ENVIRONMENT, i % max(environments, 1)
+                ),
+                "defaultEnvironmentRevisionSpec": "ActiveRevision",
+            }
+        )
+        dataset.nucleus_projects.append({"id": str(project_id), "name": f"project-{i}"})
+
+    dataset.config = [
+        {"namespace": "common", "key": key, "value": value}
+        for key, value in AUTO_SHUTDOWN_CONFIG.items()
+    ]
+    dataset.mutations = [mutation(f"mutation-{i:05d}", i) for i in range(mutations)]
+    return dataset
+
+
+def add_size_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--projects", type=int, default=5000)
+    parser.add_argument("--environments", type=int, default=200)
+    parser.add_argument("--revision-depth", type=int, default=10)
+    parser.add_argument("--base-depth", type=int, default=3)
+    parser.add_argument("--mutations", type=int, default=100)
+
+
+def generate_from_arguments(args: argparse.Namespace) -> Dataset:
+    return generate(
+        users=args.users,
+        projects=args.projects,
+        environments=args.environments,
+        revision_depth=args.revision_depth,
+        base_depth=args.base_depth,
+        mutations=args.mutations,
+    )
+
+
+def size_arguments(args: argparse.Namespace) -> List[str]:
+    """The command line arguments generating the same dataset again."""
+    return [
+        f"--users={args.users}",
+        f"--projects={args.projects}",
+        f"--environments={args.environments}",
+        f"--revision-depth={args.revision_depth}",
+        f"--base-depth={args.base_depth}",
+        f"--mutations={args.mutations}",
+    ]
@@ -59,18 +59,56 @@ def delete(mutation_name):
         logger.warning('Status Code :' + str(resp.status_code))
         logger.warning('Error :' + str(resp.text))
 
-def apply_file(mutation_file):
+def load_file(mutation_file) -> List:
+    # A YAML file can hold several mutations, separated by ---
     if(mutation_file.endswith(".yaml") or mutation_file.endswith(".yml") ):
         with open(mutation_file) as f:
-            configuration = yaml.safe_load(f)
-            mutation = json.loads(json.dumps(configuration))
+            return [m for m in yaml.safe_load_all(f) if m]
     elif (mutation_file.endswith(".json")):
         with open(mutation_file) as f:
-            mutation = json.loads(f.readlines())
+            mutations = json.load(f)
+            return mutations if isinstance(mutations, List) else [mutations]
     else:
         logger.warning('Invalid file format. Must be YAML or JSON')
         exit(1)
-    apply(mutation)
+
+def apply_file(mutation_file):
+    mutations = load_file(mutation_file)
+    if(len(mutations)==1):
+        apply(mutations[0])
+    else:
+        apply_many(mutations)
+
+def apply_dir(mutation_dir):
+    mutations = []
+    for file_name in sorted(os.listdir(mutation_dir)):
+        if(file_name.endswith((".yaml", ".yml", ".json"))):
+            mutations.extend(load_file(os.path.join(mutation_dir, file_name)))
+    print(f'Applying {len(mutations)} mutations from {mutation_dir}')
+    return apply_many(mutations)
+
+def apply_many(mutations, batch_size=100):
+    # One token and one connection for every batch
+    session = requests.Session()
+    auth_key = session.get(os.environ.get('DOMINO_API_PROXY') + '/access-token').text
+    session.headers["Authorization"] = f"Bearer {auth_key}"
+    publish_url = f'{api_endpoint}/mutation/apply/batch'
+    results = []
+    for start in range(0, len(mutations), batch_size):
+        resp = session.post(publish_url, json=mutations[start:start + batch_size])
+        if(resp.status_code==200):
+            for item in resp.json()['items']:
+                if(item['status']==200):
+                    print(f"Mutation {item['name']} {item['result']}")
+                else:
+                    logger.warning(f"Mutation {item['name']} failed: {item['status']} {item['error']}")
+                results.append(item)
+        else:
+            logger.warning('Error Publishing Mutations')
+            logger.warning('Status Code :' + str(resp.status_code))
+            logger.warning('Error :' + str(resp.text))
+    session.close()
+    return results
 
 
 def apply(mutation):
@@ -79,8 +117,8 @@ def apply(mutation):
     logger.warning('Publishing Mutation To Domsed')
     resp = requests.post(publish_url, json=mutation, headers={"Authorization": f"Bearer {auth_key}"})
     if(resp.status_code==200):
-        print('Applied Mutation')
-        print(resp.text)
+        out = resp.json()
+        print(f"Mutation {out['mutation']['metadata']['name']} {out['result']}")
     else:
         logger.warning('Error Publishing Mutation')
         logger.warning('Status Code :' + str(resp.status_code))
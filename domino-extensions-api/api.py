@@ -1,21 +1,79 @@
-from typing import Dict, Optional
+from typing import Callable, Dict, List, Optional
 
 from bson import ObjectId
-from flask import Flask, request, Response  # type: ignore
+from flask import (  # type: ignore
+    Flask,
+    jsonify,
+    request,
+    Response,
+    send_file,
+    stream_with_context,
+)
 import logging
-from pymongo import MongoClient  # type: ignore
+from pymongo import DeleteOne, UpdateOne  # type: ignore
 import os
+import socket
 import sys
-import requests
-
+import threading
+import time
+
+from bulk_writer import BulkWriter, DEFAULT_BULK_WRITE_BATCH_SIZE
+from caches import EnvironmentRevisionCache, ProjectsCache
+from central_config import CentralConfigCache
+from conditional import (
+    ETAG_HEADER,
+    IF_NONE_MATCH_HEADER,
+    NOT_MODIFIED,
+    cache_validator,
+    listing_etag,
+    not_modified,
+    upstream_condition,
+    with_condition,
+)
+from change_streams import start_cache_watchers
+import domsed_api as domsed
 from domsed_api import domsed_api
+import metrics
 import utils
-from mongo import create_database_connection
+from mongo import LazyDatabase, create_database_connection
+from nucleus import NUCLEUS_CLIENT
+from shared_refresh import (
+    DEFAULT_LEASE_DURATION_SECONDS,
+    DEFAULT_MISS_TIMEOUT_SECONDS,
+    DEFAULT_REFRESH_TIMEOUT_SECONDS,
+    DEFAULT_RETRY_PERIOD_SECONDS,
+    LeaseElector,
+    SNAPSHOT_TOKEN_HEADER,
+    SharedCacheRefresh,
+)
+from snapshots import DEFAULT_SNAPSHOT_INTERVAL_SECONDS, CacheSnapshots
+from pagination import (
+    ALL_PARAM,
+    UpstreamPageError,
+    all_pages_requested,
+    iter_all_items,
+)
+from response_cache import (
+    DEFAULT_MAX_BYTES,
+    DEFAULT_MAX_ENTRIES,
+    DEFAULT_STALE_SECONDS,
+    DEFAULT_TTL_SECONDS,
+    CachedListing,
+    ResponseCache,
+    listing_key,
+)
+from streaming import (
+    STREAM_MIMETYPES,
+    iter_upstream_items,
+    stream_listing,
+    stream_mode,
+    upstream_params,
+)
+from warmup import WarmUp
 
 
 DEFAULT_PLATFORM_NAMESPACE = "domino-platform"
-WHO_AM_I_ENDPOINT = "v4/auth/principal"
-DOMINO_NUCLEUS_URI = "http://nucleus-frontend.domino-platform:80"
+DEFAULT_FIELD_NAMESPACE = "domino-field"
 ADMINS_RELATIVE_FILE_PATH = "admins/extended-api-acls"
 ADMINS_FILE_PATH = ""
 
@@ -24,71 +82,47 @@ MAX_WKS_LIFETIME = "maximumWorkspaceLifetimeInSeconds"
 ENABLE_SESSION_NOTIFICATIONS = "enableSessionNotifications"
 SESSION_NOTIFICATION_PERIOD = "sessionNotificationPeriod"
 USER_ID = "userId"
+CACHE_GENERATION_HEADER = "X-Cache-Generation"
+AUTOSHUTDOWN_BULK_WRITE_BATCH_SIZE = int(
+    os.environ.get("AUTOSHUTDOWN_BULK_WRITE_BATCH_SIZE", DEFAULT_BULK_WRITE_BATCH_SIZE)
+)
 
 logger = logging.getLogger("extended-api")
 app = Flask(__name__)
 app.register_blueprint(domsed_api)
-
-
-def get_central_config_parameters(client: MongoClient):
-    config_collection = client["config"]
-
-    wks_auto_shutdown_enabled = False
-    val = config_collection.find_one(
-        {
-            "namespace": "common",
-            "key": "com.cerebro.domino.workspaceAutoShutdown.isEnabled",
-        }
-    )
-    if val:
-        wks_auto_shutdown_enabled = bool(val["value"])
-
-    global_max_lifetime = 0
-    val = config_collection.find_one(
-        {
-            "namespace": "common",
-            "key": "com.cerebro.domino.workspaceAutoShutdown.globalMaximumLifetimeInSeconds",
-        }
-    )
-    if val:
-        global_max_lifetime = int(val["value"])
-
-    global_default_lifetime = 0
-    val = config_collection.find_one(
-        {
-            "namespace": "common",
-            "key": "com.cerebro.domino.workspaceAutoShutdown.globalDefaultLifetimeInSeconds",
-        }
-    )
-    if val:
-        global_default_lifetime = int(val["value"])
-
-    wks_notification_enabled = False
-    val = config_collection.find_one(
-        {
-            "namespace": "common",
-            "key": "com.cerebro.domino.workloadNotifications.isEnabled",
-        }
-    )
-    if val:
-        wks_notification_enabled = bool(val["value"])
-
-    wks_notification_duration = 0
-    val = config_collection.find_one(
-        {
-            "namespace": "common",
-            "key": "com.cerebro.domino.workloadNotifications.longRunningWorkloadDefinitionInSeconds",
-        }
-    )
-    if val:
-        wks_notification_duration = int(val["value"])
-    return (
-        wks_auto_shutdown_enabled,
-        global_max_lifetime,
-        global_default_lifetime,
-        wks_notification_enabled,
-        wks_notification_duration,
+metrics.instrument_flask(app)
+
+
+def _autoshutdown_users_pipeline(domino_users: Dict, override_to_default: bool):
+    """Users to update, with whether they already have a preferences document.
+
+    Unless every user is reset to the default, only the listed users are
+    read, so the cost of a small override does not grow with the user count.
+    """
+    pipeline = []
+    if not override_to_default:
+        pipeline.append({"$match": {"loginId.id": {"$in": list(domino_users)}}})
+    pipeline.extend(
+        [
+            {"$project": {"_id": 1, "loginId.id": 1}},
+            {
+                "$lookup": {
+                    "from": "userPreferences",
+                    "localField": "_id",
+                    "foreignField": "userId",
+                    "as": "joinedResult",
+                }
+            },
+            {
+                "$project": {
+                    "_id": 1,
+                    "loginId.id": 1,
+                    "hasPreferences": {"$gt": [{"$size": "$joinedResult"}, 0]},
+                }
+            },
+        ]
     )
+    return pipeline
 
 
 """
@@ -119,7 +153,7 @@ def apply_autoshutdown_rules() -> object:
             global_default_lifetime,
             wks_notification_enabled,
             wks_notification_duration,
-        ) = get_central_config_parameters(MONGO_DATABASE)
+        ) = CENTRAL_CONFIG.get()
         logger.warning("Collected auto-shutdown values from central config")
         logger.warning(f"wks_auto_shutdown_enabled= {wks_auto_shutdown_enabled}")
         logger.warning(f"global_max_lifetime= {global_max_lifetime}")
@@ -147,19 +181,17 @@ def apply_autoshutdown_rules() -> object:
             payload = request.json
             domino_users = payload["users"]
 
+            batch_size = int(
+                payload.get("batch_size", AUTOSHUTDOWN_BULK_WRITE_BATCH_SIZE)
+            )
             result = MONGO_DATABASE["users"].aggregate(
-                [
-                    {
-                        "$lookup": {
-                            "from": "userPreferences",
-                            "localField": "_id",
-                            "foreignField": "userId",
-                            "as": "joinedResult",
-                        }
-                    }
-                ]
+                _autoshutdown_users_pipeline(
+                    domino_users, payload["override_to_default"]
+                ),
+                batchSize=batch_size,
             )
 
+            writer = BulkWriter(user_pref_coll, batch_size)
             for r in result:
                 wks_lifetime=0
                 user_id = r["loginId"]["id"]
@@ -171,13 +203,13 @@ def apply_autoshutdown_rules() -> object:
                     )
                 elif payload["override_to_default"]:
                     wks_lifetime = global_default_lifetime
-                    logger.warning(
+                    logger.info(
                         f"Override user {user_id} to default autoshutdown in {wks_lifetime} seconds"
                     )
                 else:
-                    logger.warning(f"Do not override user {user_id}")
+                    logger.info(f"Do not override user {user_id}")
 
-                if len(r["joinedResult"]) == 0:
+                if not r["hasPreferences"]:
                     user_preference["notifyAboutCollaboratorAdditions"] = True
 
                 user_preference["userId"] = r["_id"]
@@ -185,10 +217,10 @@ def apply_autoshutdown_rules() -> object:
                 if wks_lifetime > 0:
                     user_preference[MAX_WKS_LIFETIME] = wks_lifetime
                     query = {"userId": r["_id"]}
-                    user_pref_coll.update_one(query, {"$set": user_preference}, upsert=True)
-                    logger.warning(f"Upserted entry for user {id}")
-                    print('Updated User Preference')
-                    print(user_preference["userId"])
+                    # Copied, the dict is still modified below before the flush
+                    writer.add(
+                        UpdateOne(query, {"$set": dict(user_preference)}, upsert=True)
+                    )
                 #else:
                 #    user_preference.pop(MAX_WKS_LIFETIME, -1)
 
@@ -200,15 +232,14 @@ def apply_autoshutdown_rules() -> object:
                         SESSION_NOTIFICATION_PERIOD
                     ] = wks_notification_duration
 
-                id = r["_id"]
                 if wks_lifetime < 0:
-                    logger.warning(f"About to delete entry for user {id}")
-                    result = user_pref_coll.delete_one({"userId": r["_id"]})
-                    logger.warning(
-                        f"Deleted entry for user {id} - {result.deleted_count}"
-                    )
+                    logger.warning(f"Deleting entry for user {user_id}")
+                    writer.add(DeleteOne({"userId": r["_id"]}))
+            writer.flush()
+            counts = writer.counts()
+            logger.warning(f"Workspace shutdown durations updated {counts}")
 
-            return {"msg": "Workspace Shutdown Durations Updated"}
+            return {"msg": "Workspace Shutdown Durations Updated", **counts}
     except Exception as e:
         logger.exception(e)
         return Response(
@@ -217,78 +248,286 @@ def apply_autoshutdown_rules() -> object:
         )
 
 
-def _env_cache_key(environment_id: ObjectId, version: int) -> str:
-    return f"{str(environment_id)}-{version}"
-
-
-def _get_docker_image_and_base_docker_image(revision_id: ObjectId, version_no: int):
-
-    revision = ENVIRONMENT_REVISION_CACHE.get_by_environment(revision_id, version_no)
-    docker_image = None
-    docker_image_status_message = ""
+def _get_docker_image_and_base_docker_image(
+    revision_id: ObjectId, version_no: int, latest: bool = False
+):
+    revision = None
+    if latest:
+        # Served from the latest-version index when it agrees with nucleus
+        revision = ENVIRONMENT_REVISION_CACHE.try_get_latest_by_environment(revision_id)
+        if revision is not None and revision.version != version_no:
+            revision = None
     if revision is None:
-        docker_image_status_message = (
-            f"Could not find revision: {revision_id}-{version_no}"
-        )
-        docker_image = None
-        return docker_image, docker_image_status_message
-
-    count = 0
-    while True or count < 100:  # To avoid an infinite loop just in case
-        count = count + 1
-        if revision.docker_image is not None:
-            docker_image = revision.docker_image
-            docker_image_status_message = "success"
-            break
-        else:
-            base_environment_revision_id = revision.base_environment_revision_id
-            revision = ENVIRONMENT_REVISION_CACHE.get(base_environment_revision_id)
-            if revision is None:
-                docker_image_status_message = f"Could not find revision (in hierarchy)"
-                docker_image = None
-    return docker_image, docker_image_status_message
+        revision = ENVIRONMENT_REVISION_CACHE.get_by_environment(revision_id, version_no)
+    if revision is None:
+        return None, f"Could not find revision: {revision_id}-{version_no}"
+    return ENVIRONMENT_REVISION_CACHE.get_root_image(revision)
 
 
 @app.route("/api-extended/refresh_cache", methods=["GET"])
 def refresh_cache():
     ENVIRONMENT_REVISION_CACHE.refresh_cache()
     PROJECTS_CACHE.refresh_cache()
-    return {"EnvironmentReviewCacheRefreshed": True, "ProjectsCacheRefreshed": True}
+    CENTRAL_CONFIG.invalidate()
+    return {
+        "EnvironmentReviewCacheRefreshed": True,
+        "ProjectsCacheRefreshed": True,
+        "EnvironmentRevisionCacheGeneration": ENVIRONMENT_REVISION_CACHE.generation,
+        "ProjectsCacheGeneration": PROJECTS_CACHE.generation,
+    }
+
+
+@app.route("/api-extended/cache_snapshots/<collection>", methods=["GET"])
+def cache_snapshot(collection: str):
+    # Downloaded by the followers of a shared refresh from the leader's pod
+    if SHARED_REFRESH is None:
+        return Response(f"No snapshot of {collection}", 404)
+    if not SHARED_REFRESH.authorized(request.headers.get(SNAPSHOT_TOKEN_HEADER)):
+        return Response("Not authorized to download the cache snapshots", 403)
+    path = SHARED_REFRESH.snapshot_file(collection)
+    if path is None:
+        return Response(f"No snapshot of {collection}", 404)
+    return send_file(path, mimetype="application/octet-stream")
+
+
+@app.route("/api-extended/refresh_central_config", methods=["GET"])
+def refresh_central_config():
+    headers = utils.get_headers(request.headers)
+    try:
+        if not utils.is_user_authorized(headers):
+            return Response(
+                "Unauthorized - Must be Domino Admin or one of the allowed users",
+                403,
+            )
+        CENTRAL_CONFIG.invalidate()
+        return CENTRAL_CONFIG.get()._asdict()
+    except Exception as e:
+        logger.exception(e)
+        return Response(
+            str(e),
+            500,
+        )
+
+
+@app.route("/api-extended/cache_stats", methods=["GET"])
+def cache_stats():
+    return {
+        "EnvironmentRevisionCache": {
+            "size": len(ENVIRONMENT_REVISION_CACHE.cache),
+            "generation": ENVIRONMENT_REVISION_CACHE.generation,
+            "hits": ENVIRONMENT_REVISION_CACHE.lookups.hits,
+            **ENVIRONMENT_REVISION_CACHE.refresher.stats(),
+        },
+        "ProjectsCache": {
+            "size": len(PROJECTS_CACHE.cache),
+            "generation": PROJECTS_CACHE.generation,
+            "hits": PROJECTS_CACHE.lookups.hits,
+            **PROJECTS_CACHE.refresher.stats(),
+        },
+        "Snapshots": CACHE_SNAPSHOTS.stats() if CACHE_SNAPSHOTS is not None else None,
+        "SharedRefresh": SHARED_REFRESH.stats() if SHARED_REFRESH is not None else None,
+        "PrincipalCache": utils.PRINCIPAL_CACHE.stats(),
+        "ResponseCache": RESPONSE_CACHE.stats() if RESPONSE_CACHE is not None else None,
+        "Nucleus": NUCLEUS_CLIENT.stats(),
+        "Mutations": (
+            domsed.MUTATION_INFORMER.stats()
+            if domsed.MUTATION_INFORMER is not None
+            else None
+        ),
+    }
+
+
+def _enrich_environment(e: Dict) -> Dict:
+    env_id = e["id"]
+    latest_environment_revision_id = e["latestRevision"]["number"]
+    image, status_message = _get_docker_image_and_base_docker_image(
+        ObjectId(env_id), latest_environment_revision_id, latest=True
+    )
+    e["latestRevision"]["basedOnDockerImage"] = image
+    e["latestRevision"]["basedOnDockerImageStatusMessage"] = status_message
+    e["latestRevision"]["availableTools"] = None
+    selected_environment_revision_id = e["selectedRevision"]["number"]
+    image, status_message = _get_docker_image_and_base_docker_image(
+        ObjectId(env_id), selected_environment_revision_id
+    )
+    e["selectedRevision"]["basedOnDockerImage"] = image
+    e["selectedRevision"]["basedOnDockerImageStatusMessage"] = status_message
+    e["selectedRevision"]["availableTools"] = None
+    return e
+
+
+def _enrich_project(p: Dict) -> Dict:
+    project_id = p["id"]
+    project = PROJECTS_CACHE.get_by_project(ObjectId(project_id))
+    if project:
+        p["environment_id"] = str(project.environment_id)
+        p[
+            "default_environment_revision_spec"
+        ] = project.default_environment_revision_spec
+    return p
+
+
+def _fetch_listing(
+    path: str,
+    key: str,
+    enrich,
+    cache,
+    headers: Dict,
+    params: Dict,
+    all_pages: bool,
+    if_none_match: Optional[str] = None,
+) -> Response:
+    """The buffered enhanced listing, 304 when it matches `if_none_match`."""
+    # Read before the listing, a later one could tag an older enrichment
+    generation = cache.generation
+    generation_headers = {CACHE_GENERATION_HEADER: str(generation)}
+    if all_pages:
+        items = iter_all_items(NUCLEUS_CLIENT, path, key, headers, params)
+    else:
+        validator = cache_validator(cache)
+        condition = upstream_condition(if_none_match, validator)
+        resp = NUCLEUS_CLIENT.get(
+            path, headers=with_condition(headers, condition), params=params
+        )
+        if resp.status_code in (200, NOT_MODIFIED):
+            generation_headers[ETAG_HEADER] = listing_etag(resp, validator, condition)
+            if resp.status_code == NOT_MODIFIED or not_modified(
+                if_none_match, generation_headers[ETAG_HEADER]
+            ):
+                return Response(status=NOT_MODIFIED, headers=generation_headers)
+            items = resp.json()[key]
+        else:
+            items = []
+    try:
+        enriched = [enrich(item) for item in items]
+    except UpstreamPageError as e:
+        logger.exception(e)
+        return Response(str(e), 502)
+    response = jsonify({key: enriched})
+    response.headers.extend(generation_headers)
+    return response
+
+
+def _listing_headers(response: Response) -> Dict[str, str]:
+    return {
+        name: response.headers[name]
+        for name in (CACHE_GENERATION_HEADER, ETAG_HEADER)
+        if name in response.headers
+    }
+
+
+def _cached_response(entry: CachedListing, if_none_match: Optional[str]) -> Response:
+    if entry.etag is not None and not_modified(if_none_match, entry.etag):
+        return Response(status=NOT_MODIFIED, headers=entry.headers)
+    return Response(entry.body, mimetype="application/json", headers=entry.headers)
+
+
+def _revalidate_listing(
+    response_cache: ResponseCache,
+    cache_key: str,
+    entry: Optional[CachedListing],
+    fetch: Callable,
+) -> Response:
+    """Fetch the listing of `cache_key` again and store it in `response_cache`.
+
+    Conditional on the cached `entry`, which is only marked fresh again when
+    the listing did not change.
+    """
+    response = fetch(entry.etag if entry is not None else None)
+    if response.status_code == NOT_MODIFIED and entry is not None:
+        response_cache.touch(cache_key, entry.generation)
+    elif response.status_code == 200:
+        response_cache.put(
+            cache_key,
+            CachedListing(
+                response.get_data(),
+                _listing_headers(response),
+                response.headers.get(ETAG_HEADER),
+                int(response.headers[CACHE_GENERATION_HEADER]),
+            ),
+        )
+    return response
+
+
+def _revalidate_in_background(
+    response_cache: ResponseCache, cache_key: str, entry: CachedListing, fetch: Callable
+):
+    def revalidate():
+        try:
+            with app.app_context():
+                _revalidate_listing(response_cache, cache_key, entry, fetch)
+        except Exception as e:
+            logger.exception(e)
+        finally:
+            response_cache.end_revalidation(cache_key)
+
+    threading.Thread(target=revalidate, name="revalidate-listing", daemon=True).start()
+
+
+def _cached_listing(
+    response_cache: ResponseCache, cache, fetch: Callable, cache_key: str
+) -> Response:
+    """The listing of `cache_key` from `response_cache`, fetched on a miss.
+
+    A stale entry is served as is while it is revalidated in the background.
+    """
+    if_none_match = request.headers.get(IF_NONE_MATCH_HEADER)
+    entry, fresh = response_cache.get(cache_key, cache.generation)
+    if entry is not None:
+        if not fresh and response_cache.begin_revalidation(cache_key):
+            _revalidate_in_background(response_cache, cache_key, entry, fetch)
+        return _cached_response(entry, if_none_match)
+    response = _revalidate_listing(response_cache, cache_key, None, fetch)
+    etag = response.headers.get(ETAG_HEADER)
+    if response.status_code == 200 and etag and not_modified(if_none_match, etag):
+        return Response(status=NOT_MODIFIED, headers=_listing_headers(response))
+    return response
+
+
+def _enhanced_listing(path: str, key: str, enrich, cache):
+    mode = stream_mode(request.args, request.headers)
+    headers = utils.get_headers(request.headers)
+    params = upstream_params(request.args)
+    params.pop(ALL_PARAM, None)
+    all_pages = all_pages_requested(request.args)
+    if mode is not None:
+        generation_headers = {CACHE_GENERATION_HEADER: str(cache.generation)}
+        if all_pages:
+            items = iter_all_items(NUCLEUS_CLIENT, path, key, headers, params)
+        else:
+            resp = NUCLEUS_CLIENT.get(path, headers=headers, params=params, stream=True)
+            items = iter_upstream_items(resp, key)
+        return Response(
+            stream_with_context(stream_listing(items, key, enrich, mode)),
+            mimetype=STREAM_MIMETYPES[mode],
+            headers=generation_headers,
+        )
+
+    def fetch(if_none_match: Optional[str]) -> Response:
+        return _fetch_listing(
+            path, key, enrich, cache, headers, params, all_pages, if_none_match
+        )
+
+    response_cache = RESPONSE_CACHE
+    if response_cache is None:
+        return fetch(request.headers.get(IF_NONE_MATCH_HEADER))
+    route = f"{path}?{ALL_PARAM}" if all_pages else path
+    return _cached_listing(
+        response_cache, cache, fetch, listing_key(headers, route, params)
+    )
 
 
 @app.route("/api-extended/environments/beta/environments", methods=["GET"])
 def get_enchanced_env_revisions():
     logger.warning(
-        f"Extended API Endpoint /api-extended/projects/beta/projects invoked"
+        f"Extended API Endpoint /api-extended/environments/beta/environments invoked"
     )
-    params = request.args
-    resp = requests.get(
-        f"{DOMINO_NUCLEUS_URI}/api/environments/beta/environments",
-        headers=utils.get_headers(request.headers),
-        params=params,
+    return _enhanced_listing(
+        "api/environments/beta/environments",
+        "environments",
+        _enrich_environment,
+        ENVIRONMENT_REVISION_CACHE,
     )
-    new_envs = []
-    if resp.status_code == 200:
-        environments = resp.json()["environments"]
-
-        for e in environments:
-            env_id = e["id"]
-            latest_environment_revision_id = e["latestRevision"]["number"]
-            image, status_message = _get_docker_image_and_base_docker_image(
-                ObjectId(env_id), latest_environment_revision_id
-            )
-            e["latestRevision"]["basedOnDockerImage"] = image
-            e["latestRevision"]["basedOnDockerImageStatusMessage"] = status_message
-            e["latestRevision"]["availableTools"] = None
-            selected_environment_revision_id = e["selectedRevision"]["number"]
-            image, status_message = _get_docker_image_and_base_docker_image(
-                ObjectId(env_id), selected_environment_revision_id
-            )
-            e["selectedRevision"]["basedOnDockerImage"] = image
-            e["selectedRevision"]["basedOnDockerImageStatusMessage"] = status_message
-            e["selectedRevision"]["availableTools"] = None
-            new_envs.append(e)
-    return {"environments": new_envs}
 
 
 @app.route("/api-extended/projects/beta/projects", methods=["GET"])
@@ -296,26 +535,9 @@ def get_enchanced_projects():
     logger.warning(
         f"Extended API Endpoint /api-extended/projects/beta/projects invoked"
     )
-    params = request.args
-    resp = requests.get(
-        f"{DOMINO_NUCLEUS_URI}/api/projects/beta/projects",
-        headers=utils.get_headers(request.headers),
-        params=params,
+    return _enhanced_listing(
+        "api/projects/beta/projects", "projects", _enrich_project, PROJECTS_CACHE
     )
-    new_projects = []
-    if resp.status_code == 200:
-        projects = resp.json()["projects"]
-
-        for p in projects:
-            project_id = p["id"]
-            if PROJECTS_CACHE.get_by_project(ObjectId(project_id)):
-                project = PROJECTS_CACHE.get_by_project(project_id)
-                p["environment_id"] = str(project.environment_id)
-                p[
-                    "default_environment_revision_spec"
-                ] = project.default_environment_revision_spec
-            new_projects.append(p)
-    return {"projects": new_projects}
 
 
 @app.route("/healthz")
@@ -324,113 +546,295 @@ def alive():
     return "{'status': 'Healthy'}"
 
 
-class EnvironmentRevision:
-    def __init__(self, revision: dict):
-        self._id = ObjectId(revision["_id"])
-        self.environment_id = revision["environmentId"]
-        self.version = int(revision["metadata"]["number"])
-        self.docker_image = revision["definition"].get("dockerImage")
-        self.base_environment_revision_id = revision["definition"].get(
-            "baseEnvironmentRevisionId"
-        )
+def _flush_cache_lookups():
+    for cache in (ENVIRONMENT_REVISION_CACHE, PROJECTS_CACHE):
+        if cache is not None:
+            cache.lookups.flush()
+
+
+@app.route("/metrics")
+def prometheus_metrics():
+    # The lookups of this worker up to now, the others flush on their own
+    _flush_cache_lookups()
+    body, content_type = metrics.exposition()
+    return Response(body, content_type=content_type)
+
+
+@app.route("/readyz")
+def ready():
+    if WARM_UP is None:
+        return {"ready": False, "steps": {}}, 503
+    status = WARM_UP.status()
+    return status, 200 if status["ready"] else 503
+
+
+CACHE_NEGATIVE_TTL_SECONDS = float(os.environ.get("CACHE_NEGATIVE_TTL_SECONDS", "60"))
+CACHE_MIN_REFRESH_INTERVAL_SECONDS = float(
+    os.environ.get("CACHE_MIN_REFRESH_INTERVAL_SECONDS", "10")
+)
+CENTRAL_CONFIG_TTL_SECONDS = float(os.environ.get("CENTRAL_CONFIG_TTL_SECONDS", "60"))
+CACHE_CHANGE_STREAMS_ENABLED = (
+    os.environ.get("CACHE_CHANGE_STREAMS_ENABLED", "false").lower() == "true"
+)
+# Folder of the cache snapshots, none are read or written when empty
+CACHE_SNAPSHOT_DIR = os.environ.get("CACHE_SNAPSHOT_DIR", "")
+CACHE_SNAPSHOT_INTERVAL_SECONDS = float(
+    os.environ.get("CACHE_SNAPSHOT_INTERVAL_SECONDS", DEFAULT_SNAPSHOT_INTERVAL_SECONDS)
+)
+# One worker of all the replicas reloads the caches, see shared_refresh.py
+CACHE_SHARED_REFRESH_ENABLED = (
+    os.environ.get("CACHE_SHARED_REFRESH_ENABLED", "false").lower() == "true"
+)
+CACHE_SHARED_REFRESH_LEASE = os.environ.get(
+    "CACHE_SHARED_REFRESH_LEASE", "domino-extensions-api-cache-refresh"
+)
+CACHE_SHARED_REFRESH_LEASE_DURATION_SECONDS = int(
+    os.environ.get(
+        "CACHE_SHARED_REFRESH_LEASE_DURATION_SECONDS", DEFAULT_LEASE_DURATION_SECONDS
+    )
+)
+CACHE_SHARED_REFRESH_RETRY_PERIOD_SECONDS = float(
+    os.environ.get(
+        "CACHE_SHARED_REFRESH_RETRY_PERIOD_SECONDS", DEFAULT_RETRY_PERIOD_SECONDS
+    )
+)
+CACHE_SHARED_REFRESH_TIMEOUT_SECONDS = float(
+    os.environ.get("CACHE_SHARED_REFRESH_TIMEOUT_SECONDS", DEFAULT_REFRESH_TIMEOUT_SECONDS)
+)
+CACHE_SHARED_REFRESH_MISS_TIMEOUT_SECONDS = float(
+    os.environ.get(
+        "CACHE_SHARED_REFRESH_MISS_TIMEOUT_SECONDS", DEFAULT_MISS_TIMEOUT_SECONDS
+    )
+)
+DEFAULT_SHARED_SNAPSHOT_DIR = "/tmp/extended-api-snapshots"
+# Serialized enhanced listings per credentials, disabled with a TTL of 0
+RESPONSE_CACHE_TTL_SECONDS = float(
+    os.environ.get("RESPONSE_CACHE_TTL_SECONDS", DEFAULT_TTL_SECONDS)
+)
+RESPONSE_CACHE: Optional[ResponseCache] = (
+    ResponseCache(
+        ttl_seconds=RESPONSE_CACHE_TTL_SECONDS,
+        stale_seconds=float(
+            os.environ.get("RESPONSE_CACHE_STALE_SECONDS", DEFAULT_STALE_SECONDS)
+        ),
+        max_entries=int(
+            os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", DEFAULT_MAX_ENTRIES)
+        ),
+        max_bytes=int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES)),
+    )
+    if RESPONSE_CACHE_TTL_SECONDS > 0
+    else None
+)
+WARM_UP_WATCHER_TIMEOUT_SECONDS = 60.0
+# Longest wait for each background thread on shutdown, well within the
+# gunicorn graceful timeout
+SHUTDOWN_JOIN_TIMEOUT_SECONDS = 5.0
+WARM_UP_INFORMER_TIMEOUT_SECONDS = 60.0
+
+# Per process state, created by init_worker once the process serving requests
+# exists (after the fork when running under gunicorn)
+MONGO_DATABASE: LazyDatabase = None  # type: ignore
+ENVIRONMENT_REVISION_CACHE: EnvironmentRevisionCache = None  # type: ignore
+PROJECTS_CACHE: ProjectsCache = None  # type: ignore
+CENTRAL_CONFIG: CentralConfigCache = None  # type: ignore
+CACHE_WATCHERS: List = []
+CACHE_SNAPSHOTS: Optional[CacheSnapshots] = None
+SHARED_REFRESH: Optional[SharedCacheRefresh] = None
+WARM_UP: Optional[WarmUp] = None
+
+
+def configure_logging():
+    lvl = logging.getLevelName(os.environ.get("LOG_LEVEL", "WARNING"))
+    logging.basicConfig(
+        level=lvl,
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    )
+    log = logging.getLogger("extendedapi_server")
+    log.setLevel(logging.WARNING)
 
 
-class EnvironmentRevisionCache:
-    def __init__(self):
-        logger.info("Initializing EnvironmentRevision cache.")
-        self.cache: Dict[ObjectId, EnvironmentRevision] = {}
+def _ping_mongo():
+    # Reads the credential secret and creates the client on first use
+    MONGO_DATABASE.client.admin.command("ping")
+
+
+def _reload_in_background(cache):
+    def reload():
+        try:
+            cache.refresh_cache()
+        except Exception as e:
+            # Still served from the snapshot, a miss retries the reload
+            logger.exception(e)
+
+    threading.Thread(
+        target=reload, name=f"reload-{cache.collection_name}", daemon=True
+    ).start()
+
+
+def _warm_cache(cache):
+    if SHARED_REFRESH is not None and not SHARED_REFRESH.leader:
+        SHARED_REFRESH.pull(cache)
+        return
+    if CACHE_SNAPSHOTS is not None and CACHE_SNAPSHOTS.load(cache):
+        # Without change streams the cache can only catch up by a reload,
+        # requests are served from the snapshot meanwhile
+        _reload_in_background(cache)
+        return
+    cache.refresh_cache()
+    if cache.generation == 0:
+        # Waited on a concurrent reload which failed
+        raise Exception(f"{type(cache).__name__} not loaded")
+
+
+def _load_snapshots():
+    # The watchers resume from the position of the caches which were loaded
+    for cache in CACHE_SNAPSHOTS.caches:
+        if SHARED_REFRESH is not None and not SHARED_REFRESH.leader:
+            SHARED_REFRESH.pull(cache)
+        else:
+            CACHE_SNAPSHOTS.load(cache)
 
-    def get(self, environment_revision_id: ObjectId) -> Optional[EnvironmentRevision]:
-        if environment_revision_id not in self.cache:
-            self.refresh_cache()
-        return self.cache.get(environment_revision_id)
 
-    def try_get_by_environment(
-        self, environment_id: ObjectId, version: int
-    ) -> Optional[EnvironmentRevision]:
-        for revision in self.cache.values():
-            if (
-                str(revision.environment_id) == str(environment_id)
-                and revision.version == version
-            ):
-                return revision
-        return None
-
-    def get_by_environment(
-        self, environment_id: ObjectId, version: int
-    ) -> Optional[EnvironmentRevision]:
-        revision = self.try_get_by_environment(environment_id, version)
-        if revision is not None:
-            return revision
-        self.refresh_cache()
-        return self.try_get_by_environment(environment_id, version)
-
-    def refresh_cache(self):
-        logger.info("Refreshing EnvironmentRevision cache.")
-        self.cache = {}
-        for revision in MONGO_DATABASE.get_collection("environment_revisions").find():
-            self.cache[revision["_id"]] = EnvironmentRevision(revision)
-        logger.info(f"Found {len(self.cache)} environment revisions.")
-
-
-class Project:
-    def __init__(self, project: dict):
-        self._id = ObjectId(project["_id"])
-        self.environment_id = project["overrideV2EnvironmentId"]
-        self.default_environment_revision_spec = project[
-            "defaultEnvironmentRevisionSpec"
-        ]
+def _start_cache_watchers():
+    global CACHE_WATCHERS
+    if not CACHE_WATCHERS:
+        CACHE_WATCHERS = start_cache_watchers(
+            MONGO_DATABASE, ENVIRONMENT_REVISION_CACHE, PROJECTS_CACHE
+        )
+        if SHARED_REFRESH is not None:
+            SHARED_REFRESH.follow_watchers(CACHE_WATCHERS)
 
 
-class ProjectsCache:
-    def __init__(self):
-        logger.info("Initializing Project cache.")
-        self.cache: Dict[ObjectId, Project] = {}
+def _wait_for_cache_watchers():
+    for watcher in CACHE_WATCHERS:
+        if not watcher.loaded.wait(WARM_UP_WATCHER_TIMEOUT_SECONDS):
+            raise TimeoutError(f"Cache of {watcher.collection.name} not loaded yet")
 
-    def get(self, project_id: ObjectId) -> Optional[Project]:
-        if project_id not in self.cache:
-            self.refresh_cache()
-        return self.cache.get(project_id)
 
-    def try_get_by_project(self, project_id: ObjectId) -> Optional[Project]:
-        for project in self.cache.values():
-            if str(project._id) == str(project_id):
-                return project
-        return None
+def _sync_mutation_informer():
+    # Best effort: until the informer has listed the mutations, reads go to the
+    # API server, so a missing CRD or `watch` permission must not keep the
+    # worker out of service. The informer keeps retrying in the background.
+    informer = domsed.start_mutation_informer()
+    if not informer.synced.wait(WARM_UP_INFORMER_TIMEOUT_SECONDS):
+        logger.warning(
+            f"Mutations not listed after {WARM_UP_INFORMER_TIMEOUT_SECONDS} s, "
+            "reading them from the API server"
+        )
 
-    def get_by_project(self, project_id: ObjectId) -> Optional[Project]:
-        project = self.try_get_by_project(project_id)
-        if project is not None:
-            return project
-        self.refresh_cache()
-        return self.try_get_by_project(project_id)
 
-    def refresh_cache(self):
-        logger.info("Refreshing Project cache.")
-        self.cache = {}
-        for project in MONGO_DATABASE.get_collection("projects").find():
-            self.cache[project["_id"]] = Project(project)
-        logger.info(f"Found {len(self.cache)} projects.")
+def _warm_up_steps():
+    steps = [("mongo", _ping_mongo)]
+    if SHARED_REFRESH is not None:
+        # Elects the leader before the caches are loaded, from Mongo or from it
+        steps.append(("shared_refresh", SHARED_REFRESH.start))
+    if CACHE_CHANGE_STREAMS_ENABLED:
+        # The watchers load the caches before following the change streams
+        if CACHE_SNAPSHOTS is not None:
+            steps.append(("snapshots", _load_snapshots))
+        steps.append(("change_streams", _start_cache_watchers))
+        steps.append(("caches", _wait_for_cache_watchers))
+    else:
+        steps.append(
+            (
+                "environment_revision_cache",
+                lambda: _warm_cache(ENVIRONMENT_REVISION_CACHE),
+            )
+        )
+        steps.append(("projects_cache", lambda: _warm_cache(PROJECTS_CACHE)))
+    steps.append(("central_config", CENTRAL_CONFIG.get))
+    if domsed.MUTATION_INFORMER_ENABLED:
+        steps.append(("mutations", _sync_mutation_informer))
+    return steps
+
+
+def init_worker(connect: Callable = create_database_connection):
+    """Create the caches and start warming them up in the background.
+
+    Nothing here blocks: Mongo is connected and the caches are loaded by the
+    warm-up thread, whose progress `/readyz` reports. A MongoClient and the
+    background threads do not survive a fork, so this runs in every serving
+    process: from the gunicorn `post_worker_init` hook, or before starting
+    the development server. `connect` returns the `domino` database, the
+    benchmarks pass one returning a local database.
+    """
+    global MONGO_DATABASE, ENVIRONMENT_REVISION_CACHE, PROJECTS_CACHE
+    global CENTRAL_CONFIG, CACHE_WATCHERS, CACHE_SNAPSHOTS, SHARED_REFRESH, WARM_UP
+    MONGO_DATABASE = LazyDatabase(connect)
+    ENVIRONMENT_REVISION_CACHE = EnvironmentRevisionCache(
+        MONGO_DATABASE, CACHE_NEGATIVE_TTL_SECONDS, CACHE_MIN_REFRESH_INTERVAL_SECONDS
+    )
+    PROJECTS_CACHE = ProjectsCache(
+        MONGO_DATABASE, CACHE_NEGATIVE_TTL_SECONDS, CACHE_MIN_REFRESH_INTERVAL_SECONDS
+    )
+    CENTRAL_CONFIG = CentralConfigCache(MONGO_DATABASE, CENTRAL_CONFIG_TTL_SECONDS)
+    CACHE_WATCHERS = []
+    CACHE_SNAPSHOTS = None
+    SHARED_REFRESH = None
+    caches = [ENVIRONMENT_REVISION_CACHE, PROJECTS_CACHE]
+    if CACHE_SNAPSHOT_DIR or CACHE_SHARED_REFRESH_ENABLED:
+        CACHE_SNAPSHOTS = CacheSnapshots(
+            caches,
+            CACHE_SNAPSHOT_DIR or DEFAULT_SHARED_SNAPSHOT_DIR,
+            CACHE_SNAPSHOT_INTERVAL_SECONDS,
+        )
+    if CACHE_SNAPSHOT_DIR and not CACHE_SHARED_REFRESH_ENABLED:
+        # With a shared refresh only the leader writes, after each reload
+        CACHE_SNAPSHOTS.start()
+    if CACHE_SHARED_REFRESH_ENABLED:
+        SHARED_REFRESH = _create_shared_refresh(caches)
+    WARM_UP = WarmUp(_warm_up_steps())
+    WARM_UP.start()
+
+
+def _create_shared_refresh(caches: List) -> SharedCacheRefresh:
+    # Every worker is a candidate, its pod serves the snapshots it writes
+    pod = os.environ.get("POD_NAME") or socket.gethostname()
+    address = os.environ.get("POD_IP") or socket.gethostbyname(socket.gethostname())
+    port = os.environ.get("CACHE_SHARED_REFRESH_PORT", "5000")
+    elector = LeaseElector(
+        CACHE_SHARED_REFRESH_LEASE,
+        os.environ.get("POD_NAMESPACE", DEFAULT_FIELD_NAMESPACE),
+        f"{pod}_{os.getpid()}",
+        CACHE_SHARED_REFRESH_LEASE_DURATION_SECONDS,
+    )
+    return SharedCacheRefresh(
+        caches,
+        CACHE_SNAPSHOTS,
+        elector,
+        f"http://{address}:{port}",
+        CACHE_SHARED_REFRESH_RETRY_PERIOD_SECONDS,
+        CACHE_SHARED_REFRESH_TIMEOUT_SECONDS,
+        CACHE_SHARED_REFRESH_MISS_TIMEOUT_SECONDS,
+    )
 
 
-ENVIRONMENT_REVISION_CACHE = EnvironmentRevisionCache()
-PROJECTS_CACHE = ProjectsCache()
-MONGO_DATABASE = create_database_connection()
+def shutdown_worker():
+    if WARM_UP is not None:
+        WARM_UP.stop(timeout=SHUTDOWN_JOIN_TIMEOUT_SECONDS)
+    if SHARED_REFRESH is not None:
+        # Released, another worker takes over without waiting for it to expire
+        SHARED_REFRESH.stop(timeout=SHUTDOWN_JOIN_TIMEOUT_SECONDS)
+    domsed.stop_mutation_informer()
+    # One bound shared by all the watchers
+    deadline = time.monotonic() + SHUTDOWN_JOIN_TIMEOUT_SECONDS
+    for watcher in CACHE_WATCHERS:
+        watcher.stop(timeout=max(deadline - time.monotonic(), 0))
+    if CACHE_SNAPSHOTS is not None:
+        # Written once the watchers applied their last change
+        CACHE_SNAPSHOTS.stop(timeout=SHUTDOWN_JOIN_TIMEOUT_SECONDS)
+    if MONGO_DATABASE is not None:
+        MONGO_DATABASE.close()
+    _flush_cache_lookups()
 
 
 if __name__ == "__main__":
+    # Development server, production runs `gunicorn -c gunicorn.conf.py api:app`
     if len(sys.argv) > 1:
-        DOMINO_NUCLEUS_URI: str = sys.argv[1]
-
-    lvl = logging.getLevelName(os.environ.get("LOG_LEVEL", "WARNING"))
-    logging.basicConfig(
-        level=lvl,
-        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    )
-    log = logging.getLogger("extendedapi_server")
-    log.setLevel(logging.WARNING)
+        NUCLEUS_CLIENT.base_uri = sys.argv[1]
 
-    logger.warning(MONGO_DATABASE.client)
+    configure_logging()
+    init_worker()
     debug = os.environ.get("FLASK_ENV") == "development"
     app.run(
         host=os.environ.get("FLASK_HOST", "0.0.0.0"),
@@ -438,4 +842,4 @@ if __name__ == "__main__":
         debug=debug,
         # ssl_context=("/ssl/tls.crt", "/ssl/tls.key"),
     )
-    MONGO_DATABASE.client.close()
+    shutdown_worker()
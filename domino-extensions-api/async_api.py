@@ -0,0 +1,389 @@
+"""async_api Module.
+
+This module implements the asyncio server. The enhanced listings and the
+admin check run as coroutines on an AsyncNucleusClient, so a worker waiting on
+nucleus for hundreds of listings does not hold a thread for each of them.
+The caches are the ones of `api` and are still read synchronously in memory.
+Every other endpoint is served by the Flask app through a WSGI bridge.
+
+Example:
+    SERVER_MODE=async gunicorn --config gunicorn.conf.py
+"""
+import logging
+import os
+import sys
+import time
+from contextlib import asynccontextmanager
+from typing import Callable, Dict, Iterable, List, Optional
+
+from starlette.applications import Starlette
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware import Middleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Match, Mount, Route
+from uvicorn.middleware.wsgi import WSGIMiddleware
+
+import api
+import utils
+from conditional import (
+    ETAG_HEADER,
+    IF_NONE_MATCH_HEADER,
+    NOT_MODIFIED,
+    cache_validator,
+    listing_etag,
+    not_modified,
+    upstream_condition,
+    with_condition,
+)
+from metrics import REQUEST_DURATION
+from nucleus import AsyncNucleusClient, nucleus_client_settings
+from pagination import (
+    ALL_PARAM,
+    UpstreamPageError,
+    all_pages_requested,
+    iter_all_items_async,
+)
+from response_cache import CachedListing, ResponseCache, listing_key
+from streaming import (
+    STREAM_MIMETYPES,
+    iter_upstream_items_async,
+    stream_listing_async,
+    stream_mode,
+    upstream_params,
+)
+
+logger = logging.getLogger("extended-api")
+
+NUCLEUS_ASYNC_POOL_SIZE = int(os.environ.get("NUCLEUS_ASYNC_POOL_SIZE", "100"))
+WSGI_THREADS = int(os.environ.get("ASYNC_WSGI_THREADS", "10"))
+
+# Created on startup, bound to the event loop of the worker
+NUCLEUS_CLIENT: AsyncNucleusClient = None  # type: ignore
+
+
+def _enrich_all(items: Iterable[Dict], enrich: Callable[[Dict], Dict]) -> List[Dict]:
+    return [enrich(item) for item in items]
+
+
+async def _enrich_items(items: Iterable[Dict], enrich, cache) -> List[Dict]:
+    if cache.reload_on_miss:
+        # A miss reloads the cache from Mongo, keep that off the event loop
+        return await run_in_threadpool(_enrich_all, items, enrich)
+    return _enrich_all(items, enrich)
+
+
+def _async_enrich(enrich, cache):
+    async def enrich_item(item: Dict) -> Dict:
+        if cache.reload_on_miss:
+            return await run_in_threadpool(enrich, item)
+        return enrich(item)
+
+    return enrich_item
+
+
+async def _fetch_listing(
+    path: str,
+    key: str,
+    enrich,
+    cache,
+    headers: Dict,
+    params: Dict,
+    all_pages: bool,
+    if_none_match: Optional[str] = None,
+) -> Response:
+    """The buffered enhanced listing, 304 when it matches `if_none_match`."""
+    generation = cache.generation
+    generation_headers = {api.CACHE_GENERATION_HEADER: str(generation)}
+    if all_pages:
+        items = iter_all_items_async(NUCLEUS_CLIENT, path, key, headers, params)
+    else:
+        validator = cache_validator(cache)
+        condition = upstream_condition(if_none_match, validator)
+        resp = await NUCLEUS_CLIENT.get(
+            path, headers=with_condition(headers, condition), params=params
+        )
+        if resp.status_code in (200, NOT_MODIFIED):
+            generation_headers[ETAG_HEADER] = listing_etag(resp, validator, condition)
+            if resp.status_code == NOT_MODIFIED or not_modified(
+                if_none_match, generation_headers[ETAG_HEADER]
+            ):
+                return Response(status_code=NOT_MODIFIED, headers=generation_headers)
+            items = resp.json()[key]
+        else:
+            items = []
+    try:
+        if all_pages:
+            items = [item async for item in items]
+        enriched = await _enrich_items(items, enrich, cache)
+    except UpstreamPageError as e:
+        logger.exception(e)
+        return Response(str(e), 502)
+    return JSONResponse({key: enriched}, headers=generation_headers)
+
+
+def _listing_headers(response: Response) -> Dict[str, str]:
+    return {
+        name: response.headers[name]
+        for name in (api.CACHE_GENERATION_HEADER, ETAG_HEADER)
+        if name in response.headers
+    }
+
+
+def _cached_response(entry: CachedListing, if_none_match: Optional[str]) -> Response:
+    if entry.etag is not None and not_modified(if_none_match, entry.etag):
+        return Response(status_code=NOT_MODIFIED, headers=entry.headers)
+    return Response(entry.body, media_type="application/json", headers=entry.headers)
+
+
+async def _revalidate_listing(
+    response_cache: ResponseCache,
+    cache_key: str,
+    entry: Optional[CachedListing],
+    fetch: Callable,
+) -> Response:
+    """As api._revalidate_listing, with a coroutine `fetch`."""
+    response = await fetch(entry.etag if entry is not None else None)
+    if response.status_code == NOT_MODIFIED and entry is not None:
+        response_cache.touch(cache_key, entry.generation)
+    elif response.status_code == 200:
+        response_cache.put(
+            cache_key,
+            CachedListing(
+                response.body,
+                _listing_headers(response),
+                response.headers.get(ETAG_HEADER),
+                int(response.headers[api.CACHE_GENERATION_HEADER]),
+            ),
+        )
+    return response
+
+
+async def _revalidate_in_background(
+    response_cache: ResponseCache, cache_key: str, entry: CachedListing, fetch: Callable
+):
+    try:
+        await _revalidate_listing(response_cache, cache_key, entry, fetch)
+    except Exception as e:
+        logger.exception(e)
+    finally:
+        response_cache.end_revalidation(cache_key)
+
+
+async def _cached_listing(
+    request: Request,
+    response_cache: ResponseCache,
+    cache,
+    fetch: Callable,
+    cache_key: str,
+) -> Response:
+    """As api._cached_listing, the revalidation runs once the response is sent."""
+    if_none_match = request.headers.get(IF_NONE_MATCH_HEADER)
+    entry, fresh = response_cache.get(cache_key, cache.generation)
+    if entry is not None:
+        response = _cached_response(entry, if_none_match)
+        if not fresh and response_cache.begin_revalidation(cache_key):
+            response.background = BackgroundTask(
+                _revalidate_in_background, response_cache, cache_key, entry, fetch
+            )
+        return response
+    response = await _revalidate_listing(response_cache, cache_key, None, fetch)
+    etag = response.headers.get(ETAG_HEADER)
+    if response.status_code == 200 and etag and not_modified(if_none_match, etag):
+        return Response(status_code=NOT_MODIFIED, headers=_listing_headers(response))
+    return response
+
+
+async def _enhanced_listing(request: Request, path: str, key: str, enrich, cache):
+    mode = stream_mode(request.query_params, request.headers)
+    headers = utils.get_headers(request.headers)
+    params = upstream_params(request.query_params)
+    params.pop(ALL_PARAM, None)
+    all_pages = all_pages_requested(request.query_params)
+    if mode is not None:
+        generation_headers = {api.CACHE_GENERATION_HEADER: str(cache.generation)}
+        if all_pages:
+            items = iter_all_items_async(NUCLEUS_CLIENT, path, key, headers, params)
+        else:
+            resp = await NUCLEUS_CLIENT.get(
+                path, headers=headers, params=params, stream=True
+            )
+            items = iter_upstream_items_async(resp, key)
+        return StreamingResponse(
+            stream_listing_async(items, key, _async_enrich(enrich, cache), mode),
+            media_type=STREAM_MIMETYPES[mode],
+            headers=generation_headers,
+        )
+
+    async def fetch(if_none_match: Optional[str]) -> Response:
+        return await _fetch_listing(
+            path, key, enrich, cache, headers, params, all_pages, if_none_match
+        )
+
+    response_cache = api.RESPONSE_CACHE
+    if response_cache is None:
+        return await fetch(request.headers.get(IF_NONE_MATCH_HEADER))
+    route = f"{path}?{ALL_PARAM}" if all_pages else path
+    return await _cached_listing(
+        request, response_cache, cache, fetch, listing_key(headers, route, params)
+    )
+
+
+async def get_enchanced_env_revisions(request: Request):
+    logger.warning(
+        "Extended API Endpoint /api-extended/environments/beta/environments invoked"
+    )
+    return await _enhanced_listing(
+        request,
+        "api/environments/beta/environments",
+        "environments",
+        api._enrich_environment,
+        api.ENVIRONMENT_REVISION_CACHE,
+    )
+
+
+async def get_enchanced_projects(request: Request):
+    logger.warning(
+        "Extended API Endpoint /api-extended/projects/beta/projects invoked"
+    )
+    return await _enhanced_listing(
+        request,
+        "api/projects/beta/projects",
+        "projects",
+        api._enrich_project,
+        api.PROJECTS_CACHE,
+    )
+
+
+async def refresh_central_config(request: Request):
+    headers = utils.get_headers(request.headers)
+    try:
+        if not await utils.is_user_authorized_async(headers, NUCLEUS_CLIENT):
+            return Response(
+                "Unauthorized - Must be Domino Admin or one of the allowed users",
+                403,
+            )
+        api.CENTRAL_CONFIG.invalidate()
+        central_config = await run_in_threadpool(api.CENTRAL_CONFIG.get)
+        return JSONResponse(central_config._asdict())
+    except Exception as e:
+        logger.exception(e)
+        return Response(str(e), 500)
+
+
+async def cache_stats(request: Request):
+    stats = api.cache_stats()
+    stats["Nucleus"] = NUCLEUS_CLIENT.stats()
+    return JSONResponse(stats)
+
+
+async def alive(request: Request):
+    return Response("{'status': 'Healthy'}")
+
+
+class RequestMetricsMiddleware:
+    """Observes the duration of the requests of the native routes.
+
+    The Flask app observes the requests it serves through the WSGI bridge.
+    """
+
+    def __init__(self, app, routes: List):
+        self.app = app
+        self.routes = [route for route in routes if isinstance(route, Route)]
+
+    async def __call__(self, scope, receive, send):
+        route = None
+        if scope["type"] == "http":
+            route = next(
+                (r.path for r in self.routes if r.matches(scope)[0] == Match.FULL),
+                None,
+            )
+        if route is None:
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status = 500
+
+        async def send_observed(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_observed)
+        finally:
+            REQUEST_DURATION.labels(scope["method"], route, str(status)).observe(
+                time.perf_counter() - start
+            )
+
+
+def _closing(wsgi_app):
+    """Calls `close()` on the responses of `wsgi_app` once they are sent.
+
+    The uvicorn WSGI bridge never does, which would skip the Flask teardown
+    of streamed responses and their request metrics.
+    """
+
+    def app(environ, start_response):
+        iterable = wsgi_app(environ, start_response)
+        try:
+            yield from iterable
+        finally:
+            if hasattr(iterable, "close"):
+                iterable.close()
+
+    return app
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global NUCLEUS_CLIENT
+    NUCLEUS_CLIENT = AsyncNucleusClient(
+        **dict(nucleus_client_settings(), pool_size=NUCLEUS_ASYNC_POOL_SIZE)
+    )
+    yield
+    await NUCLEUS_CLIENT.aclose()
+
+
+ROUTES = [
+    Route(
+        "/api-extended/environments/beta/environments",
+        get_enchanced_env_revisions,
+        methods=["GET"],
+    ),
+    Route(
+        "/api-extended/projects/beta/projects",
+        get_enchanced_projects,
+        methods=["GET"],
+    ),
+    Route(
+        "/api-extended/refresh_central_config",
+        refresh_central_config,
+        methods=["GET"],
+    ),
+    Route("/api-extended/cache_stats", cache_stats, methods=["GET"]),
+    Route("/healthz", alive),
+    # Everything else is served by the Flask app on a thread pool
+    Mount("/", app=WSGIMiddleware(_closing(api.app), workers=WSGI_THREADS)),
+]
+
+app = Starlette(
+    routes=ROUTES,
+    middleware=[Middleware(RequestMetricsMiddleware, routes=ROUTES)],
+    lifespan=lifespan,
+)
+
+
+if __name__ == "__main__":
+    # Development server, production runs gunicorn with SERVER_MODE=async
+    import uvicorn
+
+    if len(sys.argv) > 1:
+        os.environ["DOMINO_NUCLEUS_URI"] = sys.argv[1]
+
+    api.configure_logging()
+    api.init_worker()
+    uvicorn.run(app, host=os.environ.get("FLASK_HOST", "0.0.0.0"), port=5000)
+    api.shutdown_worker()
@@ -0,0 +1,78 @@
+"""bulk_writer Module.
+
+This module implements a helper which buffers write operations for a Mongo
+collection and flushes them in unordered `bulk_write` batches, keeping the
+totals reported by the server.
+
+Example:
+    writer = BulkWriter(MONGO_DATABASE["userPreferences"], batch_size=1000)
+    writer.add(UpdateOne({"userId": user_id}, {"$set": prefs}, upsert=True))
+    writer.flush()
+    writer.counts()
+"""
+import logging
+import time
+from typing import Dict, List
+
+from pymongo.collection import Collection  # type: ignore
+
+from metrics import BULK_WRITE_BATCHES, BULK_WRITE_DOCUMENTS
+
+logger = logging.getLogger("extended-api")
+
+DEFAULT_BULK_WRITE_BATCH_SIZE = 1000
+
+
+class BulkWriter:
+    def __init__(
+        self, collection: Collection, batch_size: int = DEFAULT_BULK_WRITE_BATCH_SIZE
+    ):
+        if batch_size < 1:
+            raise ValueError("batch_size must be at least 1")
+        self.collection = collection
+        self.batch_size = batch_size
+        self._operations: List = []
+        self.matched = 0
+        self.modified = 0
+        self.upserted = 0
+        self.deleted = 0
+        self.batches = 0
+        self._start = time.perf_counter()
+
+    def add(self, operation):
+        self._operations.append(operation)
+        if len(self._operations) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._operations:
+            return
+        result = self.collection.bulk_write(self._operations, ordered=False)
+        self._operations = []
+        self.batches += 1
+        self.matched += result.matched_count
+        self.modified += result.modified_count
+        self.upserted += result.upserted_count
+        self.deleted += result.deleted_count
+        name = self.collection.name
+        BULK_WRITE_BATCHES.labels(name).inc()
+        for outcome, count in (
+            ("matched", result.matched_count),
+            ("modified", result.modified_count),
+            ("upserted", result.upserted_count),
+            ("deleted", result.deleted_count),
+        ):
+            BULK_WRITE_DOCUMENTS.labels(name, outcome).inc(count)
+        logger.info(
+            f"Flushed bulk write batch {self.batches} to {self.collection.name}"
+        )
+
+    def counts(self) -> Dict:
+        return {
+            "matched": self.matched,
+            "modified": self.modified,
+            "upserted": self.upserted,
+            "deleted": self.deleted,
+            "batches": self.batches,
+            "elapsed_seconds": round(time.perf_counter() - self._start, 3),
+        }
@@ -0,0 +1,721 @@
+"""caches Module.
+
+This module implements the in-memory caches of the `environment_revisions`
+and `projects` Mongo collections used to enrich the nucleus responses.
+
+Example:
+    ENVIRONMENT_REVISION_CACHE = EnvironmentRevisionCache(MONGO_DATABASE)
+    revision = ENVIRONMENT_REVISION_CACHE.get_by_environment(env_id, 3)
+"""
+import hashlib
+import logging
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, Iterable, List, Optional, Set, Tuple
+
+from bson import ObjectId
+from bson.timestamp import Timestamp
+
+from metrics import CACHE_LOOKUPS, CACHE_REFRESH_DURATION, CACHE_REFRESHES, CACHE_SIZE
+
+logger = logging.getLogger("extended-api")
+
+ROOT_IMAGE_SUCCESS = "success"
+ROOT_IMAGE_NOT_FOUND = "Could not find revision (in hierarchy)"
+ROOT_IMAGE_CYCLE = "Cycle detected in revision hierarchy"
+
+DEFAULT_NEGATIVE_TTL_SECONDS = 60.0
+DEFAULT_MIN_REFRESH_INTERVAL_SECONDS = 10.0
+MAX_NEGATIVE_ENTRIES = 10000
+LOOKUP_FLUSH_SECONDS = 1.0
+DIGEST_MODULUS = 1 << 64
+
+
+ENVIRONMENT_REVISION_PROJECTION = {
+    "environmentId": 1,
+    "metadata.number": 1,
+    "definition.dockerImage": 1,
+    "definition.baseEnvironmentRevisionId": 1,
+}
+PROJECT_PROJECTION = {
+    "overrideV2EnvironmentId": 1,
+    "defaultEnvironmentRevisionSpec": 1,
+}
+
+
+def _env_cache_key(environment_id: ObjectId, version: int) -> Tuple[ObjectId, int]:
+    return _as_object_id(environment_id), version
+
+
+def _as_object_id(value) -> ObjectId:
+    return value if isinstance(value, ObjectId) else ObjectId(value)
+
+
+def _cluster_time(database) -> Optional[Timestamp]:
+    """The cluster time of the replica set, a read started now sees up to it."""
+    command = getattr(database, "command", None)
+    if command is None:
+        # Stand-in databases of the benchmarks
+        return None
+    return command("ping").get("operationTime")
+
+
+def _digest(*values) -> int:
+    """Digest of the fields of one entry, the same in every process.
+
+    The digest of a snapshot is the sum of the ones of its entries, so it
+    only depends on its content and follows each change in constant time.
+    """
+    return int.from_bytes(
+        hashlib.blake2b(repr(values).encode(), digest_size=8).digest(), "little"
+    )
+
+
+def _content_digest(entries) -> int:
+    return sum(entry.digest() for entry in entries) % DIGEST_MODULUS
+
+
+def _changed_digest(digest: int, added=None, removed=None) -> int:
+    """`digest` of a snapshot once `removed` is replaced by `added`."""
+    if added is not None:
+        digest += added.digest()
+    if removed is not None:
+        digest -= removed.digest()
+    return digest % DIGEST_MODULUS
+
+
+def _intern(value, interned: Dict):
+    """Return a shared instance of `value` so repeated ids are stored once."""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return sys.intern(value)
+    return interned.setdefault(value, value)
+
+
+class LookupCounter:
+    """Counts the hits and misses of the lookups of a cache.
+
+    A lookup is a dict read, much cheaper than a Prometheus counter update
+    (a file write in multiprocess mode), so the counts are added to the
+    counters by the first lookup LOOKUP_FLUSH_SECONDS after the last flush,
+    and by `flush()`, which `/metrics` and the worker shutdown call.
+    """
+
+    def __init__(self, name: str):
+        self.hits = 0
+        self.misses = 0
+        self._flushed_hits = 0
+        self._flushed_misses = 0
+        self._flush_at = time.monotonic() + LOOKUP_FLUSH_SECONDS
+        self._lock = threading.Lock()
+        self._hits_counter = CACHE_LOOKUPS.labels(name, "hit")
+        self._misses_counter = CACHE_LOOKUPS.labels(name, "miss")
+
+    def __call__(self, value):
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if time.monotonic() >= self._flush_at:
+            self.flush()
+        return value
+
+    def flush(self):
+        with self._lock:
+            self._flush_at = time.monotonic() + LOOKUP_FLUSH_SECONDS
+            hits = self.hits - self._flushed_hits
+            misses = self.misses - self._flushed_misses
+            self._flushed_hits, self._flushed_misses = self.hits, self.misses
+        if hits:
+            self._hits_counter.inc(hits)
+        if misses:
+            self._misses_counter.inc(misses)
+
+
+class CacheRefresher:
+    """Guards a cache against reload storms caused by lookups of unknown ids.
+
+    Concurrent refreshes are coalesced into a single in-flight reload that the
+    other callers wait for. Keys still missing after a reload are remembered
+    for `negative_ttl_seconds` and do not trigger another reload, and reloads
+    caused by misses are at least `min_refresh_interval_seconds` apart.
+    """
+
+    def __init__(
+        self,
+        load: Callable[[bool], None],
+        negative_ttl_seconds: float = DEFAULT_NEGATIVE_TTL_SECONDS,
+        min_refresh_interval_seconds: float = DEFAULT_MIN_REFRESH_INTERVAL_SECONDS,
+        name: str = "cache",
+    ):
+        self._load = load
+        self.name = name
+        self.negative_ttl_seconds = negative_ttl_seconds
+        self.min_refresh_interval_seconds = min_refresh_interval_seconds
+        self._negative: "OrderedDict[Hashable, float]" = OrderedDict()
+        self._condition = threading.Condition()
+        self._in_flight = False
+        self._completed = 0
+        # Reloads started, and the number of the last one which succeeded
+        self._started = 0
+        self._loaded = 0
+        self._last_refresh: Optional[float] = None
+        self.misses = 0
+        self.negative_hits = 0
+        self.coalesced_waits = 0
+        self.throttled = 0
+        self.reloads = 0
+
+    def refresh(self, on_miss: bool = False):
+        with self._condition:
+            if self._in_flight:
+                self.coalesced_waits += 1
+                CACHE_REFRESHES.labels(self.name, "coalesced").inc()
+                completed = self._completed
+                while self._completed == completed:
+                    self._condition.wait()
+                return
+            if (
+                on_miss
+                and self._last_refresh is not None
+                and time.monotonic() - self._last_refresh
+                < self.min_refresh_interval_seconds
+            ):
+                self.throttled += 1
+                CACHE_REFRESHES.labels(self.name, "throttled").inc()
+                return
+            self._in_flight = True
+            self._started += 1
+            number = self._started
+        start = time.perf_counter()
+        loaded = False
+        try:
+            self._load(on_miss)
+            loaded = True
+        except Exception:
+            CACHE_REFRESHES.labels(self.name, "failed").inc()
+            raise
+        else:
+            CACHE_REFRESHES.labels(self.name, "reload").inc()
+            CACHE_REFRESH_DURATION.labels(self.name).observe(
+                time.perf_counter() - start
+            )
+        finally:
+            with self._condition:
+                if loaded:
+                    self._loaded = number
+                self._in_flight = False
+                self._completed += 1
+                self._last_refresh = time.monotonic()
+                self.reloads += 1
+                self._negative.clear()
+                self._condition.notify_all()
+
+    def get(self, key: Hashable, lookup: Callable[[], Optional[object]]):
+        """Return `lookup()`, reloading the cache at most once if it misses."""
+        value = lookup()
+        if value is not None:
+            return value
+        with self._condition:
+            self.misses += 1
+            expiry = self._negative.get(key)
+            if expiry is not None:
+                if expiry > time.monotonic():
+                    self.negative_hits += 1
+                    CACHE_REFRESHES.labels(self.name, "negative_cached").inc()
+                    return None
+                del self._negative[key]
+            started = self._started
+        try:
+            self.refresh(on_miss=True)
+        except TimeoutError as e:
+            # Not answered in time (shared refresh), served as it is meanwhile
+            logger.warning(str(e))
+            return None
+        value = lookup()
+        if value is None:
+            with self._condition:
+                # Throttled, or only waited for a reload which may have read
+                # the collection before the key was added
+                if self._loaded <= started:
+                    return None
+                self._negative[key] = time.monotonic() + self.negative_ttl_seconds
+                if len(self._negative) > MAX_NEGATIVE_ENTRIES:
+                    self._negative.popitem(last=False)
+        return value
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "misses": self.misses,
+            "negative_hits": self.negative_hits,
+            "coalesced_waits": self.coalesced_waits,
+            "throttled": self.throttled,
+            "reloads": self.reloads,
+            "negative_entries": len(self._negative),
+        }
+
+
+class _PartialRootImages(dict):
+    """Root images resolved again for the `stale` revisions.
+
+    Lookups fall back to the `current` root images of the other revisions, so
+    a walk stops at the first revision which is not stale.
+    """
+
+    def __init__(self, current: Dict, stale: Set[ObjectId]):
+        super().__init__()
+        self.current = current
+        self.stale = stale
+
+    def __contains__(self, key) -> bool:
+        return dict.__contains__(self, key) or (
+            key not in self.stale and key in self.current
+        )
+
+    def __getitem__(self, key):
+        if dict.__contains__(self, key):
+            return dict.__getitem__(self, key)
+        return self.current[key]
+
+
+class EnvironmentRevision:
+    __slots__ = (
+        "_id",
+        "environment_id",
+        "version",
+        "docker_image",
+        "base_environment_revision_id",
+    )
+
+    def __init__(self, revision: dict, interned: Optional[Dict] = None):
+        interned = {} if interned is None else interned
+        self._id = _intern(_as_object_id(revision["_id"]), interned)
+        self.environment_id = _intern(revision["environmentId"], interned)
+        self.version = int(revision["metadata"]["number"])
+        self.docker_image = _intern(revision["definition"].get("dockerImage"), interned)
+        self.base_environment_revision_id = _intern(
+            revision["definition"].get("baseEnvironmentRevisionId"), interned
+        )
+
+    def digest(self) -> int:
+        return _digest(
+            self._id,
+            self.environment_id,
+            self.version,
+            self.docker_image,
+            self.base_environment_revision_id,
+        )
+
+
+class EnvironmentRevisionSnapshot:
+    """One generation of the environment revisions and their derived indexes.
+
+    A snapshot is fully built before it is published, readers holding a
+    reference to it never observe a partially loaded cache.
+    """
+
+    def __init__(self, generation: int):
+        self.generation = generation
+        # Of the content, the same in every worker holding it, see `_digest`
+        self.digest = 0
+        self.cache: Dict[ObjectId, EnvironmentRevision] = {}
+        # environment id -> version -> revision
+        self.by_environment: Dict[ObjectId, Dict[int, EnvironmentRevision]] = {}
+        self.latest_by_environment: Dict[ObjectId, EnvironmentRevision] = {}
+        # revision id -> (root docker image, status message)
+        self.root_images: Dict[ObjectId, Tuple[Optional[str], str]] = {}
+        # Parents referenced by some revision but missing from the cache
+        self.dangling_parents: Set[ObjectId] = set()
+        # revision id -> the revisions without a docker image based on it, the
+        # ones whose root image depends on it
+        self.children: Dict[ObjectId, Set[ObjectId]] = {}
+
+    def try_get_by_environment(
+        self, environment_id: ObjectId, version: int
+    ) -> Optional[EnvironmentRevision]:
+        versions = self.by_environment.get(_as_object_id(environment_id))
+        return None if versions is None else versions.get(version)
+
+    def resolve_root_images(self):
+        """Map every revision to the docker image at the root of its hierarchy.
+
+        Each chain of `baseEnvironmentRevisionId` links is walked at most once:
+        every revision visited on the way is assigned the result of the walk
+        (path compression), so later walks stop at the first resolved revision.
+        Dangling parents and cycles are recorded as status messages.
+        """
+        root_images: Dict[ObjectId, Tuple[Optional[str], str]] = {}
+        dangling_parents: Set[ObjectId] = set()
+        for revision_id in self.cache:
+            self.resolve_root_image(revision_id, root_images, dangling_parents)
+        self.root_images = root_images
+        self.dangling_parents = dangling_parents
+
+    def resolve_root_image(
+        self,
+        revision_id: ObjectId,
+        root_images: Dict[ObjectId, Tuple[Optional[str], str]],
+        dangling_parents: Set[ObjectId],
+    ):
+        path = []
+        on_path = set()
+        current_id = revision_id
+        while True:
+            if current_id in root_images:
+                resolved = root_images[current_id]
+                break
+            if current_id in on_path:
+                resolved = (None, ROOT_IMAGE_CYCLE)
+                break
+            revision = self.cache.get(current_id)
+            if revision is None:
+                resolved = (None, ROOT_IMAGE_NOT_FOUND)
+                dangling_parents.add(current_id)
+                break
+            path.append(current_id)
+            on_path.add(current_id)
+            if revision.docker_image is not None:
+                resolved = (revision.docker_image, ROOT_IMAGE_SUCCESS)
+                break
+            current_id = revision.base_environment_revision_id
+        for path_id in path:
+            root_images[path_id] = resolved
+
+    def descendants(self, revision_id: ObjectId) -> List[ObjectId]:
+        """`revision_id` and the revisions whose hierarchy goes through it."""
+        found = [revision_id]
+        seen = {revision_id}
+        for current_id in found:
+            for child_id in self.children.get(current_id, ()):
+                if child_id not in seen:
+                    seen.add(child_id)
+                    found.append(child_id)
+        return found
+
+    def resolve_descendants(self, revision_id: ObjectId):
+        """Resolve again the root images which depend on `revision_id`.
+
+        The other revisions keep their root image, so a change costs the size
+        of the hierarchy below it rather than of the whole cache. The new root
+        images are published together, readers never see one missing.
+        """
+        stale = self.descendants(revision_id)
+        root_images = _PartialRootImages(self.root_images, set(stale))
+        dangling_parents: Set[ObjectId] = set()
+        for stale_id in stale:
+            if stale_id in self.cache:
+                self.resolve_root_image(stale_id, root_images, dangling_parents)
+        self.root_images.update(dict.items(root_images))
+        if revision_id not in self.cache:
+            self.root_images.pop(revision_id, None)
+        # Dangling again if a revision is still based on it
+        self.dangling_parents.discard(revision_id)
+        self.dangling_parents.update(dangling_parents)
+
+    def _link(self, revision: EnvironmentRevision):
+        base_id = revision.base_environment_revision_id
+        if revision.docker_image is None and base_id is not None:
+            self.children.setdefault(base_id, set()).add(revision._id)
+
+    def _unlink(self, revision: EnvironmentRevision):
+        base_id = revision.base_environment_revision_id
+        children = self.children.get(base_id)
+        if children is None:
+            return
+        children.discard(revision._id)
+        if not children:
+            del self.children[base_id]
+            # No longer referenced by any revision
+            self.dangling_parents.discard(base_id)
+
+    def add(self, revision: EnvironmentRevision):
+        previous = self.cache.get(revision._id)
+        if previous is not None:
+            self._unlink(previous)
+        self._link(revision)
+        self.cache[revision._id] = revision
+        env_key = revision.environment_id
+        self.by_environment.setdefault(env_key, {})[revision.version] = revision
+        latest = self.latest_by_environment.get(env_key)
+        if latest is None or latest.version <= revision.version:
+            self.latest_by_environment[env_key] = revision
+
+    def remove(self, revision_id: ObjectId) -> Optional[EnvironmentRevision]:
+        revision = self.cache.pop(revision_id, None)
+        if revision is None:
+            return None
+        self._unlink(revision)
+        env_key = revision.environment_id
+        versions = self.by_environment.get(env_key, {})
+        versions.pop(revision.version, None)
+        if self.latest_by_environment.get(env_key) is revision:
+            if versions:
+                self.latest_by_environment[env_key] = versions[max(versions)]
+            else:
+                del self.latest_by_environment[env_key]
+                self.by_environment.pop(env_key, None)
+        return revision
+
+
+class CollectionCache:
+    """In-memory cache of a Mongo collection, published as whole snapshots.
+
+    Subclasses set the collection, its projection and the snapshot class,
+    build a snapshot from the documents read (`_build`) and apply the change
+    stream events to the current one.
+    """
+
+    collection_name: str
+    projection: Dict[str, int]
+    snapshot_class: type
+    # Name of the entries in the logs
+    label: str
+
+    def __init__(
+        self,
+        database,
+        negative_ttl_seconds: float = DEFAULT_NEGATIVE_TTL_SECONDS,
+        min_refresh_interval_seconds: float = DEFAULT_MIN_REFRESH_INTERVAL_SECONDS,
+    ):
+        logger.info(f"Initializing {self.label} cache.")
+        self.database = database
+        # Replaced as a whole on every reload, never cleared in place
+        self.snapshot = self.snapshot_class(generation=0)
+        # Disabled while a change stream watcher keeps the cache current
+        self.reload_on_miss = True
+        # Serializes writers (reloads and change stream events), never readers
+        self._lock = threading.RLock()
+        self.refresher = CacheRefresher(
+            self._load,
+            negative_ttl_seconds,
+            min_refresh_interval_seconds,
+            name=type(self).__name__,
+        )
+        self.lookups = LookupCounter(type(self).__name__)
+        self._size = CACHE_SIZE.labels(type(self).__name__)
+        # Position in the collection history the cache is current at, the
+        # cluster time a reload started at or the last change stream event
+        self.cluster_time: Optional[Timestamp] = None
+        self.resume_token: Optional[dict] = None
+        # Set on the followers of a shared refresh, loads from the leader
+        self.shared_refresh: Optional[Callable[[object, bool], None]] = None
+
+    @property
+    def cache(self) -> Dict:
+        return self.snapshot.cache
+
+    @property
+    def generation(self) -> int:
+        return self.snapshot.generation
+
+    def refresh_cache(self):
+        self.refresher.refresh()
+
+    def _build(self, documents: Iterable[dict]):
+        """A new snapshot of `documents`, read with `projection`."""
+        raise NotImplementedError
+
+    def _load(self, on_miss: bool = False):
+        if self.shared_refresh is not None:
+            self.shared_refresh(self, on_miss)
+            return
+        logger.info(f"Refreshing {self.label} cache.")
+        with self._lock:
+            cluster_time = _cluster_time(self.database)
+            collection = self.database.get_collection(self.collection_name)
+            snapshot = self._build(collection.find({}, self.projection))
+            snapshot.digest = _content_digest(snapshot.cache.values())
+            self.restore(snapshot, cluster_time)
+        logger.info(
+            f"Found {len(snapshot.cache)} {self.collection_name.replace('_', ' ')}."
+        )
+
+    def restore(
+        self,
+        snapshot,
+        cluster_time: Optional[Timestamp] = None,
+        resume_token: Optional[dict] = None,
+    ):
+        """Publish a fully built snapshot, current at the position given."""
+        with self._lock:
+            snapshot.generation = self.snapshot.generation + 1
+            self.snapshot = snapshot
+            self.cluster_time, self.resume_token = cluster_time, resume_token
+            self._size.set(len(snapshot.cache))
+
+    def export(self, encode: Callable[[object], object]):
+        """Return `encode(snapshot)`, no change is applied while it runs."""
+        with self._lock:
+            return encode(self.snapshot)
+
+
+class EnvironmentRevisionCache(CollectionCache):
+    collection_name = "environment_revisions"
+    projection = ENVIRONMENT_REVISION_PROJECTION
+    snapshot_class = EnvironmentRevisionSnapshot
+    label = "EnvironmentRevision"
+
+    def get(self, environment_revision_id: ObjectId) -> Optional[EnvironmentRevision]:
+        if not self.reload_on_miss:
+            return self.lookups(self.cache.get(environment_revision_id))
+        return self.lookups(
+            self.refresher.get(
+                environment_revision_id,
+                lambda: self.cache.get(environment_revision_id),
+            )
+        )
+
+    def try_get_by_environment(
+        self, environment_id: ObjectId, version: int
+    ) -> Optional[EnvironmentRevision]:
+        return self.snapshot.try_get_by_environment(environment_id, version)
+
+    def get_by_environment(
+        self, environment_id: ObjectId, version: int
+    ) -> Optional[EnvironmentRevision]:
+        if not self.reload_on_miss:
+            return self.lookups(self.try_get_by_environment(environment_id, version))
+        return self.lookups(
+            self.refresher.get(
+                _env_cache_key(environment_id, version),
+                lambda: self.try_get_by_environment(environment_id, version),
+            )
+        )
+
+    def try_get_latest_by_environment(
+        self, environment_id: ObjectId
+    ) -> Optional[EnvironmentRevision]:
+        return self.lookups(
+            self.snapshot.latest_by_environment.get(_as_object_id(environment_id))
+        )
+
+    def get_root_image(
+        self, revision: EnvironmentRevision
+    ) -> Tuple[Optional[str], str]:
+        return self.snapshot.root_images.get(
+            revision._id, (None, ROOT_IMAGE_NOT_FOUND)
+        )
+
+    def _build(self, documents: Iterable[dict]) -> EnvironmentRevisionSnapshot:
+        snapshot = EnvironmentRevisionSnapshot(0)
+        # Shared ObjectId instances, only kept for the duration of the load
+        interned: Dict[ObjectId, ObjectId] = {}
+        for revision in documents:
+            snapshot.add(EnvironmentRevision(revision, interned))
+        snapshot.resolve_root_images()
+        return snapshot
+
+    def apply_upsert(self, document: dict):
+        """Insert or replace a single revision from a change stream event."""
+        with self._lock:
+            snapshot = self.snapshot
+            revision = EnvironmentRevision(document)
+            previous = snapshot.cache.get(revision._id)
+            if previous is not None and (
+                previous.environment_id != revision.environment_id
+                or previous.version != revision.version
+            ):
+                snapshot.remove(revision._id)
+            # Overwrites the previous entry so readers never see it missing
+            snapshot.add(revision)
+            snapshot.resolve_descendants(revision._id)
+            snapshot.digest = _changed_digest(snapshot.digest, revision, previous)
+            snapshot.generation += 1
+            self._size.set(len(snapshot.cache))
+
+    def apply_delete(self, revision_id: ObjectId):
+        """Remove a single revision from a change stream event."""
+        with self._lock:
+            snapshot = self.snapshot
+            revision = snapshot.remove(revision_id)
+            if revision is None:
+                return
+            snapshot.resolve_descendants(revision_id)
+            snapshot.digest = _changed_digest(snapshot.digest, removed=revision)
+            snapshot.generation += 1
+            self._size.set(len(snapshot.cache))
+
+
+class Project:
+    __slots__ = ("_id", "environment_id", "default_environment_revision_spec")
+
+    def __init__(self, project: dict, interned: Optional[Dict] = None):
+        interned = {} if interned is None else interned
+        self._id = _as_object_id(project["_id"])
+        self.environment_id = _intern(project["overrideV2EnvironmentId"], interned)
+        self.default_environment_revision_spec = _intern(
+            project["defaultEnvironmentRevisionSpec"], interned
+        )
+
+    def digest(self) -> int:
+        return _digest(
+            self._id, self.environment_id, self.default_environment_revision_spec
+        )
+
+
+class ProjectsSnapshot:
+    """One generation of the projects cache, published as a whole."""
+
+    def __init__(self, generation: int):
+        self.generation = generation
+        # Of the content, the same in every worker holding it, see `_digest`
+        self.digest = 0
+        self.cache: Dict[ObjectId, Project] = {}
+
+
+class ProjectsCache(CollectionCache):
+    collection_name = "projects"
+    projection = PROJECT_PROJECTION
+    snapshot_class = ProjectsSnapshot
+    label = "Project"
+
+    def get(self, project_id: ObjectId) -> Optional[Project]:
+        return self.get_by_project(project_id)
+
+    def try_get_by_project(self, project_id: ObjectId) -> Optional[Project]:
+        return self.cache.get(_as_object_id(project_id))
+
+    def get_by_project(self, project_id: ObjectId) -> Optional[Project]:
+        if not self.reload_on_miss:
+            return self.lookups(self.try_get_by_project(project_id))
+        return self.lookups(
+            self.refresher.get(
+                str(project_id), lambda: self.try_get_by_project(project_id)
+            )
+        )
+
+    def _build(self, documents: Iterable[dict]) -> ProjectsSnapshot:
+        snapshot = ProjectsSnapshot(0)
+        # Shared ObjectId instances, only kept for the duration of the load
+        interned: Dict[ObjectId, ObjectId] = {}
+        for document in documents:
+            project = Project(document, interned)
+            snapshot.cache[project._id] = project
+        return snapshot
+
+    def apply_upsert(self, document: dict):
+        """Insert or replace a single project from a change stream event."""
+        with self._lock:
+            project = Project(document)
+            previous = self.snapshot.cache.get(project._id)
+            self.snapshot.cache[project._id] = project
+            self.snapshot.digest = _changed_digest(
+                self.snapshot.digest, project, previous
+            )
+            self.snapshot.generation += 1
+            self._size.set(len(self.snapshot.cache))
+
+    def apply_delete(self, project_id: ObjectId):
+        """Remove a single project from a change stream event."""
+        with self._lock:
+            project = self.snapshot.cache.pop(project_id, None)
+            if project is not None:
+                self.snapshot.digest = _changed_digest(
+                    self.snapshot.digest, removed=project
+                )
+                self.snapshot.generation += 1
+                self._size.set(len(self.snapshot.cache))
@@ -0,0 +1,108 @@
+"""central_config Module.
+
+This module implements a loader for the central config parameters used by
+the workspace auto-shutdown endpoints. All keys are read with a single query
+against the `config` collection and kept in a small TTL cache.
+
+Example:
+    CENTRAL_CONFIG = CentralConfigCache(MONGO_DATABASE, ttl_seconds=60)
+    config = CENTRAL_CONFIG.get()
+    config.global_default_lifetime
+"""
+import logging
+import threading
+import time
+from typing import NamedTuple, Optional
+
+logger = logging.getLogger("extended-api")
+
+CENTRAL_CONFIG_NAMESPACE = "common"
+WKS_AUTO_SHUTDOWN_ENABLED_KEY = "com.cerebro.domino.workspaceAutoShutdown.isEnabled"
+GLOBAL_MAX_LIFETIME_KEY = (
+    "com.cerebro.domino.workspaceAutoShutdown.globalMaximumLifetimeInSeconds"
+)
+GLOBAL_DEFAULT_LIFETIME_KEY = (
+    "com.cerebro.domino.workspaceAutoShutdown.globalDefaultLifetimeInSeconds"
+)
+WKS_NOTIFICATION_ENABLED_KEY = "com.cerebro.domino.workloadNotifications.isEnabled"
+WKS_NOTIFICATION_DURATION_KEY = (
+    "com.cerebro.domino.workloadNotifications.longRunningWorkloadDefinitionInSeconds"
+)
+CENTRAL_CONFIG_KEYS = [
+    WKS_AUTO_SHUTDOWN_ENABLED_KEY,
+    GLOBAL_MAX_LIFETIME_KEY,
+    GLOBAL_DEFAULT_LIFETIME_KEY,
+    WKS_NOTIFICATION_ENABLED_KEY,
+    WKS_NOTIFICATION_DURATION_KEY,
+]
+
+DEFAULT_CENTRAL_CONFIG_TTL_SECONDS = 60.0
+
+
+class CentralConfig(NamedTuple):
+    wks_auto_shutdown_enabled: bool = False
+    global_max_lifetime: int = 0
+    global_default_lifetime: int = 0
+    wks_notification_enabled: bool = False
+    wks_notification_duration: int = 0
+
+
+def _to_bool(value) -> bool:
+    if isinstance(value, str):
+        return value.strip().lower() == "true"
+    return bool(value)
+
+
+def load_central_config(database) -> CentralConfig:
+    values = {
+        document["key"]: document["value"]
+        for document in database["config"].find(
+            {"namespace": CENTRAL_CONFIG_NAMESPACE, "key": {"$in": CENTRAL_CONFIG_KEYS}},
+            {"_id": 0, "key": 1, "value": 1},
+        )
+    }
+    defaults = CentralConfig()
+    return CentralConfig(
+        wks_auto_shutdown_enabled=_to_bool(
+            values.get(WKS_AUTO_SHUTDOWN_ENABLED_KEY, defaults.wks_auto_shutdown_enabled)
+        ),
+        global_max_lifetime=int(
+            values.get(GLOBAL_MAX_LIFETIME_KEY, defaults.global_max_lifetime)
+        ),
+        global_default_lifetime=int(
+            values.get(GLOBAL_DEFAULT_LIFETIME_KEY, defaults.global_default_lifetime)
+        ),
+        wks_notification_enabled=_to_bool(
+            values.get(WKS_NOTIFICATION_ENABLED_KEY, defaults.wks_notification_enabled)
+        ),
+        wks_notification_duration=int(
+            values.get(WKS_NOTIFICATION_DURATION_KEY, defaults.wks_notification_duration)
+        ),
+    )
+
+
+class CentralConfigCache:
+    def __init__(
+        self, database, ttl_seconds: float = DEFAULT_CENTRAL_CONFIG_TTL_SECONDS
+    ):
+        self.database = database
+        self.ttl_seconds = ttl_seconds
+        self._config: Optional[CentralConfig] = None
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+
+    def get(self) -> CentralConfig:
+        config = self._config
+        if config is not None and time.monotonic() < self._expires_at:
+            return config
+        with self._lock:
+            if self._config is None or time.monotonic() >= self._expires_at:
+                self._config = load_central_config(self.database)
+                self._expires_at = time.monotonic() + self.ttl_seconds
+                logger.info(f"Loaded central config {self._config}")
+            return self._config
+
+    def invalidate(self):
+        with self._lock:
+            self._config = None
+            self._expires_at = 0.0
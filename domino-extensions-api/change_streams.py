@@ -0,0 +1,249 @@
+"""change_streams Module.
+
+This module implements a background watcher which keeps a cache current by
+consuming the MongoDB change stream of the collection it was loaded from.
+Inserts, updates and deletes are applied to the cache in place. The cache is
+only fully reloaded when the watcher starts without a position to resume from
+(a cache restored from a snapshot has one), or when that position can no
+longer be used (the oplog rolled past it).
+
+Example:
+    watcher = CacheChangeStreamWatcher(
+        PROJECTS_CACHE, MONGO_DATABASE.get_collection("projects")
+    )
+    watcher.start()
+"""
+import logging
+import threading
+from typing import Callable, Optional
+
+from bson.timestamp import Timestamp
+from pymongo.errors import OperationFailure  # type: ignore
+
+logger = logging.getLogger("extended-api")
+
+# Server error codes meaning the resume token cannot be used anymore
+CHANGE_STREAM_HISTORY_LOST = 286
+CHANGE_STREAM_FATAL_ERROR = 280
+INVALID_RESUME_TOKEN = 260
+RESUME_TOKEN_LOST_CODES = (
+    CHANGE_STREAM_HISTORY_LOST,
+    CHANGE_STREAM_FATAL_ERROR,
+    INVALID_RESUME_TOKEN,
+)
+
+UPSERT_OPERATIONS = ("insert", "update", "replace")
+DELETE_OPERATIONS = ("delete",)
+INVALIDATE_OPERATIONS = ("invalidate", "drop", "rename", "dropDatabase")
+
+
+def apply_change(cache, change: dict) -> bool:
+    """Apply one change stream event to the cache.
+
+    Returns False when the event invalidates the stream and the cache must
+    be reloaded from scratch.
+    """
+    operation = change["operationType"]
+    if operation in UPSERT_OPERATIONS:
+        document = change.get("fullDocument")
+        if document is None:
+            # Deleted again before the update lookup ran, a delete event follows
+            return True
+        cache.apply_upsert(document)
+    elif operation in DELETE_OPERATIONS:
+        cache.apply_delete(change["documentKey"]["_id"])
+    elif operation in INVALIDATE_OPERATIONS:
+        return False
+    return True
+
+
+class CacheChangeStreamWatcher:
+    def __init__(
+        self,
+        cache,
+        collection,
+        max_await_time_ms: int = 1000,
+        retry_backoff_seconds: float = 1.0,
+        max_retry_backoff_seconds: float = 30.0,
+        resume_token: Optional[dict] = None,
+        start_at_operation_time: Optional[Timestamp] = None,
+    ):
+        self.cache = cache
+        self.collection = collection
+        self.max_await_time_ms = max_await_time_ms
+        self.retry_backoff_seconds = retry_backoff_seconds
+        self.max_retry_backoff_seconds = max_retry_backoff_seconds
+        self.resume_token = resume_token
+        # Used until the stream returns a resume token
+        self.start_at_operation_time = start_at_operation_time
+        self.full_reloads = 0
+        self.applied_changes = 0
+        # Set once the cache is loaded, or resumed from its position
+        self.loaded = threading.Event()
+        # Held while a change is applied, or the cache replaced by `restore`
+        self._lock = threading.Lock()
+        self._restart = False
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self.run,
+            name=f"change-stream-{self.collection.name}",
+            daemon=True,
+        )
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None):
+        """Stop following the stream, waiting at most `timeout` seconds."""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                # In a full reload, or waiting for the leader to answer one
+                logger.warning(
+                    f"Change stream watcher of {self.collection.name} still "
+                    f"running after {timeout} s, not waiting for it"
+                )
+            self._thread = None
+
+    def restore(self, load: Callable[[], bool]) -> bool:
+        """Replace the cache with `load` and follow the stream from its position.
+
+        `load` restores the cache from a snapshot taken elsewhere, and returns
+        whether it did. No change is applied meanwhile, and the stream is then
+        reopened from the position of the snapshot, so the changes made since
+        it was taken are applied again rather than lost.
+        """
+        with self._lock:
+            if not load():
+                return False
+            if self.cache.resume_token is not None or self.cache.cluster_time is not None:
+                # Without a position (stand-in databases) the stream goes on
+                self.resume_token = self.cache.resume_token
+                self.start_at_operation_time = self.cache.cluster_time
+                self._restart = True
+            return True
+
+    def _pipeline(self):
+        # Only ship the fields the cache entries are built from
+        projection = getattr(self.cache, "projection", None)
+        if not projection:
+            return None
+        fields = {
+            "operationType": 1,
+            "documentKey": 1,
+            "clusterTime": 1,
+            "fullDocument._id": 1,
+        }
+        for field in projection:
+            fields[f"fullDocument.{field}"] = 1
+        return [{"$project": fields}]
+
+    def _open_stream(self):
+        return self.collection.watch(
+            pipeline=self._pipeline(),
+            full_document="updateLookup",
+            resume_after=self.resume_token,
+            start_at_operation_time=(
+                self.start_at_operation_time if self.resume_token is None else None
+            ),
+            max_await_time_ms=self.max_await_time_ms,
+        )
+
+    def _advance(self, stream, change: Optional[dict] = None):
+        """Record the position of the stream, on the cache as well."""
+        self.resume_token = stream.resume_token
+        if self.resume_token is not None:
+            self.start_at_operation_time = None
+        self.cache.resume_token = self.resume_token
+        if change is not None and change.get("clusterTime") is not None:
+            self.cache.cluster_time = change["clusterTime"]
+
+    def _reload(self, stream):
+        # The stream is opened before the reload so that no change made while
+        # reading the collection is lost. Replaying such a change is harmless.
+        self.cache.refresh_cache()
+        self.full_reloads += 1
+        with self._lock:
+            if not self._restart:
+                self._advance(stream)
+        self.loaded.set()
+
+    def run(self):
+        backoff = self.retry_backoff_seconds
+        while not self._stop_event.is_set():
+            with self._lock:
+                self._restart = False
+            try:
+                with self._open_stream() as stream:
+                    if (
+                        self.resume_token is None
+                        and self.start_at_operation_time is None
+                    ):
+                        self._reload(stream)
+                    else:
+                        self.loaded.set()
+                    self.cache.reload_on_miss = False
+                    backoff = self.retry_backoff_seconds
+                    self._consume(stream)
+            except OperationFailure as e:
+                if e.code in RESUME_TOKEN_LOST_CODES:
+                    logger.warning(
+                        f"Resume token lost for {self.collection.name}, reloading cache"
+                    )
+                    self.resume_token = None
+                    self.start_at_operation_time = None
+                else:
+                    logger.exception(e)
+                    backoff = self._sleep(backoff)
+            except Exception as e:
+                # Not only Mongo errors: a reload can wait for the leader
+                # (TimeoutError) or fail on the Kubernetes API (ApiException),
+                # the watcher must outlive them or the cache is never loaded
+                logger.exception(e)
+                backoff = self._sleep(backoff)
+            finally:
+                self.cache.reload_on_miss = True
+
+    def _consume(self, stream):
+        while not self._stop_event.is_set() and stream.alive:
+            change = stream.try_next()
+            with self._lock:
+                if self._restart:
+                    # Restored meanwhile, reopened from the restored position
+                    return
+                if change is None:
+                    # Idle, keep the post batch resume token current
+                    self._advance(stream)
+                    continue
+                if not apply_change(self.cache, change):
+                    logger.warning(
+                        f"Change stream on {self.collection.name} invalidated by "
+                        f"{change['operationType']}, reloading cache"
+                    )
+                    self.resume_token = None
+                    self.start_at_operation_time = None
+                    return
+                self.applied_changes += 1
+                self._advance(stream, change)
+
+    def _sleep(self, backoff: float) -> float:
+        self._stop_event.wait(backoff)
+        return min(backoff * 2, self.max_retry_backoff_seconds)
+
+
+def start_cache_watchers(database, environment_revision_cache, projects_cache):
+    # Caches restored from a snapshot resume from where it was taken
+    watchers = [
+        CacheChangeStreamWatcher(
+            cache,
+            database.get_collection(cache.collection_name),
+            resume_token=cache.resume_token,
+            start_at_operation_time=cache.cluster_time,
+        )
+        for cache in (environment_revision_cache, projects_cache)
+    ]
+    for watcher in watchers:
+        watcher.start()
+    return watchers
@@ -0,0 +1,128 @@
+"""conditional Module.
+
+This module implements the conditional GETs of the enriched listings. The
+ETag of a listing is made of the validator of the cache its elements are
+enriched from (the digest of its content, see `cache_validator`) and of
+the upstream response: the ETag nucleus sent with it, or a hash of its body
+when nucleus sent none. A request whose `If-None-Match`
+holds the current ETag is answered with 304, without enriching nor
+serializing the listing. When the tag carries a nucleus ETag and the cache
+validator is unchanged, the condition is forwarded to nucleus, and a 304
+from nucleus is passed on without the listing being downloaded at all.
+
+Example:
+    if_none_match = request.headers.get(IF_NONE_MATCH_HEADER)
+    validator = cache_validator(cache)
+    condition = upstream_condition(if_none_match, validator)
+    resp = NUCLEUS_CLIENT.get(path, headers=with_condition(headers, condition))
+    etag = listing_etag(resp, validator, condition)
+    if resp.status_code == 304 or not_modified(if_none_match, etag):
+        return Response(status=304, headers={ETAG_HEADER: etag})
+"""
+import base64
+import binascii
+import hashlib
+import string
+from typing import Dict, Iterator, Optional, Tuple
+
+ETAG_HEADER = "ETag"
+IF_NONE_MATCH_HEADER = "If-None-Match"
+NOT_MODIFIED = 304
+# Kind of the upstream part of a tag
+NUCLEUS_ETAG = "n"
+BODY_HASH = "h"
+VALIDATOR_LENGTH = 16
+
+
+def _opaque_tags(if_none_match: Optional[str]) -> Iterator[str]:
+    """The tags of an `If-None-Match` header, without `W/` nor quotes."""
+    for tag in (if_none_match or "").split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        yield tag.strip('"')
+
+
+def cache_validator(cache) -> str:
+    """Validator of the content of `cache`.
+
+    The generations count the loads of each worker, the digest of the content
+    is the same in every worker holding it: a tag from one worker stays valid
+    on the others.
+    """
+    return f"{cache.snapshot.digest:0{VALIDATOR_LENGTH}x}"
+
+
+def _parse(tag: str) -> Optional[Tuple[str, str, str]]:
+    """(validator, kind, upstream part) of one of our tags, None otherwise."""
+    validator, _, upstream = tag.partition("-")
+    if (
+        len(validator) != VALIDATOR_LENGTH
+        or validator.strip(string.hexdigits)
+        or upstream[:1] not in (NUCLEUS_ETAG, BODY_HASH)
+    ):
+        return None
+    return validator, upstream[:1], upstream[1:]
+
+
+def _encode(upstream_etag: str) -> str:
+    return base64.urlsafe_b64encode(upstream_etag.encode("utf-8")).decode().rstrip("=")
+
+
+def _decode(encoded: str) -> Optional[str]:
+    try:
+        padding = "=" * (-len(encoded) % 4)
+        return base64.urlsafe_b64decode(encoded + padding).decode("utf-8")
+    except (binascii.Error, UnicodeDecodeError):
+        return None
+
+
+def listing_etag(resp, validator: str, condition: Optional[str] = None) -> str:
+    """ETag of the listing enriched at cache `validator` from `resp`.
+
+    `resp` is a requests or httpx response of nucleus, answering a request
+    sent with the `If-None-Match: condition` header when `condition` is set.
+    The tag is weak, the body is equivalent but not byte for byte the same
+    across versions of the service.
+    """
+    upstream_etag = resp.headers.get(ETAG_HEADER)
+    if resp.status_code == NOT_MODIFIED:
+        upstream_etag = upstream_etag or condition
+    if upstream_etag:
+        upstream = NUCLEUS_ETAG + _encode(upstream_etag)
+    else:
+        upstream = BODY_HASH + hashlib.blake2b(resp.content, digest_size=16).hexdigest()
+    return f'W/"{validator}-{upstream}"'
+
+
+def upstream_condition(if_none_match: Optional[str], validator: str) -> Optional[str]:
+    """The `If-None-Match` to send to nucleus, None when there is nothing to ask.
+
+    Only the tags of listings enriched at cache `validator` from a response with
+    a nucleus ETag can be checked by nucleus, a 304 for any other would not
+    mean the enriched listing is unchanged.
+    """
+    for tag in _opaque_tags(if_none_match):
+        parsed = _parse(tag)
+        if parsed is not None and parsed[:2] == (validator, NUCLEUS_ETAG):
+            upstream_etag = _decode(parsed[2])
+            if upstream_etag:
+                return upstream_etag
+    return None
+
+
+def with_condition(headers: Dict, condition: Optional[str]) -> Dict:
+    """`headers` for nucleus, with the `If-None-Match` of `condition`."""
+    if condition is None:
+        return headers
+    return dict(headers, **{IF_NONE_MATCH_HEADER: condition})
+
+
+def not_modified(if_none_match: Optional[str], etag: str) -> bool:
+    """Whether `If-None-Match` holds `etag`, weak comparison as for GETs."""
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    current = next(_opaque_tags(etag))
+    return any(tag == current for tag in _opaque_tags(if_none_match))
@@ -13,25 +13,14 @@ Example:
 
 import os
 import logging
-from kubernetes import client, config
-from kubernetes.client import ApiClient, CustomObjectsApi
 import base64
 import json
 from typing import Tuple, Dict
 
-logger = logging.getLogger(__name__)
+from k8s import get_core_v1_api
 
-try:
-    config.load_incluster_config()
-except config.ConfigException:
-    try:
-        config.load_kube_config()
-    except config.ConfigException:
-        raise Exception("Could not configure kubernetes python client")
+logger = logging.getLogger(__name__)
 
-k8s_api_client: ApiClient = client.ApiClient()
-k8s_api: CustomObjectsApi = client.CustomObjectsApi(k8s_api_client)
-api_instance = client.CoreV1Api(k8s_api_client)
 DEFAULT_PLATFORM_NAMESPACE = "domino-platform"
 DEFAULT_SYSTEM_NAMESPACE = "domino-system"
 DEFAULT_SYSTEM_FIELD = "domino-field"
@@ -97,7 +86,7 @@ class MongoDBDetails:
 
 def get_domino_creds_from_secret():
     try:
-        api_response = api_instance.read_namespaced_secret(
+        api_response = get_core_v1_api().read_namespaced_secret(
             credential_store_name, system_namespace
         )
         cred_data_bytes = base64.b64decode(api_response.data["credentials"])
@@ -11,17 +11,21 @@ Example:
 
 from flask import request, Response, Blueprint  # type: ignore
 import logging
-from kubernetes import client, config
-from kubernetes.client import ApiClient, CustomObjectsApi
-
 import os
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import yaml
+from kubernetes.client.rest import ApiException
+
+from k8s import get_custom_objects_api
+from mutation_informer import MutationInformer
 import utils
 
 domsed_api = Blueprint("domsed_api", __name__)
 
 DEFAULT_PLATFORM_NAMESPACE = "domino-platform"
-k8s_api_client = None
-k8s_api = None
 group = "apps.dominodatalab.com"
 version = "v1alpha1"
 platform_namespace = ""
@@ -36,21 +40,124 @@ logging.basicConfig(
 logger = logging.getLogger("extendedapi_server_domsed")
 logger.setLevel(logging.WARNING)
 
-try:
-    config.load_incluster_config()
-except config.ConfigException:
-    try:
-        config.load_kube_config()
-    except config.ConfigException:
-        raise Exception("Could not configure kubernetes python client")
-
-k8s_api_client: ApiClient = client.ApiClient()
-k8s_api: CustomObjectsApi = client.CustomObjectsApi(k8s_api_client)
-
 platform_namespace: str = os.environ.get(
     "PLATFORM_NAMESPACE", DEFAULT_PLATFORM_NAMESPACE
 )
 debug: bool = os.environ.get("FLASK_ENV") == "development"
+MUTATION_INFORMER_ENABLED: bool = (
+    os.environ.get("MUTATION_INFORMER_ENABLED", "true").lower() == "true"
+)
+MUTATION_WATCH_TIMEOUT_SECONDS: int = int(
+    os.environ.get("MUTATION_WATCH_TIMEOUT_SECONDS", "300")
+)
+MUTATION_INFORMER: Optional[MutationInformer] = None
+
+APPLY_CREATED = "created"
+APPLY_UPDATED = "updated"
+APPLY_UNCHANGED = "unchanged"
+APPLY_MAX_CONFLICT_RETRIES = 3
+MUTATION_BATCH_CONCURRENCY: int = int(
+    os.environ.get("MUTATION_BATCH_CONCURRENCY", "8")
+)
+MUTATION_BATCH_MAX_ITEMS: int = int(os.environ.get("MUTATION_BATCH_MAX_ITEMS", "1000"))
+YAML_CONTENT_TYPES = ("application/yaml", "application/x-yaml", "text/yaml")
+
+
+def start_mutation_informer() -> MutationInformer:
+    global MUTATION_INFORMER
+    if MUTATION_INFORMER is None:
+        MUTATION_INFORMER = MutationInformer(
+            platform_namespace, watch_timeout_seconds=MUTATION_WATCH_TIMEOUT_SECONDS
+        )
+        MUTATION_INFORMER.start()
+    return MUTATION_INFORMER
+
+
+def stop_mutation_informer():
+    global MUTATION_INFORMER
+    if MUTATION_INFORMER is not None:
+        MUTATION_INFORMER.stop()
+        MUTATION_INFORMER = None
+
+
+def _synced_informer() -> Optional[MutationInformer]:
+    # Until the first list is in, reads go to the API server
+    if MUTATION_INFORMER is not None and MUTATION_INFORMER.synced.is_set():
+        return MUTATION_INFORMER
+    return None
+
+
+def _read_mutation(name: str, use_informer: bool = True) -> Optional[Dict]:
+    informer = _synced_informer() if use_informer else None
+    if informer is not None:
+        return informer.get(name)
+    try:
+        return get_custom_objects_api().get_namespaced_custom_object(
+            group, version, platform_namespace, plural, name
+        )
+    except ApiException as e:
+        if e.status == 404:
+            return None
+        raise
+
+
+def _desired_state(mutation: Dict) -> Tuple:
+    # What an apply sets: everything but the server managed metadata
+    metadata = mutation.get("metadata") or {}
+    return (
+        {k: v for k, v in mutation.items() if k not in ("metadata", "status")},
+        metadata.get("labels") or {},
+        metadata.get("annotations") or {},
+    )
+
+
+def apply_mutation_object(mutation: Dict) -> Tuple[str, Dict]:
+    """Create the mutation, or replace it if it differs from the current one.
+
+    Replacing sends the resourceVersion that was compared, so a concurrent
+    change makes the API server answer 409 and the apply is retried on the
+    fresh object. An unchanged mutation is not written at all.
+    """
+    name = mutation["metadata"]["name"]
+    api = get_custom_objects_api()
+    existing = _read_mutation(name)
+    for _ in range(APPLY_MAX_CONFLICT_RETRIES + 1):
+        if existing is None:
+            try:
+                out = api.create_namespaced_custom_object(
+                    group, version, platform_namespace, plural, mutation
+                )
+                result = APPLY_CREATED
+            except ApiException as e:
+                if e.status != 409:
+                    raise
+                out = None
+        elif _desired_state(existing) == _desired_state(mutation):
+            return APPLY_UNCHANGED, existing
+        else:
+            desired = dict(
+                mutation,
+                metadata=dict(
+                    mutation["metadata"],
+                    resourceVersion=existing["metadata"]["resourceVersion"],
+                ),
+            )
+            try:
+                out = api.replace_namespaced_custom_object(
+                    group, version, platform_namespace, plural, name, desired
+                )
+                result = APPLY_UPDATED
+            except ApiException as e:
+                if e.status not in (404, 409):
+                    raise
+                out = None
+        if out is not None:
+            if MUTATION_INFORMER is not None:
+                MUTATION_INFORMER.store(out)
+            return result, out
+        # Changed since it was read, start over from the API server's copy
+        existing = _read_mutation(name, use_informer=False)
+    raise Exception(f"Mutation {name} kept changing while being applied")
 
 
 @domsed_api.route("/mutation/apply", methods=["POST"])
@@ -59,18 +166,9 @@ def apply_mutation() -> object:
         mutation = request.get_json()
         logging.warning(mutation)
         if utils.is_user_authorized(utils.get_headers(request.headers)):
-
-            logging.warning(
-                "First Delete before apply mutation if it exists:"
-                + mutation["metadata"]["name"]
-            )
-            delete_mutation(mutation["metadata"]["name"])
-
-            out: object = k8s_api.create_namespaced_custom_object(
-                group, version, platform_namespace, plural, mutation
-            )
-            logging.warning("Mutation Added :" + mutation["metadata"]["name"])
-            return out
+            result, out = apply_mutation_object(mutation)
+            logging.warning(f"Mutation {result} :" + mutation["metadata"]["name"])
+            return {"result": result, "mutation": out}
         else:
             return Response(
                 "Unauthorized to apply mutations because not an admin",
@@ -82,6 +180,102 @@ def apply_mutation() -> object:
             f"Mutation {mutation['metadata']['name']} \
                        failed to apply"
         )
+        return Response(str(e), 500)
+
+
+def _batch_mutations() -> List:
+    """The mutations of a batch body: a JSON list, a JSON object with `items`
+    (as returned by /mutation/list) or a multi-document YAML."""
+    if request.mimetype in YAML_CONTENT_TYPES:
+        documents = [d for d in yaml.safe_load_all(request.get_data()) if d]
+        if len(documents) == 1 and isinstance(documents[0], (list, dict)):
+            documents = documents[0]
+    else:
+        documents = request.get_json(force=True)
+    if isinstance(documents, dict):
+        documents = documents.get("items")
+    if not isinstance(documents, list):
+        raise ValueError("Expected a list of mutations")
+    return documents
+
+
+def _batch_item_name(mutation) -> Optional[str]:
+    if isinstance(mutation, dict) and isinstance(mutation.get("metadata"), dict):
+        return mutation["metadata"].get("name")
+    return None
+
+
+def _apply_batch_item(mutation: Dict) -> Dict:
+    name = mutation["metadata"]["name"]
+    try:
+        result, out = apply_mutation_object(mutation)
+    except ApiException as e:
+        logger.warning(f"Mutation {name} failed to apply: {e.status} {e.reason}")
+        return {"name": name, "status": e.status, "error": e.reason}
+    except Exception as e:
+        logger.exception(e)
+        return {"name": name, "status": 500, "error": str(e)}
+    logging.warning(f"Mutation {result} :" + name)
+    return {
+        "name": name,
+        "status": 200,
+        "result": result,
+        "resourceVersion": out["metadata"].get("resourceVersion"),
+    }
+
+
+@domsed_api.route("/mutation/apply/batch", methods=["POST"])
+def apply_mutations() -> object:
+    try:
+        if not utils.is_user_authorized(utils.get_headers(request.headers)):
+            return Response(
+                "Unauthorized to apply mutations because not an admin",
+                403,
+            )
+        try:
+            mutations = _batch_mutations()
+        except (ValueError, yaml.YAMLError) as e:
+            return Response(f"Invalid batch of mutations: {e}", 400)
+        if len(mutations) > MUTATION_BATCH_MAX_ITEMS:
+            return Response(
+                f"At most {MUTATION_BATCH_MAX_ITEMS} mutations per batch", 413
+            )
+
+        names = [_batch_item_name(mutation) for mutation in mutations]
+        occurrences = Counter(names)
+        results: List[Optional[Dict]] = [None] * len(mutations)
+        valid: List[int] = []
+        for i, name in enumerate(names):
+            if not name:
+                results[i] = {"name": None, "status": 400, "error": "No metadata.name"}
+            elif occurrences[name] > 1:
+                # Applied concurrently, the last one to land would win
+                results[i] = {
+                    "name": name,
+                    "status": 400,
+                    "error": "Appears more than once in the batch",
+                }
+            else:
+                valid.append(i)
+
+        with ThreadPoolExecutor(
+            max_workers=max(1, min(MUTATION_BATCH_CONCURRENCY, len(valid)))
+        ) as executor:
+            for i, result in zip(
+                valid, executor.map(_apply_batch_item, [mutations[i] for i in valid])
+            ):
+                results[i] = result
+
+        failed = sum(1 for result in results if result["status"] != 200)
+        return {
+            "applied": len(results) - failed,
+            "failed": failed,
+            "items": results,
+        }
+    except Exception as e:
+        logger.exception(e)
+        logger.warning("Failed to apply the batch of mutations")
+        return Response(str(e), 500)
 
 
 @domsed_api.route("/mutation/<name>", methods=["DELETE"])
@@ -89,13 +283,23 @@ def delete_mutation(name: str) -> object:
     try:
         logger.warning(request.headers)
         if utils.is_user_authorized(utils.get_headers(request.headers)):
-            out = k8s_api.get_namespaced_custom_object(
-                group, version, platform_namespace, plural, name
-            )
+            informer = _synced_informer()
+            if informer is not None:
+                out = informer.get(name)
+            else:
+                out = get_custom_objects_api().get_namespaced_custom_object(
+                    group, version, platform_namespace, plural, name
+                )
             if out:
-                out: object = k8s_api.delete_namespaced_custom_object(
+                resource_version = out["metadata"]["resourceVersion"]
+                out: object = get_custom_objects_api().delete_namespaced_custom_object(
                     group, version, platform_namespace, plural, name
                 )
+                if MUTATION_INFORMER is not None:
+                    # The deleted object when returned, a Status otherwise
+                    if out.get("kind") != "Status":
+                        resource_version = out["metadata"]["resourceVersion"]
+                    MUTATION_INFORMER.forget(name, resource_version)
                 logging.info(out)
                 logging.info("Mutation Delete :" + name)
             return out
@@ -114,9 +318,15 @@ def get_mutation(name: str) -> object:
     try:
         logger.warning(request.headers)
         if utils.is_user_authorized(utils.get_headers(request.headers)):
-            out: object = k8s_api.get_namespaced_custom_object(
-                group, version, platform_namespace, plural, name
-            )
+            informer = _synced_informer()
+            if informer is not None:
+                out = informer.get(name)
+                if out is None:
+                    return Response(f"Mutation {name} not found", 404)
+            else:
+                out = get_custom_objects_api().get_namespaced_custom_object(
+                    group, version, platform_namespace, plural, name
+                )
             logging.info(out)
             logging.info("Mutation Get :" + name)
             return out
@@ -136,7 +346,10 @@ def list_mutations():
     try:
         logger.warning(request.headers)
         if utils.is_user_authorized(utils.get_headers(request.headers)):
-            return k8s_api.list_namespaced_custom_object(
+            informer = _synced_informer()
+            if informer is not None:
+                return informer.list()
+            return get_custom_objects_api().list_namespaced_custom_object(
                 group, version, platform_namespace, plural
             )
         else:
@@ -0,0 +1,66 @@
+"""gunicorn configuration Module.
+
+This module configures the production server: gunicorn with threaded
+(`gthread`) workers serving the Flask app, or with `SERVER_MODE=async`
+uvicorn workers serving the asyncio app of `async_api`. Each worker builds its
+own Mongo connection, caches and change stream watchers once it has been
+forked, so the application is not preloaded in the master process.
+
+The workers share their Prometheus metrics through files in
+PROMETHEUS_MULTIPROC_DIR, emptied when the server starts.
+
+Example:
+    gunicorn --config gunicorn.conf.py
+"""
+import os
+import shutil
+
+SERVER_MODE = os.environ.get("SERVER_MODE", "sync").lower()
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:5000")
+if SERVER_MODE == "async":
+    wsgi_app = "async_api:app"
+    worker_class = "uvicorn.workers.UvicornWorker"
+else:
+    wsgi_app = "api:app"
+    worker_class = "gthread"
+workers = int(os.environ.get("GUNICORN_WORKERS", "2"))
+threads = int(os.environ.get("GUNICORN_THREADS", "8"))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT_SECONDS", "120"))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT_SECONDS", "30"))
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE_SECONDS", "5"))
+# Clients, caches and watcher threads must be created after the fork
+preload_app = False
+accesslog = "-" if os.environ.get("GUNICORN_ACCESS_LOG", "false") == "true" else None
+errorlog = "-"
+loglevel = os.environ.get("LOG_LEVEL", "WARNING").lower()
+# Read by prometheus_client when a worker imports it, so set before the fork
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/extended-api-metrics")
+
+
+def on_starting(server):
+    metrics_dir = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    # Samples of a previous run would be added to the new ones
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir)
+
+
+def post_worker_init(worker):
+    import api
+
+    api.configure_logging()
+    api.init_worker()
+    worker.log.info(f"Worker {worker.pid} initialized its caches")
+
+
+def worker_exit(server, worker):
+    import api
+
+    api.shutdown_worker()
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    # Drops the live gauges of the worker, its counters are kept
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,79 @@
+"""k8s Module.
+
+This module implements the Kubernetes API clients shared by the service. The
+kube config is loaded and the clients are built the first time one of them
+is requested, not when a module is imported, so the modules can be imported
+without a cluster and a slow API server does not delay the process start.
+
+Example:
+    from k8s import get_custom_objects_api
+
+    get_custom_objects_api().list_namespaced_custom_object(...)
+"""
+import logging
+import os
+import threading
+from typing import Optional
+
+from kubernetes import client, config
+from kubernetes.client import ApiClient, CoordinationV1Api, CoreV1Api, CustomObjectsApi
+
+from metrics import UPSTREAM_DURATION, UPSTREAM_ERRORS
+
+logger = logging.getLogger("extended-api")
+
+# Requests to the API server in flight at once, e.g. a batch of mutations
+K8S_CONNECTION_POOL_SIZE: int = int(os.environ.get("K8S_CONNECTION_POOL_SIZE", "16"))
+
+_lock = threading.Lock()
+_api_client: Optional[ApiClient] = None
+
+
+class TimedApiClient(ApiClient):
+    """ApiClient observing the duration of every call to the API server.
+
+    A watch is observed once its response headers are in, not for as long as
+    it streams events.
+    """
+
+    def request(self, method, url, *args, **kwargs):
+        with UPSTREAM_DURATION.labels("kubernetes", method).time():
+            try:
+                return super().request(method, url, *args, **kwargs)
+            except Exception:
+                UPSTREAM_ERRORS.labels("kubernetes", method).inc()
+                raise
+
+
+def load_config():
+    try:
+        config.load_incluster_config()
+    except config.ConfigException:
+        try:
+            config.load_kube_config()
+        except config.ConfigException:
+            raise Exception("Could not configure kubernetes python client")
+
+
+def get_api_client() -> ApiClient:
+    global _api_client
+    if _api_client is None:
+        with _lock:
+            if _api_client is None:
+                load_config()
+                configuration = client.Configuration.get_default_copy()
+                configuration.connection_pool_maxsize = K8S_CONNECTION_POOL_SIZE
+                _api_client = TimedApiClient(configuration)
+    return _api_client
+
+
+def get_custom_objects_api() -> CustomObjectsApi:
+    return client.CustomObjectsApi(get_api_client())
+
+
+def get_core_v1_api() -> CoreV1Api:
+    return client.CoreV1Api(get_api_client())
+
+
+def get_coordination_v1_api() -> CoordinationV1Api:
+    return client.CoordinationV1Api(get_api_client())
@@ -0,0 +1,158 @@
+"""metrics Module.
+
+This module implements the Prometheus metrics of the service: request
+latency per route, latency of the calls to nucleus, Mongo and the Kubernetes
+API, the state of the caches and the bulk writes. `/metrics` exposes them in
+the Prometheus text format.
+
+Under gunicorn every worker is a process of its own. With
+`PROMETHEUS_MULTIPROC_DIR` set (gunicorn.conf.py does it), the workers write
+their samples to files in that folder and `/metrics` aggregates the files of
+all the workers, whichever worker answers the scrape.
+
+Example:
+    metrics.instrument_flask(app)
+    with metrics.UPSTREAM_DURATION.labels("nucleus", "GET").time():
+        ...
+"""
+import os
+import time
+from typing import Tuple
+
+from flask import Flask, g, request  # type: ignore
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from pymongo import monitoring  # type: ignore
+
+NAMESPACE = "extended_api"
+UNMATCHED_ROUTE = "unmatched"
+
+# Seconds, from a cached lookup to an `all=true` listing of many pages
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+# Cache reloads read whole collections
+REFRESH_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+REQUEST_DURATION = Histogram(
+    "request_duration_seconds",
+    "Time to serve a request, until the last byte of the response",
+    ["method", "route", "status"],
+    namespace=NAMESPACE,
+    buckets=LATENCY_BUCKETS,
+)
+UPSTREAM_DURATION = Histogram(
+    "upstream_duration_seconds",
+    "Time of a call to nucleus, Mongo or the Kubernetes API",
+    ["upstream", "operation"],
+    namespace=NAMESPACE,
+    buckets=LATENCY_BUCKETS,
+)
+UPSTREAM_ERRORS = Counter(
+    "upstream_errors_total",
+    "Calls to nucleus, Mongo or the Kubernetes API which failed",
+    ["upstream", "operation"],
+    namespace=NAMESPACE,
+)
+CACHE_SIZE = Gauge(
+    "cache_size",
+    "Entries in a cache",
+    ["cache"],
+    namespace=NAMESPACE,
+    multiprocess_mode="livemax",
+)
+CACHE_LOOKUPS = Counter(
+    "cache_lookups_total",
+    "Cache lookups by result (hit or miss)",
+    ["cache", "result"],
+    namespace=NAMESPACE,
+)
+CACHE_REFRESHES = Counter(
+    "cache_refreshes_total",
+    "Cache refresh requests by outcome "
+    "(reload, failed, coalesced, throttled or negative_cached)",
+    ["cache", "result"],
+    namespace=NAMESPACE,
+)
+CACHE_REFRESH_DURATION = Histogram(
+    "cache_refresh_duration_seconds",
+    "Time to reload a cache from Mongo",
+    ["cache"],
+    namespace=NAMESPACE,
+    buckets=REFRESH_BUCKETS,
+)
+BULK_WRITE_DOCUMENTS = Counter(
+    "bulk_write_documents_total",
+    "Documents matched, modified, upserted or deleted by bulk writes",
+    ["collection", "result"],
+    namespace=NAMESPACE,
+)
+BULK_WRITE_BATCHES = Counter(
+    "bulk_write_batches_total",
+    "Bulk write batches sent to Mongo",
+    ["collection"],
+    namespace=NAMESPACE,
+)
+
+
+def registry() -> CollectorRegistry:
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        collected = CollectorRegistry()
+        multiprocess.MultiProcessCollector(collected)
+        return collected
+    from prometheus_client import REGISTRY
+
+    return REGISTRY
+
+
+def exposition() -> Tuple[bytes, str]:
+    return generate_latest(registry()), CONTENT_TYPE_LATEST
+
+
+def instrument_flask(app: Flask):
+    """Observe the duration of every request of `app`, labelled with its route."""
+
+    @app.before_request
+    def _start_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def _observe(response):
+        start = g.get("request_start")
+        if start is None:
+            return response
+        route = request.url_rule.rule if request.url_rule else UNMATCHED_ROUTE
+        labels = (request.method, route, str(response.status_code))
+
+        # Streamed listings are only done once the server closes the body
+        response.call_on_close(
+            lambda: REQUEST_DURATION.labels(*labels).observe(
+                time.perf_counter() - start
+            )
+        )
+        return response
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    """Observes the duration of every command the Mongo client sends."""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        UPSTREAM_DURATION.labels("mongo", event.command_name).observe(
+            event.duration_micros / 1e6
+        )
+
+    def failed(self, event):
+        UPSTREAM_DURATION.labels("mongo", event.command_name).observe(
+            event.duration_micros / 1e6
+        )
+        UPSTREAM_ERRORS.labels("mongo", event.command_name).inc()
@@ -1,14 +1,18 @@
 """mongodb Module.
 
 This module implements a functions for creating mongodb connections.
+LazyDatabase defers reading the credentials and creating the client to the
+first use of the database.
 
 """
 import os
 import logging
+import threading
 
 from pymongo import MongoClient  # type: ignore
 from urllib.parse import quote_plus
 from domino_creds import MongoDBDetails, DominoSystemCred
+from metrics import MongoCommandListener
 
 
 logger = logging.getLogger(__name__)
@@ -39,8 +43,38 @@ def create_database_connection():
     logging.warning("mongo_uri :: ",mongo_uri)
     print('---------')
     print(mongo_uri)
-    return MongoClient(mongo_uri)[db_name]
+    return MongoClient(mongo_uri, event_listeners=[MongoCommandListener()])[db_name]
 
 
+class LazyDatabase:
+    """The `domino` database, connected on first use.
 
+    Stands in for the pymongo Database: items and attributes are looked up
+    on the real one, which is created once per process.
+    """
 
+    def __init__(self, connect=create_database_connection):
+        self._connect = connect
+        self._database = None
+        self._lock = threading.Lock()
+
+    @property
+    def connected(self) -> bool:
+        return self._database is not None
+
+    def get(self):
+        if self._database is None:
+            with self._lock:
+                if self._database is None:
+                    self._database = self._connect()
+        return self._database
+
+    def __getitem__(self, name):
+        return self.get()[name]
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+    def close(self):
+        if self._database is not None:
+            self._database.client.close()
@@ -0,0 +1,217 @@
+"""mutation_informer Module.
+
+This module implements an in-process informer for the Domsed mutations
+(`mutations.apps.dominodatalab.com`) of the platform namespace. The mutations
+are listed once, then a watch started from the listed resourceVersion keeps
+the copy in memory current, so listing and reading mutations does not call
+the API server. When the watch can no longer resume (410 Gone) the mutations
+are listed again.
+
+Example:
+    informer = MutationInformer(namespace="domino-platform")
+    informer.start()
+    informer.synced.wait()
+    informer.get("my-mutation")
+"""
+import logging
+import threading
+from typing import Callable, Dict, List, Optional
+
+from kubernetes import watch
+from kubernetes.client import CustomObjectsApi
+from kubernetes.client.rest import ApiException
+
+from k8s import get_custom_objects_api
+
+logger = logging.getLogger("extended-api")
+
+GROUP = "apps.dominodatalab.com"
+VERSION = "v1alpha1"
+PLURAL = "mutations"
+LIST_KIND = "MutationList"
+HTTP_GONE = 410
+
+DEFAULT_WATCH_TIMEOUT_SECONDS = 300
+DEFAULT_RETRY_BACKOFF_SECONDS = 1.0
+DEFAULT_MAX_RETRY_BACKOFF_SECONDS = 30.0
+
+
+def _name(obj: Dict) -> str:
+    return obj["metadata"]["name"]
+
+
+def _version(resource_version: Optional[str]) -> Optional[int]:
+    # resourceVersions are opaque, but the API server backed by etcd sends
+    # increasing integers; anything else is never compared
+    if resource_version is not None and resource_version.isdigit():
+        return int(resource_version)
+    return None
+
+
+def _older(resource_version: Optional[str], than: Optional[str]) -> bool:
+    """Whether `resource_version` is known to be older than `than`."""
+    version, other = _version(resource_version), _version(than)
+    return version is not None and other is not None and version < other
+
+
+def _resource_version(obj: Optional[Dict]) -> Optional[str]:
+    return (obj or {}).get("metadata", {}).get("resourceVersion")
+
+
+class MutationInformer:
+    def __init__(
+        self,
+        namespace: str,
+        api: Callable[[], CustomObjectsApi] = get_custom_objects_api,
+        watch_timeout_seconds: int = DEFAULT_WATCH_TIMEOUT_SECONDS,
+        retry_backoff_seconds: float = DEFAULT_RETRY_BACKOFF_SECONDS,
+        max_retry_backoff_seconds: float = DEFAULT_MAX_RETRY_BACKOFF_SECONDS,
+    ):
+        self.namespace = namespace
+        self.api = api
+        self.watch_timeout_seconds = watch_timeout_seconds
+        self.retry_backoff_seconds = retry_backoff_seconds
+        self.max_retry_backoff_seconds = max_retry_backoff_seconds
+        # name -> mutation, the objects are never modified once stored
+        self._items: Dict[str, Dict] = {}
+        self.resource_version: Optional[str] = None
+        # Set once the first list has been stored
+        self.synced = threading.Event()
+        self.relists = 0
+        self.events = 0
+        self.bookmarks = 0
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._watch: Optional[watch.Watch] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def get(self, name: str) -> Optional[Dict]:
+        return self._items.get(name)
+
+    def list(self) -> Dict:
+        """The mutations in the shape of the API server list response."""
+        with self._lock:
+            items: List[Dict] = [self._items[name] for name in sorted(self._items)]
+            resource_version = self.resource_version
+        return {
+            "apiVersion": f"{GROUP}/{VERSION}",
+            "kind": LIST_KIND,
+            "items": items,
+            "metadata": {"resourceVersion": resource_version},
+        }
+
+    def store(self, obj: Dict):
+        """Record a mutation written by this process before its event arrives.
+
+        Ignored when the watch already is past the write, or when the stored
+        copy is newer: a slow write result must not replace a later change.
+        """
+        resource_version = _resource_version(obj)
+        with self._lock:
+            if not _older(resource_version, self.resource_version) and not _older(
+                resource_version, _resource_version(self._items.get(_name(obj)))
+            ):
+                self._items[_name(obj)] = obj
+
+    def forget(self, name: str, resource_version: Optional[str] = None):
+        """Drop a mutation deleted by this process before its event arrives.
+
+        `resource_version` is the last one of the deleted mutation, a copy
+        stored since then, of a mutation created again, is kept.
+        """
+        with self._lock:
+            if not _older(resource_version, _resource_version(self._items.get(name))):
+                self._items.pop(name, None)
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self.run, name="mutation-informer", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._watch is not None:
+            self._watch.stop()
+        if self._thread is not None:
+            # A watch blocked on the socket only returns at its timeout
+            self._thread.join(timeout=1.0)
+            self._thread = None
+
+    def run(self):
+        backoff = self.retry_backoff_seconds
+        while not self._stop_event.is_set():
+            try:
+                if self.resource_version is None:
+                    self._relist()
+                backoff = self.retry_backoff_seconds
+                self._watch_changes()
+            except ApiException as e:
+                if e.status == HTTP_GONE:
+                    logger.warning("Mutation watch expired, listing mutations again")
+                    self.resource_version = None
+                else:
+                    logger.exception(e)
+                    backoff = self._sleep(backoff)
+            except Exception as e:
+                logger.exception(e)
+                backoff = self._sleep(backoff)
+
+    def _relist(self):
+        resp = self.api().list_namespaced_custom_object(
+            GROUP, VERSION, self.namespace, PLURAL
+        )
+        items = {_name(obj): obj for obj in resp.get("items", [])}
+        with self._lock:
+            self._items = items
+            self.resource_version = resp["metadata"]["resourceVersion"]
+        self.relists += 1
+        self.synced.set()
+
+    def _watch_changes(self):
+        self._watch = watch.Watch()
+        for event in self._watch.stream(
+            self.api().list_namespaced_custom_object,
+            GROUP,
+            VERSION,
+            self.namespace,
+            PLURAL,
+            resource_version=self.resource_version,
+            allow_watch_bookmarks=True,
+            timeout_seconds=self.watch_timeout_seconds,
+        ):
+            self._apply(event["type"], event["raw_object"])
+            if self._stop_event.is_set():
+                break
+
+    def _apply(self, event_type: str, obj: Dict):
+        resource_version = obj["metadata"]["resourceVersion"]
+        if event_type == "BOOKMARK":
+            # Only carries the resourceVersion to resume from, no name
+            with self._lock:
+                self.resource_version = resource_version
+            self.bookmarks += 1
+            return
+        with self._lock:
+            # A newer copy stored by this process wins until its own event
+            stored = _resource_version(self._items.get(_name(obj)))
+            if event_type in ("ADDED", "MODIFIED") and not _older(resource_version, stored):
+                self._items[_name(obj)] = obj
+            elif event_type == "DELETED" and not _older(resource_version, stored):
+                self._items.pop(_name(obj), None)
+            self.resource_version = resource_version
+        self.events += 1
+
+    def _sleep(self, backoff: float) -> float:
+        self._stop_event.wait(backoff)
+        return min(backoff * 2, self.max_retry_backoff_seconds)
+
+    def stats(self) -> Dict:
+        return {
+            "size": len(self._items),
+            "synced": self.synced.is_set(),
+            "resource_version": self.resource_version,
+            "relists": self.relists,
+            "events": self.events,
+            "bookmarks": self.bookmarks,
+        }
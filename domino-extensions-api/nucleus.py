@@ -0,0 +1,220 @@
+"""nucleus Module.
+
+This module implements the HTTP client used for every call to the Domino
+nucleus frontend. Calls share a pooled keep-alive session with connect and
+read timeouts, and GETs are retried with backoff on connection errors and
+gateway errors. AsyncNucleusClient does the same for the asyncio server.
+
+Example:
+    from nucleus import NUCLEUS_CLIENT
+
+    resp = NUCLEUS_CLIENT.get("api/projects/beta/projects", headers=headers)
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from metrics import UPSTREAM_DURATION, UPSTREAM_ERRORS
+
+logger = logging.getLogger("extended-api")
+
+DOMINO_NUCLEUS_URI = "http://nucleus-frontend.domino-platform:80"
+DEFAULT_POOL_SIZE = 20
+DEFAULT_CONNECT_TIMEOUT_SECONDS = 3.05
+DEFAULT_READ_TIMEOUT_SECONDS = 60.0
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_RETRY_BACKOFF_SECONDS = 0.3
+RETRY_STATUS_CODES = (502, 503, 504)
+
+
+class NucleusClient:
+    def __init__(
+        self,
+        base_uri: str = DOMINO_NUCLEUS_URI,
+        pool_size: int = DEFAULT_POOL_SIZE,
+        connect_timeout_seconds: float = DEFAULT_CONNECT_TIMEOUT_SECONDS,
+        read_timeout_seconds: float = DEFAULT_READ_TIMEOUT_SECONDS,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+        retry_backoff_seconds: float = DEFAULT_RETRY_BACKOFF_SECONDS,
+    ):
+        self.base_uri = base_uri
+        self.timeout = (connect_timeout_seconds, read_timeout_seconds)
+        retries = Retry(
+            total=max_retries,
+            backoff_factor=retry_backoff_seconds,
+            status_forcelist=RETRY_STATUS_CODES,
+            # Only the idempotent methods of the urllib3 default are retried
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries
+        )
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def url(self, path: str) -> str:
+        return f"{self.base_uri.rstrip('/')}/{path.lstrip('/')}"
+
+    def get(
+        self,
+        path: str,
+        headers: Optional[Dict] = None,
+        params=None,
+        **kwargs,
+    ) -> requests.Response:
+        start = time.perf_counter()
+        try:
+            return self.session.get(
+                self.url(path),
+                headers=headers,
+                params=params,
+                timeout=self.timeout,
+                **kwargs,
+            )
+        except requests.RequestException:
+            with self._lock:
+                self.errors += 1
+            UPSTREAM_ERRORS.labels("nucleus", path).inc()
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            UPSTREAM_DURATION.labels("nucleus", path).observe(elapsed)
+            with self._lock:
+                self.calls += 1
+                self.total_seconds += elapsed
+                self.max_seconds = max(self.max_seconds, elapsed)
+            logger.info(f"Nucleus GET {path} took {elapsed * 1000:.1f} ms")
+
+    def stats(self) -> Dict:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "total_seconds": round(self.total_seconds, 3),
+            "max_seconds": round(self.max_seconds, 3),
+        }
+
+
+class AsyncNucleusClient:
+    """asyncio counterpart of NucleusClient, built on httpx.
+
+    Must be created and used from the event loop serving the requests.
+    Connection errors are retried by the transport, gateway errors here.
+    """
+
+    def __init__(
+        self,
+        base_uri: str = DOMINO_NUCLEUS_URI,
+        pool_size: int = DEFAULT_POOL_SIZE,
+        connect_timeout_seconds: float = DEFAULT_CONNECT_TIMEOUT_SECONDS,
+        read_timeout_seconds: float = DEFAULT_READ_TIMEOUT_SECONDS,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+        retry_backoff_seconds: float = DEFAULT_RETRY_BACKOFF_SECONDS,
+    ):
+        self.base_uri = base_uri
+        self.max_retries = max_retries
+        self.retry_backoff_seconds = retry_backoff_seconds
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(read_timeout_seconds, connect=connect_timeout_seconds),
+            # The limits of the client are ignored once a transport is given
+            transport=httpx.AsyncHTTPTransport(
+                retries=max_retries,
+                limits=httpx.Limits(
+                    max_connections=pool_size, max_keepalive_connections=pool_size
+                ),
+            ),
+        )
+        self.calls = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def url(self, path: str) -> str:
+        return f"{self.base_uri.rstrip('/')}/{path.lstrip('/')}"
+
+    async def get(
+        self,
+        path: str,
+        headers: Optional[Dict] = None,
+        params=None,
+        stream: bool = False,
+    ) -> httpx.Response:
+        """GET `path` on nucleus.
+
+        With `stream=True` the body is not read, the caller must close the
+        response with `await resp.aclose()`.
+        """
+        start = time.perf_counter()
+        try:
+            for attempt in range(self.max_retries + 1):
+                request = self.client.build_request(
+                    "GET", self.url(path), headers=headers, params=params
+                )
+                resp = await self.client.send(request, stream=stream)
+                if resp.status_code not in RETRY_STATUS_CODES or (
+                    attempt == self.max_retries
+                ):
+                    return resp
+                await resp.aclose()
+                await asyncio.sleep(self.retry_backoff_seconds * (2 ** attempt))
+            return resp
+        except httpx.HTTPError:
+            self.errors += 1
+            UPSTREAM_ERRORS.labels("nucleus", path).inc()
+            raise
+        finally:
+            # Only touched from the event loop thread, no lock needed
+            elapsed = time.perf_counter() - start
+            UPSTREAM_DURATION.labels("nucleus", path).observe(elapsed)
+            self.calls += 1
+            self.total_seconds += elapsed
+            self.max_seconds = max(self.max_seconds, elapsed)
+            logger.info(f"Nucleus GET {path} took {elapsed * 1000:.1f} ms")
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    def stats(self) -> Dict:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "total_seconds": round(self.total_seconds, 3),
+            "max_seconds": round(self.max_seconds, 3),
+        }
+
+
+def nucleus_client_settings() -> Dict:
+    return dict(
+        base_uri=os.environ.get("DOMINO_NUCLEUS_URI", DOMINO_NUCLEUS_URI),
+        pool_size=int(os.environ.get("NUCLEUS_POOL_SIZE", DEFAULT_POOL_SIZE)),
+        connect_timeout_seconds=float(
+            os.environ.get(
+                "NUCLEUS_CONNECT_TIMEOUT_SECONDS", DEFAULT_CONNECT_TIMEOUT_SECONDS
+            )
+        ),
+        read_timeout_seconds=float(
+            os.environ.get("NUCLEUS_READ_TIMEOUT_SECONDS", DEFAULT_READ_TIMEOUT_SECONDS)
+        ),
+        max_retries=int(os.environ.get("NUCLEUS_MAX_RETRIES", DEFAULT_MAX_RETRIES)),
+        retry_backoff_seconds=float(
+            os.environ.get(
+                "NUCLEUS_RETRY_BACKOFF_SECONDS", DEFAULT_RETRY_BACKOFF_SECONDS
+            )
+        ),
+    )
+
+
+NUCLEUS_CLIENT = NucleusClient(**nucleus_client_settings())
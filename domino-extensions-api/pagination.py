@@ -0,0 +1,228 @@
+"""pagination Module.
+
+This module implements the `all=true` mode of the enriched listings: the
+service walks every page of a nucleus listing itself, fetching up to
+`concurrency` pages at once, and yields the elements in upstream order as
+soon as the pages preceding them have arrived. iter_all_items_async does the
+same for the asyncio server.
+
+Example:
+    items = iter_all_items(
+        NUCLEUS_CLIENT, "api/projects/beta/projects", "projects", headers, params
+    )
+"""
+import asyncio
+import logging
+import os
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import AsyncIterator, Deque, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger("extended-api")
+
+ALL_PARAM = "all"
+PAGING_PARAMS = ("offset", "limit")
+DEFAULT_PAGE_SIZE = 500
+DEFAULT_PAGE_CONCURRENCY = 4
+
+PAGE_SIZE = int(os.environ.get("NUCLEUS_PAGE_SIZE", DEFAULT_PAGE_SIZE))
+PAGE_CONCURRENCY = int(
+    os.environ.get("NUCLEUS_PAGE_CONCURRENCY", DEFAULT_PAGE_CONCURRENCY)
+)
+
+
+class UpstreamPageError(Exception):
+    pass
+
+
+def all_pages_requested(args) -> bool:
+    return args.get(ALL_PARAM, "").lower() == "true"
+
+
+def _listing_params(params: Dict) -> Dict:
+    return {
+        k: v
+        for k, v in params.items()
+        if k not in PAGING_PARAMS and k != ALL_PARAM
+    }
+
+
+def _is_last_page(items: List[Dict], total: Optional[int], page_size: int) -> bool:
+    if total is not None:
+        # nucleus may cap `limit` below `page_size`, only the total tells
+        return not items or len(items) >= total
+    return len(items) < page_size
+
+
+def _capped(items: List[Dict], offset: int, total: Optional[int], stride: int) -> bool:
+    """Whether a page came back shorter than requested before the end."""
+    return total is not None and len(items) < stride and offset + len(items) < total
+
+
+def _parse_page(resp, path: str, key: str, offset: int):
+    if resp.status_code != 200:
+        raise UpstreamPageError(
+            f"{resp.status_code} - Error fetching {path} at offset {offset}"
+        )
+    body = resp.json()
+    total = (body.get("metadata") or {}).get("totalCount")
+    return body[key], total
+
+
+def _fetch_page(
+    client, path: str, key: str, headers: Dict, params: Dict, offset: int, limit: int
+) -> Tuple[List[Dict], Optional[int]]:
+    page_params = dict(params, offset=offset, limit=limit)
+    resp = client.get(path, headers=headers, params=page_params)
+    return _parse_page(resp, path, key, offset)
+
+
+async def _fetch_page_async(
+    client, path: str, key: str, headers: Dict, params: Dict, offset: int, limit: int
+) -> Tuple[List[Dict], Optional[int]]:
+    page_params = dict(params, offset=offset, limit=limit)
+    resp = await client.get(path, headers=headers, params=page_params)
+    return _parse_page(resp, path, key, offset)
+
+
+def iter_all_items(
+    client,
+    path: str,
+    key: str,
+    headers: Dict,
+    params: Dict,
+    page_size: int = PAGE_SIZE,
+    concurrency: int = PAGE_CONCURRENCY,
+) -> Iterator[Dict]:
+    """Yield every element of a paged nucleus listing, in upstream order.
+
+    The first page tells how many elements there are (`metadata.totalCount`)
+    and the remaining pages are fetched with at most `concurrency` requests
+    in flight, each of the size of the first page: nucleus may return fewer
+    elements than `page_size`. A page shorter than that before the total
+    restarts the window where it ended. Without a total count pages are
+    requested ahead until one comes back short.
+    """
+    params = _listing_params(params)
+    items, total = _fetch_page(client, path, key, headers, params, 0, page_size)
+    yield from items
+    if _is_last_page(items, total, page_size):
+        return
+
+    executor = ThreadPoolExecutor(
+        max_workers=max(1, concurrency), thread_name_prefix="nucleus-page"
+    )
+    # (offset, page)
+    pending: Deque[Tuple[int, Future]] = deque()
+    stride = len(items) if total is not None else page_size
+    next_offset = stride
+    try:
+
+        def schedule():
+            nonlocal next_offset
+            while len(pending) < concurrency and (total is None or next_offset < total):
+                pending.append(
+                    (
+                        next_offset,
+                        executor.submit(
+                            _fetch_page,
+                            client,
+                            path,
+                            key,
+                            headers,
+                            params,
+                            next_offset,
+                            stride,
+                        ),
+                    )
+                )
+                next_offset += stride
+
+        schedule()
+        while pending:
+            offset, future = pending.popleft()
+            items, _ = future.result()
+            if total is None and len(items) < page_size:
+                # Last page, anything requested after it comes back empty
+                yield from items
+                break
+            if total is not None and not items:
+                # Fewer elements than counted, removed meanwhile
+                break
+            if _capped(items, offset, total, stride):
+                for _, later in pending:
+                    later.cancel()
+                pending.clear()
+                stride = len(items)
+                next_offset = offset + stride
+            # Keep the window full while this page is being enriched
+            schedule()
+            yield from items
+    finally:
+        for _, future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+async def iter_all_items_async(
+    client,
+    path: str,
+    key: str,
+    headers: Dict,
+    params: Dict,
+    page_size: int = PAGE_SIZE,
+    concurrency: int = PAGE_CONCURRENCY,
+) -> AsyncIterator[Dict]:
+    """iter_all_items with an AsyncNucleusClient, pages are fetched as tasks."""
+    params = _listing_params(params)
+    items, total = await _fetch_page_async(
+        client, path, key, headers, params, 0, page_size
+    )
+    for item in items:
+        yield item
+    if _is_last_page(items, total, page_size):
+        return
+
+    # (offset, page)
+    pending: Deque[Tuple[int, asyncio.Future]] = deque()
+    stride = len(items) if total is not None else page_size
+    next_offset = stride
+
+    def schedule():
+        nonlocal next_offset
+        while len(pending) < concurrency and (total is None or next_offset < total):
+            pending.append(
+                (
+                    next_offset,
+                    asyncio.ensure_future(
+                        _fetch_page_async(
+                            client, path, key, headers, params, next_offset, stride
+                        )
+                    ),
+                )
+            )
+            next_offset += stride
+
+    try:
+        schedule()
+        while pending:
+            offset, future = pending.popleft()
+            items, _ = await future
+            last = (total is None and len(items) < page_size) or (
+                total is not None and not items
+            )
+            if _capped(items, offset, total, stride):
+                for _, later in pending:
+                    later.cancel()
+                pending.clear()
+                stride = len(items)
+                next_offset = offset + stride
+            if not last:
+                schedule()
+            for item in items:
+                yield item
+            if last:
+                break
+    finally:
+        for _, task in pending:
+            task.cancel()
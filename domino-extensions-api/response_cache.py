@@ -0,0 +1,143 @@
+"""response_cache Module.
+
+This module implements the cache of the serialized enhanced listings. An
+entry is keyed by the caller's credentials, the route and the normalized
+query parameters, so a listing is only ever served to the credentials it was
+fetched from nucleus with. It is fresh for `ttl_seconds`, then served stale
+for `stale_seconds` more while a single revalidation runs in the background,
+and dropped as soon as the generation of the cache it was enriched from
+changes. The least recently used entries are evicted beyond `max_entries` or
+`max_bytes` of bodies.
+
+Example:
+    key = listing_key(headers, "projects", params)
+    entry, fresh = RESPONSE_CACHE.get(key, PROJECTS_CACHE.generation)
+    if entry is None:
+        entry = CachedListing(body, headers, etag, generation)
+        RESPONSE_CACHE.put(key, entry)
+    elif not fresh and RESPONSE_CACHE.begin_revalidation(key):
+        ...  # fetch again, then `put` or `touch`, and `end_revalidation`
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, NamedTuple, Optional, Set, Tuple
+
+DEFAULT_TTL_SECONDS = 0.0
+DEFAULT_STALE_SECONDS = 30.0
+DEFAULT_MAX_ENTRIES = 1024
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+
+class CachedListing(NamedTuple):
+    body: bytes
+    headers: Dict[str, str]
+    etag: Optional[str]
+    generation: int
+    # time.monotonic() of the last fetch or revalidation
+    stored_at: float = 0.0
+
+
+def listing_key(headers: Dict, route: str, params: Dict) -> str:
+    """Key of a listing, the credentials are only kept hashed."""
+    credentials = "|".join(f"{k}={headers[k]}" for k in sorted(headers))
+    query = "&".join(f"{k}={params[k]}" for k in sorted(params))
+    return hashlib.sha256(f"{credentials}\n{route}\n{query}".encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    def __init__(
+        self,
+        ttl_seconds: float = DEFAULT_TTL_SECONDS,
+        stale_seconds: float = DEFAULT_STALE_SECONDS,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+    ):
+        self.ttl_seconds = ttl_seconds
+        self.stale_seconds = stale_seconds
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, CachedListing]" = OrderedDict()
+        self._revalidating: Set[str] = set()
+        self._lock = threading.Lock()
+        self.size_bytes = 0
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.revalidations = 0
+
+    def _drop(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size_bytes -= len(entry.body)
+
+    def get(self, key: str, generation: int) -> Tuple[Optional[CachedListing], bool]:
+        """(entry, fresh) of `key`, (None, False) on a miss.
+
+        An entry enriched at another generation than `generation` is dropped.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.generation != generation:
+                self._drop(key)
+                self.invalidations += 1
+                entry = None
+            age = time.monotonic() - entry.stored_at if entry is not None else 0.0
+            if entry is None or age > self.ttl_seconds + self.stale_seconds:
+                self._drop(key)
+                self.misses += 1
+                return None, False
+            self._entries.move_to_end(key)
+            if age > self.ttl_seconds:
+                self.stale_hits += 1
+                return entry, False
+            self.hits += 1
+            return entry, True
+
+    def put(self, key: str, entry: CachedListing):
+        if len(entry.body) > self.max_bytes:
+            return
+        with self._lock:
+            self._drop(key)
+            self._entries[key] = entry._replace(stored_at=time.monotonic())
+            self.size_bytes += len(entry.body)
+            while len(self._entries) > self.max_entries or self.size_bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+
+    def touch(self, key: str, generation: int):
+        """Mark the entry of `key` as fresh again, nucleus found it unchanged."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.generation == generation:
+                self._entries[key] = entry._replace(stored_at=time.monotonic())
+
+    def begin_revalidation(self, key: str) -> bool:
+        """Whether the caller should revalidate `key`, one caller at a time."""
+        with self._lock:
+            if key in self._revalidating:
+                return False
+            self._revalidating.add(key)
+            self.revalidations += 1
+            return True
+
+    def end_revalidation(self, key: str):
+        with self._lock:
+            self._revalidating.discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size_bytes = 0
+
+    def stats(self) -> Dict:
+        return {
+            "size": len(self._entries),
+            "bytes": self.size_bytes,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "revalidations": self.revalidations,
+        }
@@ -0,0 +1,581 @@
+"""shared_refresh Module.
+
+This module implements a refresh of the caches shared by all the replicas,
+so that the collections are read from Mongo by one worker instead of by
+every worker of every pod.
+
+The workers compete for a Kubernetes Lease. The holder (the leader) is the
+only one reloading the caches from Mongo. After each reload it writes their
+snapshots (see `snapshots`) to the snapshot folder of its pod, served by
+`/api-extended/cache_snapshots/<collection>`, and publishes their checksums
+on the Lease. The other workers (followers) read the Lease every retry
+period and download a snapshot whenever its checksum changed.
+
+The route only serves the snapshots to the followers: each worker draws a
+random token, the leader publishes its own on the Lease, and the followers
+send it in the `X-Snapshot-Token` header of their downloads. Reading it
+takes the same RBAC permissions on the Lease as the election.
+
+A follower does not reload a cache itself. A refresh (`/refresh_cache`, or
+a lookup of an unknown id) is counted on the Lease instead, and the follower
+waits for the snapshot the leader publishes in answer. The leader reloads
+a cache once for all the refreshes counted since its previous reload. A
+lookup only waits `miss_timeout_seconds` for it, and is answered from the
+cache as it is after that: the snapshot is still loaded once published.
+
+A cache kept current by a change stream watcher is more recent than the
+snapshots of the leader, so it is only replaced by one when empty or when
+the follower asked for the reload, and its watcher then resumes from the
+position of the snapshot.
+
+Example:
+    caches = [ENVIRONMENT_REVISION_CACHE, PROJECTS_CACHE]
+    shared = SharedCacheRefresh(
+        caches,
+        CacheSnapshots(caches, "/snapshots"),
+        LeaseElector("extended-api-cache", "domino-field", "pod-0_12"),
+        "http://10.0.3.4:5000",
+    )
+    shared.start()
+"""
+import json
+import logging
+import hmac
+import os
+import secrets
+import tempfile
+import threading
+import time
+import weakref
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional
+
+import requests
+from kubernetes.client import V1Lease, V1LeaseSpec, V1ObjectMeta
+from kubernetes.client.rest import ApiException
+
+from k8s import get_coordination_v1_api
+from metrics import CACHE_REFRESHES
+from snapshots import CacheSnapshots, SnapshotError, snapshot_path, snapshot_version
+
+logger = logging.getLogger("extended-api")
+
+ANNOTATION_PREFIX = "extended-api.dominodatalab.com/"
+LEADER_URL_ANNOTATION = f"{ANNOTATION_PREFIX}leader-url"
+# Token the followers send to download the snapshots of the leader
+SNAPSHOT_TOKEN_ANNOTATION = f"{ANNOTATION_PREFIX}snapshot-token"
+SNAPSHOT_TOKEN_HEADER = "X-Snapshot-Token"
+# collection -> checksum of the snapshot the leader serves
+SNAPSHOTS_ANNOTATION = f"{ANNOTATION_PREFIX}snapshots"
+# collection -> refreshes requested, and the ones the served snapshot answers
+REFRESH_REQUESTS_ANNOTATION = f"{ANNOTATION_PREFIX}refresh-requests"
+REFRESHED_ANNOTATION = f"{ANNOTATION_PREFIX}refreshed"
+SNAPSHOT_ROUTE = "/api-extended/cache_snapshots/{collection}"
+
+DEFAULT_LEASE_DURATION_SECONDS = 15
+DEFAULT_RETRY_PERIOD_SECONDS = 2.0
+DEFAULT_REFRESH_TIMEOUT_SECONDS = 60.0
+DEFAULT_MISS_TIMEOUT_SECONDS = 2.0
+DOWNLOAD_TIMEOUT_SECONDS = (3.05, 60)
+MAX_UPDATE_ATTEMPTS = 5
+
+
+def _counts(annotations: Dict[str, str], key: str) -> Dict[str, int]:
+    try:
+        return json.loads(annotations.get(key) or "{}")
+    except ValueError:
+        return {}
+
+
+class LeaseElector:
+    """Leader election on a `coordination.k8s.io/v1` Lease.
+
+    The holder renews the Lease every round. Another candidate takes it over
+    once it has not seen the Lease renewed for the lease duration, timed with
+    its own clock (the clocks of the pods may differ).
+    """
+
+    def __init__(
+        self,
+        name: str,
+        namespace: str,
+        identity: str,
+        lease_duration_seconds: int = DEFAULT_LEASE_DURATION_SECONDS,
+        api: Callable = get_coordination_v1_api,
+    ):
+        self.name = name
+        self.namespace = namespace
+        self.identity = identity
+        self.lease_duration_seconds = lease_duration_seconds
+        self.api = api
+        self.lease: Optional[V1Lease] = None
+        self._observed_record = None
+        self._observed_at = 0.0
+        # When the last successful renewal was sent
+        self._renewed_at: Optional[float] = None
+
+    @property
+    def is_leader(self) -> bool:
+        return (
+            self._renewed_at is not None
+            and time.monotonic() - self._renewed_at < self.lease_duration_seconds
+        )
+
+    @property
+    def annotations(self) -> Dict[str, str]:
+        if self.lease is None:
+            return {}
+        return self.lease.metadata.annotations or {}
+
+    def _observe(self, lease: V1Lease):
+        self.lease = lease
+        record = (lease.spec.holder_identity, lease.spec.renew_time)
+        if record != self._observed_record:
+            self._observed_record = record
+            self._observed_at = time.monotonic()
+
+    def _expired(self) -> bool:
+        spec = self.lease.spec
+        duration = spec.lease_duration_seconds or self.lease_duration_seconds
+        return (
+            not spec.holder_identity
+            or time.monotonic() - self._observed_at > duration
+        )
+
+    def _create(self, annotations: Dict[str, str], sent_at: float) -> bool:
+        now = datetime.now(timezone.utc)
+        lease = V1Lease(
+            metadata=V1ObjectMeta(
+                name=self.name, namespace=self.namespace, annotations=annotations
+            ),
+            spec=V1LeaseSpec(
+                holder_identity=self.identity,
+                acquire_time=now,
+                renew_time=now,
+                lease_duration_seconds=self.lease_duration_seconds,
+                lease_transitions=0,
+            ),
+        )
+        try:
+            self._observe(self.api().create_namespaced_lease(self.namespace, lease))
+        except ApiException as e:
+            if e.status != 409:
+                raise
+            # Created by another candidate meanwhile
+            self._renewed_at = None
+            return False
+        self._renewed_at = sent_at
+        return True
+
+    def acquire_or_renew(self, annotations: Dict[str, str]) -> bool:
+        """One election round, True while this candidate holds the Lease."""
+        sent_at = time.monotonic()
+        for _ in range(MAX_UPDATE_ATTEMPTS):
+            try:
+                lease = self.api().read_namespaced_lease(self.name, self.namespace)
+            except ApiException as e:
+                if e.status != 404:
+                    raise
+                return self._create(annotations, sent_at)
+            self._observe(lease)
+            spec = lease.spec
+            if spec.holder_identity != self.identity and not self._expired():
+                self._renewed_at = None
+                return False
+            now = datetime.now(timezone.utc)
+            if spec.holder_identity != self.identity:
+                logger.warning(f"{self.identity} takes over the lease {self.name}")
+                spec.holder_identity = self.identity
+                spec.acquire_time = now
+                spec.lease_transitions = (spec.lease_transitions or 0) + 1
+            spec.renew_time = now
+            spec.lease_duration_seconds = self.lease_duration_seconds
+            lease.metadata.annotations = {
+                **(lease.metadata.annotations or {}),
+                **annotations,
+            }
+            try:
+                self._observe(
+                    self.api().replace_namespaced_lease(self.name, self.namespace, lease)
+                )
+            except ApiException as e:
+                if e.status != 409:
+                    raise
+                # Changed meanwhile: renewed or taken over by another
+                # candidate, or a refresh request counted by a follower
+                continue
+            self._renewed_at = sent_at
+            return True
+        return self.is_leader
+
+    def update_annotations(self, update: Callable[[Dict[str, str]], None]) -> V1Lease:
+        """Apply `update` to the annotations of the Lease, retried on conflicts."""
+        for attempt in range(MAX_UPDATE_ATTEMPTS):
+            lease = self.api().read_namespaced_lease(self.name, self.namespace)
+            annotations = dict(lease.metadata.annotations or {})
+            update(annotations)
+            lease.metadata.annotations = annotations
+            try:
+                lease = self.api().replace_namespaced_lease(
+                    self.name, self.namespace, lease
+                )
+            except ApiException as e:
+                if e.status != 409 or attempt == MAX_UPDATE_ATTEMPTS - 1:
+                    raise
+                continue
+            self._observe(lease)
+            return lease
+
+    def release(self):
+        """Give the Lease up, the next candidate does not wait for it to expire."""
+        if not self.is_leader:
+            return
+        self._renewed_at = None
+        lease = self.api().read_namespaced_lease(self.name, self.namespace)
+        if lease.spec.holder_identity != self.identity:
+            return
+        lease.spec.holder_identity = None
+        try:
+            self.api().replace_namespaced_lease(self.name, self.namespace, lease)
+        except ApiException as e:
+            if e.status != 409:
+                raise
+
+
+class SharedCacheRefresh:
+    """Reloads the caches on the leader and loads them from it on the followers.
+
+    The election thread renews or watches the Lease every retry period and,
+    on the followers, downloads the snapshots published since the last round.
+    On the leader, a second thread reloads the caches which have refresh
+    requests and publishes the snapshot of every reload, so a long reload
+    never delays the renewal of the Lease.
+    """
+
+    def __init__(
+        self,
+        caches: List,
+        snapshots: CacheSnapshots,
+        elector: LeaseElector,
+        url: str,
+        retry_period_seconds: float = DEFAULT_RETRY_PERIOD_SECONDS,
+        refresh_timeout_seconds: float = DEFAULT_REFRESH_TIMEOUT_SECONDS,
+        miss_timeout_seconds: float = DEFAULT_MISS_TIMEOUT_SECONDS,
+    ):
+        self.caches = {cache.collection_name: cache for cache in caches}
+        self.snapshots = snapshots
+        self.elector = elector
+        self.url = url
+        self.token = secrets.token_urlsafe(32)
+        self.retry_period_seconds = retry_period_seconds
+        self.refresh_timeout_seconds = refresh_timeout_seconds
+        self.miss_timeout_seconds = miss_timeout_seconds
+        self.session = requests.Session()
+        self.leader = False
+        self.rounds = 0
+        self.pulls = 0
+        self.publishes = 0
+        self.requests = 0
+        self.leader_reloads = 0
+        # collection -> (snapshot of the cache, checksum) last published
+        self._published: Dict[str, tuple] = {}
+        # collection -> checksum of the snapshot loaded
+        self._pulled: Dict[str, str] = {}
+        # collection -> refreshes answered by the snapshot loaded
+        self._served: Dict[str, int] = {}
+        # collection -> count of the last refresh this worker requested
+        self._requested: Dict[str, int] = {}
+        # collection -> change stream watcher keeping the cache current
+        self.watchers: Dict[str, object] = {}
+        self._condition = threading.Condition()
+        self._lead = threading.Event()
+        self._stop_event = threading.Event()
+        self._threads: List[threading.Thread] = []
+        # Followers until elected, a cold worker never reads Mongo on its own
+        self._set_role(leader=False)
+
+    def _set_role(self, leader: bool):
+        for cache in self.caches.values():
+            cache.shared_refresh = None if leader else self.refresh
+
+    def follow_watchers(self, watchers: List):
+        """Only pull the caches of `watchers` when needed, see `_needs_pull`."""
+        self.watchers = {watcher.cache.collection_name: watcher for watcher in watchers}
+
+    def snapshot_file(self, collection: str) -> Optional[str]:
+        """The snapshot of `collection` this worker serves, if it wrote one."""
+        cache = self.caches.get(collection)
+        if cache is None:
+            return None
+        path = snapshot_path(self.snapshots.directory, cache)
+        return path if os.path.exists(path) else None
+
+    def authorized(self, token: Optional[str]) -> bool:
+        """Whether `token` was published by the leader, to download its snapshots.
+
+        Any worker of the leader's pod serves the snapshot folder, so the token
+        of the Lease as last read is accepted too.
+        """
+        if not token:
+            return False
+        published = self.elector.annotations.get(SNAPSHOT_TOKEN_ANNOTATION)
+        return any(
+            expected and hmac.compare_digest(token.encode(), expected.encode())
+            for expected in (self.token, published)
+        )
+
+    def start(self):
+        """Run the first round, then keep electing and following in the background."""
+        os.makedirs(self.snapshots.directory, exist_ok=True)
+        self.run_once()
+        for target, name in ((self.run, "lease"), (self._run_leader, "lease-leader")):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout: Optional[float] = None):
+        """Stop electing, waiting at most `timeout` seconds, and release the Lease."""
+        self._stop_event.set()
+        self._lead.set()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(None if deadline is None else max(deadline - time.monotonic(), 0))
+            if thread.is_alive():
+                # A reload in progress, the process exits without it
+                logger.warning(f"Thread {thread.name} still running after {timeout} s")
+        self._threads = []
+        try:
+            self.elector.release()
+        except Exception as e:
+            logger.exception(e)
+
+    def run(self):
+        while not self._stop_event.wait(self.retry_period_seconds):
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.exception(e)
+
+    def run_once(self):
+        leader = self.elector.acquire_or_renew(
+            {LEADER_URL_ANNOTATION: self.url, SNAPSHOT_TOKEN_ANNOTATION: self.token}
+        )
+        if leader != self.leader:
+            logger.warning(
+                f"{self.elector.identity} is now the "
+                f"{'leader' if leader else 'follower'} of the cache refresh"
+            )
+            self.leader = leader
+            self._set_role(leader)
+        if leader:
+            self._lead.set()
+        else:
+            self._follow(self.elector.annotations)
+        with self._condition:
+            self.rounds += 1
+            self._condition.notify_all()
+
+    def _follow(self, annotations: Dict[str, str]):
+        versions = _counts(annotations, SNAPSHOTS_ANNOTATION)
+        refreshed = _counts(annotations, REFRESHED_ANNOTATION)
+        url = annotations.get(LEADER_URL_ANNOTATION)
+        token = annotations.get(SNAPSHOT_TOKEN_ANNOTATION)
+        if url is None or token is None:
+            return
+        for collection, cache in self.caches.items():
+            version = versions.get(collection)
+            if version is None:
+                continue
+            if self._needs_pull(cache, version, refreshed.get(collection, 0)):
+                if not self._pull(cache, url, token, version):
+                    continue
+            elif collection in self.watchers:
+                # Behind the cache its watcher keeps current
+                self._pulled[collection] = version
+            if version == self._pulled.get(collection):
+                with self._condition:
+                    self._served[collection] = refreshed.get(collection, 0)
+
+    def _needs_pull(self, cache, version: str, refreshed: int) -> bool:
+        """Whether to load snapshot `version`, answering `refreshed` refreshes.
+
+        A cache without watcher loads every new snapshot. A cache with one only
+        loads the first, and the one answering a refresh it requested, even
+        when its checksum is the one of a snapshot skipped before.
+        """
+        collection = cache.collection_name
+        if version != self._pulled.get(collection) and (
+            collection not in self.watchers or cache.generation == 0
+        ):
+            return True
+        if collection not in self.watchers:
+            return False
+        with self._condition:
+            requested = self._requested.get(collection, 0)
+            return refreshed >= requested > self._served.get(collection, 0)
+
+    def _pull(self, cache, url: str, token: str, version: str) -> bool:
+        collection = cache.collection_name
+        # Unique across the pods sharing the folder, their worker pids are alike
+        fd, path = tempfile.mkstemp(
+            dir=self.snapshots.directory, prefix=f"{collection}.", suffix=".download"
+        )
+        try:
+            with os.fdopen(fd, "wb") as f, self.session.get(
+                url + SNAPSHOT_ROUTE.format(collection=collection),
+                headers={SNAPSHOT_TOKEN_HEADER: token},
+                stream=True,
+                timeout=DOWNLOAD_TIMEOUT_SECONDS,
+            ) as resp:
+                resp.raise_for_status()
+                for chunk in resp.iter_content(chunk_size=1 << 20):
+                    f.write(chunk)
+            if snapshot_version(path) != version:
+                # Replaced by a newer one since it was published
+                return False
+            watcher = self.watchers.get(collection)
+            if watcher is None:
+                loaded = self.snapshots.load(cache, path)
+            else:
+                loaded = watcher.restore(lambda: self.snapshots.load(cache, path))
+            if not loaded:
+                return False
+        except (requests.RequestException, OSError, SnapshotError) as e:
+            logger.warning(f"Could not download the snapshot of {collection}: {e}")
+            return False
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+        self._pulled[collection] = version
+        self.pulls += 1
+        CACHE_REFRESHES.labels(type(cache).__name__, "pulled").inc()
+        return True
+
+    def _run_leader(self):
+        while True:
+            self._lead.wait()
+            if self._stop_event.is_set():
+                return
+            self._lead.clear()
+            if not self.elector.is_leader:
+                continue
+            try:
+                self._reload_and_publish()
+            except Exception as e:
+                logger.exception(e)
+
+    def _reload_and_publish(self):
+        requested = _counts(self.elector.annotations, REFRESH_REQUESTS_ANNOTATION)
+        refreshed = _counts(self.elector.annotations, REFRESHED_ANNOTATION)
+        for collection, cache in self.caches.items():
+            if requested.get(collection, 0) > refreshed.get(collection, 0):
+                # A single reload answers every request counted so far
+                cache.refresh_cache()
+                self.leader_reloads += 1
+                refreshed[collection] = requested[collection]
+
+        versions = {}
+        for collection, cache in self.caches.items():
+            snapshot = cache.snapshot
+            if cache.generation == 0:
+                continue
+            published = self._published.get(collection)
+            if published is not None and published[0]() is snapshot:
+                versions[collection] = published[1]
+                continue
+            # Only reloads are published, followers with change streams
+            # apply the changes themselves
+            if not self.snapshots.write(cache, force=True):
+                continue
+            version = snapshot_version(snapshot_path(self.snapshots.directory, cache))
+            self._published[collection] = (weakref.ref(snapshot), version)
+            versions[collection] = version
+        if (
+            versions == _counts(self.elector.annotations, SNAPSHOTS_ANNOTATION)
+            and refreshed == _counts(self.elector.annotations, REFRESHED_ANNOTATION)
+        ):
+            return
+
+        def publish(annotations: Dict[str, str]):
+            # Requests counted meanwhile are answered by the next reload
+            served = _counts(annotations, REFRESHED_ANNOTATION)
+            for collection, count in refreshed.items():
+                served[collection] = max(served.get(collection, 0), count)
+            annotations[SNAPSHOTS_ANNOTATION] = json.dumps(versions, sort_keys=True)
+            annotations[REFRESHED_ANNOTATION] = json.dumps(served, sort_keys=True)
+
+        self.elector.update_annotations(publish)
+        self.publishes += 1
+        with self._condition:
+            self._pulled.update(versions)
+            self._served.update(refreshed)
+            self._condition.notify_all()
+
+    def refresh(self, cache, on_miss: bool = False):
+        """Load of a follower's cache: have the leader reload it, then pull it.
+
+        Raises TimeoutError when no snapshot answered the request within the
+        refresh timeout, or the miss timeout for a lookup of an unknown id,
+        which should not hold a request thread for long.
+        """
+        collection = cache.collection_name
+        requested = {}
+
+        def request(annotations: Dict[str, str]):
+            counts = _counts(annotations, REFRESH_REQUESTS_ANNOTATION)
+            counts[collection] = counts.get(collection, 0) + 1
+            requested.update(counts)
+            with self._condition:
+                # Before the Lease is updated, the answer may come right after
+                self._requested[collection] = counts[collection]
+            annotations[REFRESH_REQUESTS_ANNOTATION] = json.dumps(counts, sort_keys=True)
+
+        self.elector.update_annotations(request)
+        self.requests += 1
+        if self.leader:
+            # Elected meanwhile, the request is for this worker
+            self._lead.set()
+        timeout = self.miss_timeout_seconds if on_miss else self.refresh_timeout_seconds
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while self._served.get(collection, 0) < requested[collection]:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(
+                        f"No snapshot of {collection} published by the leader "
+                        f"within {timeout}s"
+                    )
+                self._condition.wait(remaining)
+
+    def pull(self, cache):
+        """Warm `cache` up from the snapshot the leader serves.
+
+        The leader may still be loading it. Refreshes the cache instead (a
+        request to the leader, or a reload on the leader itself) when no
+        snapshot could be downloaded within the refresh timeout.
+        """
+        collection = cache.collection_name
+        deadline = time.monotonic() + self.refresh_timeout_seconds
+        with self._condition:
+            # Downloaded by the election thread once published
+            while (
+                not self.leader
+                and collection not in self._pulled
+                and time.monotonic() < deadline
+            ):
+                self._condition.wait(max(deadline - time.monotonic(), 0))
+        if cache.generation == 0:
+            cache.refresh_cache()
+
+    def stats(self) -> Dict:
+        return {
+            "identity": self.elector.identity,
+            "leader": self.leader,
+            "holder": self.elector.lease.spec.holder_identity
+            if self.elector.lease is not None
+            else None,
+            "pulls": self.pulls,
+            "publishes": self.publishes,
+            "refresh_requests": self.requests,
+            "leader_reloads": self.leader_reloads,
+        }
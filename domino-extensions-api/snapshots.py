@@ -0,0 +1,448 @@
+"""snapshots Module.
+
+This module implements on-disk snapshots of the caches, so that a restarted
+worker serves from the cache it had instead of rescanning the collections.
+
+A snapshot is a compact binary file per cache: a header with the Mongo
+cluster time and change stream resume token the cache was current at and
+the digest of its content (not recomputed on load), a
+table of the distinct strings (docker images, revision specs) and one fixed
+width record per entry, with the ids as their 12 raw bytes. The root image
+of every revision is stored with it, so loading a snapshot neither queries
+Mongo nor walks the revision hierarchies. Snapshots are read through a
+memory map, and written to a temporary file renamed over the previous one so
+that a reader never sees a partially written snapshot.
+
+After loading a snapshot the cache catches up from its position: the change
+stream watchers resume from the stored resume token (or cluster time), and
+without change streams the collections are read again in the background
+while requests are served from the snapshot.
+
+Example:
+    snapshots = CacheSnapshots([ENVIRONMENT_REVISION_CACHE, PROJECTS_CACHE], "/snapshots")
+    snapshots.load(PROJECTS_CACHE)  # True when the snapshot was read
+    snapshots.start()  # Writes the changed caches every interval
+"""
+import gc
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+import bson
+from bson import ObjectId
+from bson.timestamp import Timestamp
+
+from caches import (
+    ROOT_IMAGE_CYCLE,
+    ROOT_IMAGE_NOT_FOUND,
+    ROOT_IMAGE_SUCCESS,
+    EnvironmentRevision,
+    EnvironmentRevisionCache,
+    EnvironmentRevisionSnapshot,
+    Project,
+    ProjectsCache,
+    ProjectsSnapshot,
+)
+
+logger = logging.getLogger("extended-api")
+
+MAGIC = b"XAPISNAP"
+FORMAT_VERSION = 2
+DEFAULT_SNAPSHOT_INTERVAL_SECONDS = 300.0
+
+KIND_ENVIRONMENT_REVISIONS = 1
+KIND_PROJECTS = 2
+
+# magic, format version, kind, cluster time (t, i), resume token length,
+# string count, record count, content digest, CRC32 of everything after the
+# header
+HEADER = struct.Struct("<8sHBxIIIIIQI")
+STRING_LENGTH = struct.Struct("<I")
+# id, environment id, base revision id, version, docker image, root image,
+# root image status, flags
+REVISION_RECORD = struct.Struct("<12s12s12siIIBB")
+# id, environment id, default environment revision spec, flags
+PROJECT_RECORD = struct.Struct("<12s12sIB")
+
+NO_STRING = 0xFFFFFFFF
+NO_ID = bytes(12)
+HAS_BASE_REVISION = 1
+HAS_ENVIRONMENT = 1
+ROOT_IMAGE_STATUSES = (ROOT_IMAGE_SUCCESS, ROOT_IMAGE_NOT_FOUND, ROOT_IMAGE_CYCLE)
+
+
+class SnapshotError(Exception):
+    """The cache cannot be written to, or restored from, a snapshot file."""
+
+
+class _StringTable:
+    def __init__(self):
+        self.strings: List[str] = []
+        self._indexes: Dict[str, int] = {}
+
+    def index(self, value: Optional[str]) -> int:
+        if value is None:
+            return NO_STRING
+        index = self._indexes.get(value)
+        if index is None:
+            index = self._indexes[value] = len(self.strings)
+            self.strings.append(value)
+        return index
+
+    def encode(self) -> bytes:
+        parts = []
+        for value in self.strings:
+            encoded = value.encode("utf-8")
+            parts.append(STRING_LENGTH.pack(len(encoded)))
+            parts.append(encoded)
+        return b"".join(parts)
+
+
+def _id_bytes(value) -> bytes:
+    if not isinstance(value, ObjectId):
+        raise SnapshotError(f"Cannot store the id {value!r}, not an ObjectId")
+    return value.binary
+
+
+def _object_id(raw: bytes, interned: Dict[bytes, ObjectId]) -> ObjectId:
+    """A shared ObjectId instance per id, like the interning of a load."""
+    value = interned.get(raw)
+    if value is None:
+        value = interned[raw] = ObjectId(raw)
+    return value
+
+
+def _encode_revisions(snapshot: EnvironmentRevisionSnapshot) -> Tuple[bytes, int, int]:
+    strings = _StringTable()
+    records = bytearray()
+    for revision in snapshot.cache.values():
+        image, status = snapshot.root_images.get(
+            revision._id, (None, ROOT_IMAGE_NOT_FOUND)
+        )
+        base = revision.base_environment_revision_id
+        records += REVISION_RECORD.pack(
+            _id_bytes(revision._id),
+            _id_bytes(revision.environment_id),
+            NO_ID if base is None else _id_bytes(base),
+            revision.version,
+            strings.index(revision.docker_image),
+            strings.index(image),
+            ROOT_IMAGE_STATUSES.index(status),
+            0 if base is None else HAS_BASE_REVISION,
+        )
+    return strings.encode() + records, len(strings.strings), len(snapshot.cache)
+
+
+def _encode_projects(snapshot: ProjectsSnapshot) -> Tuple[bytes, int, int]:
+    strings = _StringTable()
+    records = bytearray()
+    for project in snapshot.cache.values():
+        environment_id = project.environment_id
+        records += PROJECT_RECORD.pack(
+            _id_bytes(project._id),
+            NO_ID if environment_id is None else _id_bytes(environment_id),
+            strings.index(project.default_environment_revision_spec),
+            0 if environment_id is None else HAS_ENVIRONMENT,
+        )
+    return strings.encode() + records, len(strings.strings), len(snapshot.cache)
+
+
+def _decode_revisions(
+    strings: Dict[int, Optional[str]], records: memoryview
+) -> EnvironmentRevisionSnapshot:
+    snapshot = EnvironmentRevisionSnapshot(generation=0)
+    interned: Dict[bytes, ObjectId] = {}
+    root_images = snapshot.root_images
+    for raw_id, raw_env, raw_base, version, image, root, status, flags in (
+        REVISION_RECORD.iter_unpack(records)
+    ):
+        revision = EnvironmentRevision.__new__(EnvironmentRevision)
+        revision._id = _object_id(raw_id, interned)
+        revision.environment_id = _object_id(raw_env, interned)
+        revision.version = version
+        revision.docker_image = strings[image]
+        revision.base_environment_revision_id = (
+            _object_id(raw_base, interned) if flags & HAS_BASE_REVISION else None
+        )
+        snapshot.add(revision)
+        root_images[revision._id] = (strings[root], ROOT_IMAGE_STATUSES[status])
+    # Where resolve_root_images stopped on a missing revision
+    snapshot.dangling_parents = {
+        revision.base_environment_revision_id
+        for revision in snapshot.cache.values()
+        if revision.docker_image is None
+        and revision.base_environment_revision_id not in snapshot.cache
+    }
+    return snapshot
+
+
+def _decode_projects(
+    strings: Dict[int, Optional[str]], records: memoryview
+) -> ProjectsSnapshot:
+    snapshot = ProjectsSnapshot(generation=0)
+    interned: Dict[bytes, ObjectId] = {}
+    cache = snapshot.cache
+    for raw_id, raw_env, spec, flags in PROJECT_RECORD.iter_unpack(records):
+        project = Project.__new__(Project)
+        project._id = ObjectId(raw_id)
+        project.environment_id = (
+            _object_id(raw_env, interned) if flags & HAS_ENVIRONMENT else None
+        )
+        project.default_environment_revision_spec = strings[spec]
+        cache[project._id] = project
+    return snapshot
+
+
+CODECS = {
+    EnvironmentRevisionCache: (
+        KIND_ENVIRONMENT_REVISIONS,
+        REVISION_RECORD,
+        _encode_revisions,
+        _decode_revisions,
+    ),
+    ProjectsCache: (KIND_PROJECTS, PROJECT_RECORD, _encode_projects, _decode_projects),
+}
+
+
+def _codec(cache):
+    codec = CODECS.get(type(cache))
+    if codec is None:
+        raise SnapshotError(f"No snapshot format for {type(cache).__name__}")
+    return codec
+
+
+def snapshot_path(directory: str, cache) -> str:
+    return os.path.join(directory, f"{cache.collection_name}.snapshot")
+
+
+def write_snapshot(cache, path: str) -> int:
+    """Write the cache and its position to `path`, returns the bytes written."""
+    kind, _, encode, _ = _codec(cache)
+    # Read before the entries: the entries may be newer than the position,
+    # never older, and replaying a change on restore is harmless
+    cluster_time, resume_token = cache.cluster_time, cache.resume_token
+    payload, string_count, record_count, digest = cache.export(
+        lambda snapshot: (*encode(snapshot), snapshot.digest)
+    )
+    token = bson.encode(resume_token) if resume_token is not None else b""
+    body = token + payload
+    header = HEADER.pack(
+        MAGIC,
+        FORMAT_VERSION,
+        kind,
+        cluster_time.time if cluster_time is not None else 0,
+        cluster_time.inc if cluster_time is not None else 0,
+        len(token),
+        string_count,
+        record_count,
+        digest,
+        zlib.crc32(body),
+    )
+    # Unique across the pods sharing the folder, their worker pids are alike
+    fd, temporary = tempfile.mkstemp(
+        dir=os.path.dirname(path) or ".",
+        prefix=f"{os.path.basename(path)}.",
+        suffix=".tmp",
+    )
+    try:
+        # mkstemp creates it private, the other pods read it as well
+        os.fchmod(fd, 0o644)
+        with os.fdopen(fd, "wb") as f:
+            f.write(header)
+            f.write(body)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, path)
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+    return len(header) + len(body)
+
+
+def snapshot_version(path: str) -> str:
+    """The checksum of the snapshot at `path`, equal for equal snapshots."""
+    with open(path, "rb") as f:
+        header = f.read(HEADER.size)
+    if len(header) < HEADER.size or header[: len(MAGIC)] != MAGIC:
+        raise SnapshotError(f"{path} is not a snapshot")
+    return f"{HEADER.unpack(header)[-1]:08x}"
+
+
+def read_snapshot(cache, path: str):
+    """Read the snapshot of `cache` at `path`.
+
+    Returns the cache snapshot and the cluster time and resume token it was
+    current at, or raises SnapshotError if the file is not a valid snapshot
+    of this kind of cache.
+    """
+    kind, record, _, decode = _codec(cache)
+    with open(path, "rb") as f, mmap.mmap(
+        f.fileno(), 0, access=mmap.ACCESS_READ
+    ) as data, memoryview(data) as view:
+        if len(view) < HEADER.size:
+            raise SnapshotError(f"{path} is truncated")
+        (
+            magic,
+            version,
+            file_kind,
+            time_t,
+            time_i,
+            token_length,
+            string_count,
+            record_count,
+            digest,
+            checksum,
+        ) = HEADER.unpack_from(view)
+        if magic != MAGIC or version != FORMAT_VERSION or file_kind != kind:
+            raise SnapshotError(f"{path} is not a version {FORMAT_VERSION} snapshot")
+        # Every view of the map is released before it is closed
+        with view[HEADER.size :] as body:
+            if zlib.crc32(body) != checksum:
+                raise SnapshotError(f"{path} is corrupted")
+            resume_token = None
+            if token_length:
+                with body[:token_length] as token:
+                    resume_token = bson.decode(token.tobytes())
+            strings: Dict[int, Optional[str]] = {NO_STRING: None}
+            offset = token_length
+            for index in range(string_count):
+                (length,) = STRING_LENGTH.unpack_from(body, offset)
+                offset += STRING_LENGTH.size
+                with body[offset : offset + length] as encoded:
+                    strings[index] = str(encoded, "utf-8")
+                offset += length
+            with body[offset:] as records:
+                if len(records) != record_count * record.size:
+                    raise SnapshotError(f"{path} has {len(records)} bytes of records")
+                # Every object built is kept, collecting garbage during the
+                # allocations would only cost time (half of the load)
+                gc_enabled = gc.isenabled()
+                gc.disable()
+                try:
+                    snapshot = decode(strings, records)
+                    snapshot.digest = digest
+                finally:
+                    if gc_enabled:
+                        gc.enable()
+    cluster_time = Timestamp(time_t, time_i) if time_t else None
+    return snapshot, cluster_time, resume_token
+
+
+class CacheSnapshots:
+    """Loads the caches from their snapshots and writes the changed ones.
+
+    A snapshot is written every `interval_seconds` when the cache changed
+    since the last one, and once more when stopped. Every gunicorn worker
+    writes its own caches; they hold the same data and each write replaces
+    the file in a single rename.
+    """
+
+    def __init__(
+        self,
+        caches: List,
+        directory: str,
+        interval_seconds: float = DEFAULT_SNAPSHOT_INTERVAL_SECONDS,
+    ):
+        self.caches = caches
+        self.directory = directory
+        self.interval_seconds = interval_seconds
+        self.loads = 0
+        self.writes = 0
+        self.failures = 0
+        # Version of every cache when its snapshot was last written or read
+        self._written: Dict[int, Tuple[int, int]] = {}
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @staticmethod
+    def _version(cache) -> Tuple[int, int]:
+        # Reloads replace the snapshot object, change stream events do not
+        snapshot = cache.snapshot
+        return id(snapshot), snapshot.generation
+
+    def load(self, cache, path: Optional[str] = None) -> bool:
+        """Restore `cache` from its snapshot, False if there is no usable one.
+
+        Reads the snapshot of the folder unless another `path` is given.
+        """
+        path = path or snapshot_path(self.directory, cache)
+        if not os.path.exists(path):
+            return False
+        start = time.perf_counter()
+        try:
+            snapshot, cluster_time, resume_token = read_snapshot(cache, path)
+        except (OSError, ValueError, struct.error, SnapshotError) as e:
+            self.failures += 1
+            logger.warning(f"Ignoring the snapshot of {cache.collection_name}: {e}")
+            return False
+        cache.restore(snapshot, cluster_time, resume_token)
+        self._written[id(cache)] = self._version(cache)
+        self.loads += 1
+        logger.warning(
+            f"Loaded {len(snapshot.cache)} {cache.collection_name} from {path} "
+            f"in {time.perf_counter() - start:.3f}s, as of {cluster_time}"
+        )
+        return True
+
+    def write(self, cache, force: bool = False) -> bool:
+        """Write the snapshot of `cache` if it changed since the last one."""
+        version = self._version(cache)
+        if cache.generation == 0 or (
+            not force and self._written.get(id(cache)) == version
+        ):
+            return False
+        path = snapshot_path(self.directory, cache)
+        start = time.perf_counter()
+        try:
+            size = write_snapshot(cache, path)
+        except (OSError, SnapshotError) as e:
+            self.failures += 1
+            logger.warning(f"Could not write the snapshot of {cache.collection_name}: {e}")
+            return False
+        self._written[id(cache)] = version
+        self.writes += 1
+        logger.info(
+            f"Wrote {len(cache.cache)} {cache.collection_name} to {path} "
+            f"({size} bytes) in {time.perf_counter() - start:.3f}s"
+        )
+        return True
+
+    def write_all(self):
+        for cache in self.caches:
+            self.write(cache)
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._thread = threading.Thread(
+            target=self.run, name="cache-snapshots", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None):
+        """Stop writing periodically, and write a last time.
+
+        Waits at most `timeout` seconds for a periodic write in progress, the
+        last write is skipped when it does not complete in time.
+        """
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                logger.warning(f"Snapshot write still running after {timeout} s")
+                self._thread = None
+                return
+            self._thread = None
+            self.write_all()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval_seconds):
+            self.write_all()
+
+    def stats(self) -> Dict[str, int]:
+        return {"loads": self.loads, "writes": self.writes, "failures": self.failures}
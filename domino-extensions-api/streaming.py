@@ -0,0 +1,149 @@
+"""streaming Module.
+
+This module implements the streaming mode of the enriched listings. The
+upstream array is parsed incrementally, every element is enriched as soon as
+it has been read, and the result is written out as a chunked JSON document
+or as newline delimited JSON. Memory use does not depend on the listing size.
+The `_async` variants do the same for the asyncio server.
+
+Example:
+    mode = stream_mode(request.args, request.headers)
+    if mode:
+        return Response(
+            stream_listing(
+                iter_upstream_items(resp, "projects"), "projects", _enrich_project, mode
+            ),
+            mimetype=STREAM_MIMETYPES[mode],
+        )
+"""
+import json
+import logging
+from typing import (
+    AsyncIterable,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    Optional,
+)
+
+import httpx
+import ijson  # type: ignore
+import requests
+
+logger = logging.getLogger("extended-api")
+
+STREAM_PARAM = "stream"
+STREAM_JSON = "json"
+STREAM_NDJSON = "ndjson"
+NDJSON_MIMETYPE = "application/x-ndjson"
+STREAM_MIMETYPES = {STREAM_JSON: "application/json", STREAM_NDJSON: NDJSON_MIMETYPE}
+UPSTREAM_CHUNK_SIZE = 64 * 1024
+
+
+def stream_mode(args, headers) -> Optional[str]:
+    """The requested streaming mode, or None for a regular response.
+
+    `stream=true` (or `stream=json`) streams a JSON document, `stream=ndjson`
+    or an `Accept: application/x-ndjson` header streams one element per line.
+    """
+    value = args.get(STREAM_PARAM, "").lower()
+    if value == STREAM_NDJSON or NDJSON_MIMETYPE in headers.get("Accept", ""):
+        return STREAM_NDJSON
+    if value in ("true", STREAM_JSON):
+        return STREAM_JSON
+    return None
+
+
+def upstream_params(params) -> Dict:
+    """Query parameters to forward to nucleus, without the streaming switch."""
+    return {k: v for k, v in params.items() if k != STREAM_PARAM}
+
+
+def iter_upstream_items(resp: requests.Response, key: str) -> Iterator[Dict]:
+    """Yield the elements of the `key` array of a streamed nucleus response.
+
+    Nothing is yielded when nucleus did not answer with 200, like the
+    buffered listings. The response is closed once consumed.
+    """
+    try:
+        if resp.status_code != 200:
+            return
+        resp.raw.decode_content = True
+        yield from ijson.items(resp.raw, f"{key}.item", use_float=True)
+    finally:
+        resp.close()
+
+
+def stream_listing(
+    items: Iterable[Dict],
+    key: str,
+    enrich: Callable[[Dict], Dict],
+    mode: str,
+) -> Iterator[str]:
+    if mode == STREAM_NDJSON:
+        for item in items:
+            yield json.dumps(enrich(item)) + "\n"
+        return
+    yield f'{{"{key}": ['
+    separator = ""
+    for item in items:
+        yield separator + json.dumps(enrich(item))
+        separator = ","
+    yield "]}"
+
+
+class _AsyncResponseReader:
+    """Async file-like view of a streamed httpx response, as ijson reads it."""
+
+    def __init__(self, resp: httpx.Response):
+        self._chunks = resp.aiter_bytes()
+        self._buffer = b""
+        self._done = False
+
+    async def read(self, size: int = -1) -> bytes:
+        if size == 0:
+            return b""
+        while not self._done and (size < 0 or len(self._buffer) < size):
+            try:
+                self._buffer += await self._chunks.__anext__()
+            except StopAsyncIteration:
+                self._done = True
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+async def iter_upstream_items_async(
+    resp: httpx.Response, key: str
+) -> AsyncIterator[Dict]:
+    """iter_upstream_items for a response streamed by AsyncNucleusClient."""
+    try:
+        if resp.status_code != 200:
+            return
+        reader = _AsyncResponseReader(resp)
+        async for item in ijson.items(reader, f"{key}.item", use_float=True):
+            yield item
+    finally:
+        await resp.aclose()
+
+
+async def stream_listing_async(
+    items: AsyncIterable[Dict],
+    key: str,
+    enrich: Callable[[Dict], Awaitable[Dict]],
+    mode: str,
+) -> AsyncIterator[str]:
+    if mode == STREAM_NDJSON:
+        async for item in items:
+            yield json.dumps(await enrich(item)) + "\n"
+        return
+    yield f'{{"{key}": ['
+    separator = ""
+    async for item in items:
+        yield separator + json.dumps(await enrich(item))
+        separator = ","
+    yield "]}"
@@ -1,12 +1,18 @@
+import hashlib
 import os
-import requests
-from typing import Dict
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
 import logging
 
+from flask import g, has_request_context  # type: ignore
+
+from nucleus import NUCLEUS_CLIENT
+
 logger = logging.getLogger("extended-api")
 
 WHO_AM_I_ENDPOINT = "v4/auth/principal"
-DOMINO_NUCLEUS_URI = "http://nucleus-frontend.domino-platform:80"
 
 
 def get_headers(headers):
@@ -18,21 +24,113 @@ def get_headers(headers):
     return new_headers
 
 
-def is_user_authorized(headers):
-    url: str = os.path.join(DOMINO_NUCLEUS_URI, WHO_AM_I_ENDPOINT)
-    ret: Dict = requests.get(url, headers=headers)
-    if ret.status_code == 200:
-        user: str = ret.json()
-        user_name: str = user["canonicalName"]
-        logger.warning(f"Extended API Invoking User {user_name}")
-        is_admin: bool = user["isAdmin"]
-        if is_admin:  # Admins can update mutations
-            logger.warning(
-                f"User {user_name} allowed because user is \
-                           a Domino Admin"
-            )
-            return True
-        else:
-            return False
+class PrincipalCache:
+    """Bounded LRU of nucleus principals keyed by a hash of the credentials.
+
+    Entries expire after `ttl_seconds` so revoked keys and admin changes are
+    picked up quickly. Only successful principal lookups are cached.
+    """
+
+    def __init__(self, ttl_seconds: float, max_entries: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[float, Dict]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[Dict]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: str, principal: Dict):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, principal)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict:
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+PRINCIPAL_CACHE = PrincipalCache(
+    ttl_seconds=float(os.environ.get("AUTH_CACHE_TTL_SECONDS", "30")),
+    max_entries=int(os.environ.get("AUTH_CACHE_MAX_ENTRIES", "1024")),
+)
+
+
+def _principal_cache_key(headers) -> str:
+    credentials = "|".join(f"{k}={headers[k]}" for k in sorted(headers))
+    return hashlib.sha256(credentials.encode("utf-8")).hexdigest()
+
+
+def get_principal(headers) -> Dict:
+    """Return the nucleus principal for the credentials in `headers`.
+
+    Resolved at most once per Flask request, and shared across requests
+    through the PRINCIPAL_CACHE.
+    """
+    key = _principal_cache_key(headers)
+    request_principals = None
+    if has_request_context():
+        request_principals = g.setdefault("principals", {})
+        if key in request_principals:
+            return request_principals[key]
+    principal = PRINCIPAL_CACHE.get(key)
+    if principal is None:
+        ret = NUCLEUS_CLIENT.get(WHO_AM_I_ENDPOINT, headers=headers)
+        if ret.status_code != 200:
+            raise Exception(str(ret.status_code) + " - Error getting user status")
+        principal = ret.json()
+        PRINCIPAL_CACHE.put(key, principal)
+    if request_principals is not None:
+        request_principals[key] = principal
+    return principal
+
+
+async def get_principal_async(headers, client) -> Dict:
+    """get_principal for the asyncio server, with an AsyncNucleusClient."""
+    key = _principal_cache_key(headers)
+    principal = PRINCIPAL_CACHE.get(key)
+    if principal is None:
+        ret = await client.get(WHO_AM_I_ENDPOINT, headers=headers)
+        if ret.status_code != 200:
+            raise Exception(str(ret.status_code) + " - Error getting user status")
+        principal = ret.json()
+        PRINCIPAL_CACHE.put(key, principal)
+    return principal
+
+
+def _is_admin(user: Dict) -> bool:
+    user_name: str = user["canonicalName"]
+    logger.warning(f"Extended API Invoking User {user_name}")
+    is_admin: bool = user["isAdmin"]
+    if is_admin:  # Admins can update mutations
+        logger.warning(
+            f"User {user_name} allowed because user is \
+                       a Domino Admin"
+        )
+        return True
     else:
-        raise Exception(str(ret.status_code) + " - Error getting user status")
+        return False
+
+
+def is_user_authorized(headers):
+    return _is_admin(get_principal(headers))
+
+
+async def is_user_authorized_async(headers, client):
+    return _is_admin(await get_principal_async(headers, client))
@@ -0,0 +1,122 @@
+"""warmup Module.
+
+This module implements the startup phase of a worker. A background thread
+runs the warm-up steps in order (connect to Mongo, load the caches, ...),
+retrying a failing step with backoff until it succeeds, while the worker
+already answers requests. The readiness endpoint reports its progress.
+
+Example:
+    warm_up = WarmUp([("mongo", ping), ("projects_cache", PROJECTS_CACHE.refresh_cache)])
+    warm_up.start()
+    warm_up.ready  # True once every step succeeded
+"""
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger("extended-api")
+
+STEP_PENDING = "pending"
+STEP_RUNNING = "running"
+STEP_DONE = "done"
+STEP_RETRYING = "retrying"
+
+DEFAULT_RETRY_BACKOFF_SECONDS = 1.0
+DEFAULT_MAX_RETRY_BACKOFF_SECONDS = 30.0
+
+
+class WarmUpStep:
+    def __init__(self, name: str, run: Callable[[], None]):
+        self.name = name
+        self.run = run
+        self.state = STEP_PENDING
+        self.attempts = 0
+        self.seconds: Optional[float] = None
+        self.last_error: Optional[str] = None
+
+    def status(self) -> Dict:
+        status = {"state": self.state, "attempts": self.attempts}
+        if self.seconds is not None:
+            status["seconds"] = round(self.seconds, 3)
+        if self.last_error is not None:
+            status["last_error"] = self.last_error
+        return status
+
+
+class WarmUp:
+    def __init__(
+        self,
+        steps: List[Tuple[str, Callable[[], None]]],
+        retry_backoff_seconds: float = DEFAULT_RETRY_BACKOFF_SECONDS,
+        max_retry_backoff_seconds: float = DEFAULT_MAX_RETRY_BACKOFF_SECONDS,
+    ):
+        self.steps = [WarmUpStep(name, run) for name, run in steps]
+        self.retry_backoff_seconds = retry_backoff_seconds
+        self.max_retry_backoff_seconds = max_retry_backoff_seconds
+        self._ready = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._started_at: Optional[float] = None
+
+    @property
+    def ready(self) -> bool:
+        return self._ready.is_set()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        return self._ready.wait(timeout)
+
+    def start(self):
+        self._started_at = time.monotonic()
+        self._thread = threading.Thread(target=self.run, name="warm-up", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None):
+        """Stop after the running step, waiting at most `timeout` seconds for it."""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                running = [s.name for s in self.steps if s.state == STEP_RUNNING]
+                logger.warning(
+                    f"Warm-up step {', '.join(running) or '?'} still running "
+                    f"after {timeout} s, not waiting for it"
+                )
+            self._thread = None
+
+    def run(self):
+        for step in self.steps:
+            if not self._run_step(step):
+                return
+        self._ready.set()
+        logger.warning(
+            f"Warm-up done in {time.monotonic() - (self._started_at or 0):.1f} s"
+        )
+
+    def _run_step(self, step: WarmUpStep) -> bool:
+        backoff = self.retry_backoff_seconds
+        while not self._stop_event.is_set():
+            step.state = STEP_RUNNING
+            step.attempts += 1
+            start = time.perf_counter()
+            try:
+                step.run()
+            except Exception as e:
+                step.state = STEP_RETRYING
+                step.last_error = str(e)
+                logger.exception(e)
+                logger.warning(f"Warm-up step {step.name} failed, retrying in {backoff} s")
+                self._stop_event.wait(backoff)
+                backoff = min(backoff * 2, self.max_retry_backoff_seconds)
+                continue
+            step.seconds = time.perf_counter() - start
+            step.state = STEP_DONE
+            step.last_error = None
+            return True
+        return False
+
+    def status(self) -> Dict:
+        return {
+            "ready": self.ready,
+            "steps": {step.name: step.status() for step in self.steps},
+        }